@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import os
+import errno
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import logging
+
+from discogstagger.copystrategy import FileCopier
+
+logger = logging
+
+class CacheMiss(Exception):
+    """ Raised, if a value is requested from the cache in offline mode and
+        the cache does not contain it
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class ReleaseCache(object):
+    """ persistent on-disk store for the release metadata fetched from the
+        discogs api. The json data of each release is stored in a sqlite
+        database keyed by the release id, entries are invalidated after
+        `ttl` seconds and the least recently used entries are evicted as soon
+        as the total size exceeds `max_size` bytes.
+
+        A ttl of 0 keeps entries forever, a max_size of 0 disables eviction.
+    """
+
+    DB_NAME = "releases.db"
+
+    def __init__(self, cache_dir, ttl=0, max_size=0):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        mkdir_p(cache_dir)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.DB_NAME),
+                                   timeout=30, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS releases (
+                                id INTEGER PRIMARY KEY,
+                                data TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                fetched REAL NOT NULL,
+                                accessed REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS releases_accessed ON releases (accessed)")
+        self._db.commit()
+
+    @classmethod
+    def from_config(cls, tagger_config):
+        """ creates the release cache as configured in the [cache] section,
+            returns None if the cache is disabled
+        """
+        if not tagger_config.getboolean("cache", "release_cache"):
+            return None
+
+        cache_dir = os.path.expanduser(tagger_config.get("cache", "cache_dir"))
+        # ttl is configured in days, the size in megabytes
+        ttl = tagger_config.getfloat("cache", "release_ttl") * 24 * 60 * 60
+        max_size = tagger_config.getint("cache", "release_max_size") * 1024 * 1024
+
+        return cls(cache_dir, ttl, max_size)
+
+    def get(self, release_id, allow_stale=False):
+        """ returns the cached json data (as dict) for the given release_id or
+            None, if the release is not cached (or expired)
+        """
+        with self._lock:
+            row = self._db.execute("SELECT data, fetched FROM releases WHERE id = ?",
+                                   (int(release_id),)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            data, fetched = row
+            now = time.time()
+
+            if self.ttl and fetched < now - self.ttl and not allow_stale:
+                logger.debug("cached release %s is expired" % release_id)
+                self.misses += 1
+                return None
+
+            self._db.execute("UPDATE releases SET accessed = ? WHERE id = ?",
+                             (now, int(release_id)))
+            self._db.commit()
+
+        self.hits += 1
+        return json.loads(data)
+
+    def put(self, release_id, data):
+        """ stores the json data (dict) of the given release and evicts old
+            entries if the cache grows beyond max_size
+        """
+        content = json.dumps(data)
+        now = time.time()
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO releases (id, data, size, fetched, accessed) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (int(release_id), content, len(content), now, now))
+            self._evict()
+            self._db.commit()
+
+    def __contains__(self, release_id):
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM releases WHERE id = ?",
+                                   (int(release_id),)).fetchone()
+        return row is not None
+
+    def _evict(self):
+        """ removes the least recently used entries until the total size of
+            the cache is below max_size (lock must be held by the caller)
+        """
+        if not self.max_size:
+            return
+
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM releases").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self._db.execute("SELECT id, size FROM releases ORDER BY accessed ASC").fetchall()
+        evicted = []
+        for release_id, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((release_id,))
+            total -= size
+
+        logger.debug("evicting %d releases from the release cache" % len(evicted))
+        self._db.executemany("DELETE FROM releases WHERE id = ?", evicted)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class ImageStore(object):
+    """ content-addressed on-disk store for the images downloaded from discogs.
+        The images are stored by the sha256 hash of their content, the
+        image urls are mapped to the hash, so that images referenced by
+        several releases (e.g. reissues or the discs of a box set) are only
+        downloaded (and stored) once. The least recently used images are
+        evicted as soon as the total size exceeds `max_size` bytes.
+
+        A max_size of 0 disables eviction.
+
+        The stored images are placed into the album directories as copies
+        (reflinks, if the filesystem supports them), never as hardlinks, so
+        that later writes to the album files cannot change the store. The
+        content is verified on lookup, corrupted images are dropped.
+    """
+
+    DB_NAME = "images.db"
+    BLOB_DIR = "images"
+
+    def __init__(self, cache_dir, max_size=0):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, self.BLOB_DIR)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.copier = FileCopier()
+
+        mkdir_p(self.blob_dir)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.DB_NAME),
+                                   timeout=30, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS urls (
+                                url TEXT PRIMARY KEY,
+                                hash TEXT NOT NULL)""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                                hash TEXT PRIMARY KEY,
+                                size INTEGER NOT NULL,
+                                accessed REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS urls_hash ON urls (hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed)")
+        self._db.commit()
+
+    @classmethod
+    def from_config(cls, tagger_config):
+        """ creates the image store as configured in the [cache] section,
+            returns None if the image cache is disabled
+        """
+        if not tagger_config.getboolean("cache", "image_cache"):
+            return None
+
+        cache_dir = os.path.expanduser(tagger_config.get("cache", "cache_dir"))
+        max_size = tagger_config.getint("cache", "image_max_size") * 1024 * 1024
+
+        return cls(cache_dir, max_size)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def lookup(self, image_url):
+        """ returns the path of the stored image for the given url or None,
+            if the image is not stored (or its content does not match its hash)
+        """
+        with self._lock:
+            row = self._db.execute("SELECT hash FROM urls WHERE url = ?",
+                                   (image_url,)).fetchone()
+
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            self.misses += 1
+            return None
+
+        digest = row[0]
+        if file_hash(self.blob_path(digest)) != digest:
+            logger.warn("removing corrupted image %s from the image cache" % digest)
+            with self._lock:
+                self._remove([digest])
+                self._db.commit()
+            self.misses += 1
+            return None
+
+        with self._lock:
+            self._db.execute("UPDATE blobs SET accessed = ? WHERE hash = ?",
+                             (time.time(), digest))
+            self._db.commit()
+
+        self.hits += 1
+        return self.blob_path(digest)
+
+    def add(self, image_url, source_file):
+        """ moves the (downloaded) source_file into the store and returns the
+            path of the stored image. If an image with the same content is
+            stored already, the source_file is removed.
+        """
+        digest = file_hash(source_file)
+        path = self.blob_path(digest)
+
+        with self._lock:
+            if os.path.exists(path) and file_hash(path) == digest:
+                os.remove(source_file)
+            else:
+                mkdir_p(os.path.dirname(path))
+                os.replace(source_file, path)
+
+            self._db.execute("INSERT OR REPLACE INTO blobs (hash, size, accessed) VALUES (?, ?, ?)",
+                             (digest, os.path.getsize(path), time.time()))
+            self._db.execute("INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)",
+                             (image_url, digest))
+            self._evict(keep=digest)
+            self._db.commit()
+
+        return path
+
+    def place(self, path, target_file):
+        """ copies the stored image to target_file (a reflink, if possible),
+            an existing target_file is replaced
+        """
+        self.copier.copy(path, target_file)
+
+    def _evict(self, keep=None):
+        """ removes the least recently used images until the total size of the
+            store is below max_size (lock must be held by the caller)
+        """
+        if not self.max_size:
+            return
+
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        rows = self._db.execute("SELECT hash, size FROM blobs ORDER BY accessed ASC").fetchall()
+        evicted = []
+        for digest, size in rows:
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            evicted.append(digest)
+            total -= size
+
+        logger.debug("evicting %d images from the image cache" % len(evicted))
+        self._remove(evicted)
+
+    def _remove(self, digests):
+        """ removes the given images (lock must be held by the caller), the
+            copies in the album directories are not affected
+        """
+        for digest in digests:
+            if os.path.exists(self.blob_path(digest)):
+                os.remove(self.blob_path(digest))
+        self._db.executemany("DELETE FROM urls WHERE hash = ?", [(digest,) for digest in digests])
+        self._db.executemany("DELETE FROM blobs WHERE hash = ?", [(digest,) for digest in digests])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def file_hash(path, chunk_size=64 * 1024):
+    """ returns the sha256 hex digest of the content of the given file """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def mkdir_p(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else: raise
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import os
+import errno
+import fcntl
+import shutil
+import tempfile
+import threading
+import logging
+
+logger = logging
+
+# ioctl cloning a whole file (linux/fs.h), supported by btrfs, xfs, ...
+FICLONE = 0x40049409
+
+# errors telling, that a strategy is not supported for the given files
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.ENOSYS, errno.EPERM, errno.EMLINK)
+
+# the copies get the permissions of a newly created file (mkstemp uses 0600)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def reflink(source_file, target_file):
+    """ clones the source file (copy-on-write), the data blocks are shared
+        until one of the files is modified
+    """
+    with open(source_file, "rb") as source, open(target_file, "wb") as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+def copy_range(source_file, target_file):
+    """ copies the file within the kernel (os.copy_file_range), the
+        filesystem might share the blocks or copy them server side (nfs)
+    """
+    with open(source_file, "rb") as source, open(target_file, "wb") as target:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(source.fileno(), target.fileno(), remaining)
+            if copied == 0:
+                # e.g. a filesystem (fuse, nfs) not copying the range, the
+                # target would be truncated, fall back to a plain copy
+                raise OSError(errno.EINVAL, "copy_file_range stopped with %d bytes left" % remaining)
+            remaining -= copied
+
+def hardlink(source_file, target_file):
+    """ links the source file, an existing target file is replaced (e.g. on
+        reruns) instead of being written through
+    """
+    if os.path.lexists(target_file) and os.path.samefile(source_file, target_file):
+        return
+    temp_file = os.path.join(os.path.dirname(target_file), ".%s.%d.%d.part" % (
+                             os.path.basename(target_file), os.getpid(), threading.get_ident()))
+    os.link(source_file, temp_file)
+    try:
+        os.replace(temp_file, target_file)
+    except:
+        os.remove(temp_file)
+        raise
+
+def rename(source_file, target_file):
+    """ moves the source file, an existing target file is replaced """
+    if os.path.lexists(target_file) and os.path.samefile(source_file, target_file):
+        # both names link the same file, rename would keep both
+        os.remove(source_file)
+        return
+    os.replace(source_file, target_file)
+
+def copy(source_file, target_file):
+    shutil.copyfile(source_file, target_file)
+
+# the methods placing the source file itself, the others write the data
+# into a new file
+LINKS = ('hardlink', 'rename')
+
+METHODS = {
+    'reflink': reflink,
+    'copy_file_range': copy_range,
+    'hardlink': hardlink,
+    'rename': rename,
+    'copy': copy,
+}
+
+class FileCopier(object):
+    """ copies files using the configured strategy, unsupported strategies
+        (e.g. a reflink on ext4 or across filesystems) fall back to the next
+        one and finally to a plain copy.
+
+        auto: on the same filesystem the files are cloned (reflink),
+              otherwise copied by the kernel (copy_file_range), the source
+              files are never changed
+        reflink, copy_file_range, copy: the given method
+        hardlink: links the files, only allowed for files which are never
+              modified afterwards (e.g. scans)
+        rename: moves the files out of the source directory, only if it is
+              set explicitly and keep_original=False. This is destructive,
+              a run failing halfway leaves an incomplete source directory
+              behind, which cannot be tagged again.
+
+        The data is written into a temporary file in the target directory,
+        which replaces the target file once it is complete. An existing
+        target file is never written in place, it might be linked to other
+        files (e.g. a hardlinked scan or image).
+    """
+
+    STRATEGIES = ('auto',) + tuple(METHODS)
+
+    def __init__(self, strategy="auto", move=False, allow_link=False):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("unknown copy strategy %s (one of %s)" % (strategy, ", ".join(self.STRATEGIES)))
+        if strategy == 'hardlink' and not allow_link:
+            raise ValueError("hardlink is not allowed for files modified after the copy")
+        if strategy == 'rename' and not move:
+            logger.warn("copy strategy rename needs keep_original=False, using auto")
+            strategy = 'auto'
+
+        self.strategy = strategy
+        self.move = move
+        # method -> number of files
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, tagger_config, option, allow_link=False):
+        """ creates the copier configured in the [copy] section using the
+            given option (e.g. audio_strategy)
+        """
+        return cls(tagger_config.get("copy", option),
+                   not tagger_config.getboolean("details", "keep_original"),
+                   allow_link)
+
+    def methods(self, source_file, target_file):
+        """ the methods to try (in this order) """
+        if self.strategy != 'auto':
+            return [self.strategy, 'copy']
+
+        if same_filesystem(source_file, target_file):
+            return ['reflink', 'copy_file_range', 'copy']
+        return ['copy_file_range', 'copy']
+
+    def copy(self, source_file, target_file, stat=False):
+        """ copies the source file to the target file, copies the permission
+            bits and times as well if stat is set (like shutil.copy2).
+            Returns the name of the method used.
+        """
+        for method in self.methods(source_file, target_file):
+            try:
+                if method in LINKS:
+                    METHODS[method](source_file, target_file)
+                else:
+                    self._write(method, source_file, target_file, stat)
+                break
+            except (OSError, AttributeError) as ex:
+                # AttributeError: os.copy_file_range is not available
+                if method == 'copy' or getattr(ex, 'errno', errno.ENOSYS) not in UNSUPPORTED:
+                    raise
+                logger.debug("%s not supported for %s: %s" % (method, target_file, ex))
+
+        with self._lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+        return method
+
+    def _write(self, method, source_file, target_file, stat):
+        """ writes the copy into a temporary file, which replaces the target
+            file afterwards
+        """
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target_file)),
+                                         prefix="." + os.path.basename(target_file), suffix=".part")
+        os.close(fd)
+        try:
+            os.chmod(temp_file, 0o666 & ~_UMASK)
+            METHODS[method](source_file, temp_file)
+            if stat:
+                shutil.copystat(source_file, temp_file)
+            os.replace(temp_file, target_file)
+        except:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+
+    def copy2(self, source_file, target_file):
+        """ copy including the stat (usable as copy_function of copytree) """
+        return self.copy(source_file, target_file, stat=True)
+
+    def log_summary(self, what):
+        if self.counts:
+            logger.debug("%s: %s" % (what, ", ".join("%s %d" % (method, count)
+                                                     for method, count in sorted(self.counts.items()))))
+
+def same_filesystem(source_file, target_file):
+    """ True, if the source file and the (existing) directory of the target
+        file are on the same filesystem
+    """
+    try:
+        return os.stat(source_file).st_dev == os.stat(os.path.dirname(os.path.abspath(target_file))).st_dev
+    except OSError:
+        return False
@@ -1,8 +1,6 @@
 import logging
 import re
 import os
-import urllib
-import urllib.request
 import string
 
 import pprint
@@ -16,8 +14,13 @@ import time
 import discogs_client as discogs
 
 import json
+import threading
 
 from discogstagger.album import Album, Disc, Track
+from discogstagger.cache import ReleaseCache
+from discogstagger.ratelimit import RateLimiter, RateLimitedFetcher
+from discogstagger.imagefetch import ImageDownloader
+from discogstagger.mediasession import MediaSession
 
 logger = logging
 
@@ -30,29 +33,75 @@ class AlbumError(Exception):
     def __str__(self):
         return repr(self.value)
 
-class RateLimit(object):
-    pass
+class CachedRelease(discogs.Release):
+    """ A release restored from the release cache. The cached data is the
+        complete api response, therefor there is no need to refresh it from
+        the discogs api server
+    """
+    def refresh(self):
+        pass
 
 class DiscogsConnector(object):
     """ central class to connect to the discogs api server.
-        this should be a singleton, to allow the usage of authentication and rate-limiting
+        The discogs client (including the authentication), the rate limiter and
+        the release cache are shared by all connectors in a process, to allow
+        the usage of authentication and rate-limiting.
         encapsules all discogs information retrieval
     """
 
+    # discogs clients shared by all connectors, see shared_client
+    _shared_clients = {}
+    _shared_lock = threading.Lock()
+
     def __init__(self, tagger_config):
         self.config = tagger_config
         self.user_agent = self.config.get("common", "user_agent")
-        self.discogs_client = discogs.Client(self.user_agent)
         self.tracklength_tolerance = self.config.getfloat("batch", "tracklength_tolerance")
-        self.discogs_auth = False
-        self.rate_limit_pool = {}
-        self.release_cache = {}
+        self.rate_limiter = RateLimiter.shared(self.config)
+        self.offline = self.config.getboolean("cache", "offline")
 
+        self.discogs_client, self.discogs_auth, self.release_cache = self.shared_client()
+        self.image_downloader = ImageDownloader.shared(self.config, self.rate_limiter)
+
+    @classmethod
+    def reset_shared(cls):
+        """ forgets the shared clients, the rate limiter and the image
+            downloader, to be used in forked worker processes, which must not
+            reuse the connections of the parent process
+        """
+        cls._shared_lock = threading.Lock()
+        cls._shared_clients = {}
+        RateLimiter.reset_shared()
+        ImageDownloader.reset_shared()
+
+    def shared_client(self):
+        """ returns the discogs client, the authentication state and the release
+            cache shared by all connectors using the same user agent. The
+            client is created (and authenticated) on first use only.
+        """
         skip_auth = self.config.get("discogs", "skip_auth")
+        key = (self.user_agent, skip_auth, self.offline)
 
-        if skip_auth != "True":
-            self.initialize_auth()
-            self.authenticate()
+        with DiscogsConnector._shared_lock:
+            if key not in DiscogsConnector._shared_clients:
+                self.discogs_client = discogs.Client(self.user_agent)
+                self.discogs_auth = False
+
+                if self.offline:
+                    logger.info('offline mode, using cached releases only')
+                elif skip_auth != "True":
+                    self.initialize_auth()
+                    self.authenticate()
+
+                # all api calls (including the lazy loading of the discogs_client
+                # objects) are running through the rate limiter
+                self.discogs_client._fetcher = RateLimitedFetcher(self.discogs_client._fetcher,
+                                                                  self.rate_limiter)
+
+                DiscogsConnector._shared_clients[key] = (self.discogs_client, self.discogs_auth,
+                                                         ReleaseCache.from_config(self.config))
+
+            return DiscogsConnector._shared_clients[key]
 
     def initialize_auth(self):
         """ initializes the authentication against the discogs api
@@ -82,27 +131,68 @@ class DiscogsConnector(object):
         return self.fetch_release(release_id)
 
     def fetch_release(self, release_id):
-        """ fetches the metadata for the given release_id from the discogs api server
-            (authentication necessary as well, specific rate-limit implemented on this one)
+        """ fetches the metadata for the given release_id from the release cache
+            or the discogs api server (authentication necessary as well,
+            specific rate-limit implemented on this one)
         """
         logger.info("fetching release with id %s" % release_id)
 
+        release = self.cached_release(release_id)
+        if release is not None:
+            logger.debug("using cached release %s" % release_id)
+            return release
+
+        if self.offline:
+            raise AlbumError("release {} is not cached, cannot fetch it in offline mode".format(release_id))
+
         if not self.discogs_auth:
             logger.error('You are not authenticated, cannot download image metadata')
 
-        rate_limit_type = 'metadata'
+        release = self.discogs_client.release(int(release_id))
+        if self.release_cache is not None:
+            release.refresh()
+            self.store_release(release)
+
+        return release
+
+    def cached_release(self, release_id):
+        """ returns the release with the given release_id from the release
+            cache, or None if it is not cached. Expired releases are used
+            in offline mode only.
+        """
+        if self.release_cache is None:
+            return None
+
+        data = self.release_cache.get(release_id, allow_stale=self.offline)
+        if data is None:
+            return None
+
+        return CachedRelease(self.discogs_client, data)
+
+    def restore_release(self, release):
+        """ completes a (partial) release, as returned by a search or a list
+            of master versions, using the release cache.
+            Returns True, if the release data is available from the cache.
+        """
+        if self.release_cache is None or not isinstance(release, discogs.Release):
+            return False
 
-        if rate_limit_type in self.rate_limit_pool:
-            if self.rate_limit_pool[rate_limit_type].lastcall >= time.time() - 5:
-                logger.warn('Waiting one second to allow rate limiting...')
-                time.sleep(5)
+        data = self.release_cache.get(release.data['id'], allow_stale=self.offline)
+        if data is None:
+            return False
 
-        rl = RateLimit()
-        rl.lastcall = time.time()
+        release.data.update(data)
+        return True
 
-        self.rate_limit_pool[rate_limit_type] = rl
+    def store_release(self, release):
+        """ stores the (complete) data of the given release in the release cache
+        """
+        if self.release_cache is None or not isinstance(release, discogs.Release):
+            return
 
-        return self.discogs_client.release(int(release_id))
+        # partial releases (e.g. search results) do not contain a tracklist
+        if 'tracklist' in release.data:
+            self.release_cache.put(release.data['id'], release.data)
 
     def authenticate(self):
         """ Authenticates the user on the discogs api via oauth 1.0a
@@ -163,41 +253,23 @@ class DiscogsConnector(object):
             be called, to make sure, that the user is authenticated already. Furthermore, discogs restricts the
             download of images to 1000 per day. This can be very low on huge volume collections ;-(
         """
-        self._rateLimit('image')
-        # rate_limit_type = 'image'
-
-        if not self.discogs_auth:
-            logger.error('You are not authenticated, cannot download image - skipping')
-            return
+        return self.fetch_images([(image_url, image_dir)]).wait()
 
-        # if rate_limit_type in self.rate_limit_pool:
-        #     if self.rate_limit_pool[rate_limit_type].lastcall >= time.time() - 5:
-        #         logger.warn('Waiting one second to allow rate limiting...')
-        #         time.sleep(5)
-        #
-        # rl = RateLimit()
-        # rl.lastcall = time.time()
-
-        try:
-            urllib.request.urlretrieve(image_url,  image_dir)
-            # urllib.urlretrieve(image_url,  image_dir)
-
-            # self.rate_limit_pool[rate_limit_type] = rl
-        except Exception as e:
-            logger.error("Unable to download image '%s', skipping. (%s)" % (image_url, e))
-
-    def _rateLimit(self, type='metadata'):
-        rate_limit_type = type
-
-        if rate_limit_type in self.rate_limit_pool:
-            if self.rate_limit_pool[rate_limit_type].lastcall >= time.time() - 5:
-                logger.warn('Waiting two seconds to allow rate limiting...')
-                time.sleep(5)
+    def fetch_images(self, images):
+        """
+            Starts the download of the given (image_url, target_file) pairs in the
+            background and returns an ImageBatch, which allows to wait for the
+            downloads (see fetch_image regarding authentication and limits)
+        """
+        if self.offline:
+            logger.warn('offline mode, using cached images only')
+            return self.image_downloader.submit(images, network=False)
 
-        rl = RateLimit()
-        rl.lastcall = time.time()
+        if not self.discogs_auth:
+            logger.error('You are not authenticated, cannot download image - using cached images only')
+            return self.image_downloader.submit(images, network=False)
 
-        self.rate_limit_pool[rate_limit_type] = rl
+        return self.image_downloader.submit(images)
 
 class DummyResponse(object):
     """
@@ -227,18 +299,24 @@ class LocalDiscogsConnector(object):
         pass
 
     def fetch_release(self, release_id, source_dir):
-        """ fetches the metadata for the given release_id from a local file
+        """ fetches the metadata for the given release_id from a local file,
+            if there is no such file, the release cache of the delegate is used
         """
-        dummy_response = DummyResponse(release_id, source_dir)
+        if not os.path.exists(os.path.join(source_dir, "%s.json" % release_id)):
+            release = self.delegate.cached_release(release_id)
+            if release is not None:
+                logger.debug("no local json for %s, using cached release" % release_id)
+                return release
 
-        # we need a dummy client here ;-(
-        client = discogs.Client('Dummy Client - just for testing')
+        dummy_response = DummyResponse(release_id, source_dir)
 
         self.content = self.convert(json.loads(dummy_response.content))
 
         logger.debug('content: %s' % self.content)
 
-        release = discogs.Release(client, self.content)
+        # use the client of the delegate, if the release needs to get
+        # refreshed, this is done using authentication and rate limiting
+        release = discogs.Release(self.delegate.discogs_client, self.content)
 
         return release
 
@@ -246,7 +324,10 @@ class LocalDiscogsConnector(object):
         self.delegate.authenticate()
 
     def fetch_image(self, image_dir, image_url):
-        self.delegate.fetch_image(image_dir, image_url)
+        return self.delegate.fetch_image(image_dir, image_url)
+
+    def fetch_images(self, images):
+        return self.delegate.fetch_images(images)
 
     def updateRateLimits(self, request):
         self.delegate.updateRateLimits(request)
@@ -671,6 +752,10 @@ class DiscogsSearch(DiscogsConnector):
     """ Search for a release based on the existing
         metadata of the files in the source directory
     """
+
+    # the tags read by getSearchParams
+    SEARCH_FIELDS = ('artist', 'albumartist', 'album', 'year', 'date', 'disc',
+                     'track', 'title')
     def __init__(self, tagger_config):
         DiscogsConnector.__init__(self, tagger_config)
         self.cue_done_dir = '.cue'
@@ -693,10 +778,12 @@ class DiscogsSearch(DiscogsConnector):
         else:
             return []
 
-    def getSearchParams(self, source_dir):
+    def getSearchParams(self, source_dir, session=None):
         """ get search parameters from exiting tags to find release on discogs.
             Minimum tags = artist, album title, disc, tracknumber and date is also helpful.
             If track numbers are not present they are guessed by their index.
+            The files are read through the given MediaSession (and kept for
+            the later stages of the album).
         """
         logger.info('Retrieving original metadata for search purposes')
         # reset candidates & searchParams
@@ -712,21 +799,25 @@ class DiscogsSearch(DiscogsConnector):
         trackcount = 0
         discnumber = 0
         searchParams['artists'] = []
+        # the length is taken from the probed stream information
+        if session is None:
+            session = MediaSession.from_config(self.config)
+        infos = session.infos(files, self.SEARCH_FIELDS)
         for i, file in enumerate(files):
             trackcount = trackcount + 1
-            metadata = MediaFile(os.path.join(file))
-            for a in metadata.artist:
+            metadata = infos[i].tags
+            for a in metadata['artist']:
                 searchParams['artists'].append(a)
-            searchParams['albumartist'] = ', '.join(set(metadata.albumartist))
-            searchParams['album'] = metadata.album
+            searchParams['albumartist'] = ', '.join(set(metadata['albumartist']))
+            searchParams['album'] = metadata['album']
             searchParams['album'] = re.sub('\[.*?\]', '', searchParams['album'])
-            searchParams['year'] = metadata.year
-            searchParams['date'] = metadata.date
+            searchParams['year'] = metadata['year']
+            searchParams['date'] = metadata['date']
             # print(file)
             # print(subdirectories)
-            if metadata.disc is not None and int(metadata.disc) > 1:
-                searchParams['disc'] = metadata.disc
-            elif metadata.disc is None and len(set(subdirectories)) > 1:
+            if metadata['disc'] is not None and int(metadata['disc']) > 1:
+                searchParams['disc'] = metadata['disc']
+            elif metadata['disc'] is None and len(set(subdirectories)) > 1:
                 trackdisc = re.search(r'^(?i)(cd|disc)\s?(?P<discnumber>[0-9]{1,2})', subdirectories[i])
                 searchParams['disc'] = int(trackdisc.group('discnumber'))
             # print(searchParams)
@@ -735,19 +826,19 @@ class DiscogsSearch(DiscogsConnector):
             if 'tracks' not in searchParams:
                 searchParams['tracks'] = []
             tracknumber = str(searchParams['disc']) + '-' if 'disc' in searchParams.keys() else ''
-            if metadata.track is not None:
-                tracknumber += str(metadata.track)
+            if metadata['track'] is not None:
+                tracknumber += str(metadata['track'])
             else:
                 tracknumber += str(trackcount)
 
             # print(searchParams)
             trackInfo = {}
-            if re.search(r'^(?i)[a-z]', str(metadata.track)):
-                trackInfo['real_tracknumber'] = metadata.track
+            if re.search(r'^(?i)[a-z]', str(metadata['track'])):
+                trackInfo['real_tracknumber'] = metadata['track']
             trackInfo['position'] = tracknumber
-            trackInfo['duration'] = str(timedelta(seconds = round(metadata.length, 0)))
-            trackInfo['title'] = metadata.title
-            trackInfo['artist'] = metadata.artist # useful for compilations
+            trackInfo['duration'] = str(timedelta(seconds = round(infos[i].length, 0)))
+            trackInfo['title'] = metadata['title']
+            trackInfo['artist'] = metadata['artist'] # useful for compilations
             searchParams['tracks'].append(trackInfo)
         searchParams['artists'] = list(dict.fromkeys(searchParams['artists']))
         searchParams['artist'] = ', '.join(searchParams['artists'])
@@ -840,7 +931,6 @@ class DiscogsSearch(DiscogsConnector):
             return release
 
     def search_artist_title(self, type):
-        self._rateLimit()
         searchParams = self.search_params
         candidates = self.candidates
         s = self.search_params['search']
@@ -869,7 +959,6 @@ class DiscogsSearch(DiscogsConnector):
 
 
     def search_artist(self):
-        self._rateLimit()
         searchParams = self.search_params
         candidates = self.candidates
 
@@ -901,7 +990,6 @@ class DiscogsSearch(DiscogsConnector):
             for i, release in enumerate(releases):
                 if len(candidates) > 0 or i > 25: # give up after 25 iterations
                     return
-                self._rateLimit()
                 r = release.title.lower()
                 s = searchParams['album'].lower()
 
@@ -984,7 +1072,10 @@ class DiscogsSearch(DiscogsConnector):
         """ Take the search parameters and look for a release, the searching &
             matching is done by various subroutines.
         """
-        self._rateLimit()
+        if self.offline:
+            logger.warn('offline mode, cannot search discogs')
+            return None
+
         logger.info('Searching discogs...')
 
         searchParams = self.search_params
@@ -1156,7 +1247,11 @@ class DiscogsSearch(DiscogsConnector):
             to what we have got.  Remove extra info appearing with empty track
             number, e.g. Bonus tracks, or section titles.
         """
-        self._rateLimit()
+        cached = self.restore_release(version)
+        if not cached and self.offline:
+            logger.debug('release {} is not cached, ignoring it in offline mode'.format(version.id))
+            return []
+
         trackinfo = []
         discogs_tracks = version.tracklist
         exclude = ("Video", "video", "DVD")
@@ -1175,4 +1270,8 @@ class DiscogsSearch(DiscogsConnector):
             for key in ['position', 'duration', 'title']:
                 discogs_info[key] = getattr(track, key)
             trackinfo.append(discogs_info)
+
+        if not cached:
+            self.store_release(version)
+
         return trackinfo
@@ -6,12 +6,17 @@ from mutagen.flac import FLAC
 import re
 from ext.cue import CUE, Track
 
+from discogstagger.scanner import ScanIndex, ParallelScanner, scandir
+
 import logging
 logger = logging
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
+AUDIO_EXTENSIONS = ('.flac', '.mp3', '.ape', '.wav', '.wv')
+DISC_DIR = re.compile(r'^(cd|disc)\s*\d+', re.IGNORECASE)
+
 class FileUtils(object):
     def __init__(self, tagger_config, options):
         self.config = tagger_config
@@ -20,6 +25,35 @@ class FileUtils(object):
         self.done_file = self.config.get("details", "done_file")
         self.forceUpdate = options.forceUpdate
 
+    def _scanner(self):
+        """ the scanner used to walk the source directory, the listings of
+            unchanged directories are read from the scan index (if enabled)
+        """
+        scan_index = ScanIndex.shared(self.config)
+        return ParallelScanner(scan_index.listdir if scan_index is not None else scandir,
+                               self.config.getint("batch", "scan_workers"))
+
+    def _walk(self, start_dir, visit):
+        scan_index = ScanIndex.shared(self.config)
+        try:
+            yield from self._scanner().walk(start_dir, visit)
+        finally:
+            if scan_index is not None:
+                scan_index.flush()
+
+    def _listdir(self, dir):
+        """ returns the names of the files in the given directory """
+        scan_index = ScanIndex.shared(self.config)
+        if scan_index is None:
+            return scandir(dir).files
+        return scan_index.listdir(dir).files
+
+    def _contains(self, dir, file_name):
+        scan_index = ScanIndex.shared(self.config)
+        if scan_index is None:
+            return os.path.exists(os.path.join(dir, file_name))
+        return file_name in scan_index.listdir(dir).files
+
     def read_id_file(self, dir, file_name, options):
         # read tags from batch file if available
         releaseid = None
@@ -36,59 +70,69 @@ class FileUtils(object):
         return releaseid
 
     def walk_dir_tree(self, start_dir, id_file):
-        source_dirs = []
-        for root, dirs, files in os.walk(start_dir):
+        """ Yields the directories containing an id file, the directories are
+            yielded as soon as they are found
+        """
+        def visit(root, dirs, files):
             if id_file in files:
                 logger.debug("found %s in %s" % (id_file, root))
-                source_dirs.append(root)
+                return root, dirs
+            return None, dirs
 
-        return source_dirs
+        yield from self._walk(start_dir, visit)
 
     def get_audio_dirs(self, start_dir):
-        """ Returns a list of directories with audio track to be processed.
-            Any CUE files encountered will be split automatically
+        """ Yields the directories with audio track to be processed (as soon as
+            they are found). Any CUE files encountered will be split automatically
         """
         parse_cue_files = self.config.getboolean('cue', 'parse_cue_files')
         extf = (self.cue_done_dir)
-        source_dirs = []
 
-        for root, dirs, files in os.walk(start_dir, topdown=True):
-            dirs[:] = [d for d in dirs if d not in extf]
+        def visit(root, dirs, files):
+            """ runs in the threads of the scanner, returns the audio and cue
+                files of the directory and the subdirectories to descend into
+            """
+            dirs = [d for d in dirs if d not in extf]
             done = []
             cue_files = []
             audio_files = []
             unwalk = []
             for dir in dirs:
-                if os.path.exists(os.path.join(root, dir, self.done_file)):
+                if self._contains(os.path.join(root, dir), self.done_file):
                     done.append(dir)
             if len(done) > 0:
-                dirs[:] = [d for d in dirs if d not in done]
+                dirs = [d for d in dirs if d not in done]
 
             for file in files:
                 if file.endswith('.cue'):
                     cue_files.append(file)
-                elif file.endswith(('.flac', '.mp3', '.ape', '.wav', '.wv')):
+                elif file.endswith(AUDIO_EXTENSIONS):
                     audio_files.append(file)
             for dir in dirs:
-                if re.search('^(?i)(cd|disc)\s*\d+', dir):
+                if DISC_DIR.search(dir):
                     logger.debug('Directory has cd/disc subdirectories')
                     unwalk.append(dir)
-                    d = Path(os.path.join(root, dir))
-                    for file in d.iterdir():
-                        if str(file).endswith('.cue'):
-                            cue_files.append(str(file))
-                        if str(file).endswith(('.flac', '.mp3', '.ape', '.wav', '.wv')):
-                            audio_files.append(str(file))
-            dirs[:] = [d for d in dirs if d not in unwalk]
+                    d = os.path.join(root, dir)
+                    for file in self._listdir(d):
+                        if file.endswith('.cue'):
+                            cue_files.append(os.path.join(d, file))
+                        if file.endswith(AUDIO_EXTENSIONS):
+                            audio_files.append(os.path.join(d, file))
+            dirs = [d for d in dirs if d not in unwalk]
+
+            if len(audio_files) > 0 or len(cue_files) > 0:
+                return (root, files, cue_files, audio_files), dirs
+            return None, dirs
+
+        for root, files, cue_files, audio_files in self._walk(start_dir, visit):
+            # the cue files are split one by one
             if parse_cue_files == True and len(cue_files) > 0 and len(cue_files) == len(audio_files):
                 result = self._processCueFiles(root, cue_files)
                 if result == 0:
-                    source_dirs.append(root + '/')
+                    yield root + '/'
             elif len(audio_files) > 0 and self.done_file not in files:
-                source_dirs.append(root + '/')
-                logger.debug('found %s in %s' % (file, root + '/'))
-
-        return source_dirs
+                logger.debug('found %s in %s' % (audio_files[-1], root + '/'))
+                yield root + '/'
 
     def _processCueFiles(self, dir, files):
         """ Process CUE files.  Work out multi-disc sets
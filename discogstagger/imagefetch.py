@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from discogstagger.cache import ImageStore
+
+logger = logging
+
+ImageTiming = namedtuple('ImageTiming', ['url', 'path', 'size', 'seconds', 'throttled', 'ok', 'cached'])
+
+class ImageBatch(object):
+    """ the pending downloads of a single album, wait() blocks until all images
+        are stored and returns the timings of the single images
+    """
+
+    def __init__(self, futures=None):
+        self.futures = futures or []
+
+    def wait(self):
+        return [future.result() for future in self.futures]
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+class ImageDownloader(object):
+    """ downloads images from discogs using a keep-alive connection pool and a
+        bounded pool of worker threads. Every download takes a token from the
+        image bucket of the rate limiter. Images are downloaded into a
+        temporary file, which is renamed to the target file afterwards.
+
+        If an ImageStore is given, images already stored are copied from the
+        store into the target directory without hitting the network, new
+        images are added to the store.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate_limiter, user_agent, workers=4, store=None):
+        self.rate_limiter = rate_limiter
+        self.workers = workers
+        self.store = store
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    @classmethod
+    def shared(cls, tagger_config, rate_limiter):
+        """ returns the process-wide image downloader """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(rate_limiter,
+                                  tagger_config.get("common", "user_agent"),
+                                  tagger_config.getint("images", "download_workers"),
+                                  ImageStore.from_config(tagger_config))
+            return cls._shared
+
+    @classmethod
+    def reset_shared(cls):
+        cls._shared_lock = threading.Lock()
+        cls._shared = None
+
+    def submit(self, images, network=True):
+        """ starts the download of the given (image_url, target_file) pairs
+            and returns an ImageBatch to wait for. Without `network` only the
+            images available in the store are used.
+        """
+        return ImageBatch([self.executor.submit(self.download, image_url, target_file, network)
+                           for image_url, target_file in images])
+
+    def download(self, image_url, target_file, network=True):
+        """ downloads a single image and returns its ImageTiming """
+        start = time.time()
+        throttled = 0.0
+        size = 0
+        ok = False
+
+        if self.store is not None:
+            path = self.store.lookup(image_url)
+            if path is not None:
+                try:
+                    self.store.place(path, target_file)
+                    timing = ImageTiming(image_url, target_file, os.path.getsize(target_file),
+                                         time.time() - start, throttled, True, True)
+                    logger.debug("using cached image {0} for {1}".format(
+                                 os.path.basename(path), os.path.basename(target_file)))
+                    return timing
+                except Exception as e:
+                    logger.warn("Unable to use cached image '%s' (%s)" % (image_url, e))
+
+        if not network:
+            logger.warn("Image '%s' is not cached, skipping." % image_url)
+            return ImageTiming(image_url, target_file, size, time.time() - start, throttled, ok, False)
+
+        for attempt in range(self.rate_limiter.max_retries + 1):
+            throttled += self.rate_limiter.acquire('image')
+            try:
+                resp = self.session.get(image_url, stream=True, timeout=60)
+                if resp.status_code == 429:
+                    resp.close()
+                    self.rate_limiter.backoff('image', resp.headers)
+                    continue
+
+                resp.raise_for_status()
+                size = self._store(resp, image_url, target_file)
+                ok = True
+            except Exception as e:
+                logger.error("Unable to download image '%s', skipping. (%s)" % (image_url, e))
+            break
+        else:
+            logger.error("Unable to download image '%s', rate limit exceeded, skipping." % image_url)
+
+        timing = ImageTiming(image_url, target_file, size, time.time() - start, throttled, ok, False)
+        if ok:
+            logger.debug("downloaded image {0} ({1} bytes) in {2:.2f}s ({3:.2f}s throttled)".format(
+                         os.path.basename(target_file), size, timing.seconds, throttled))
+        return timing
+
+    def _store(self, resp, image_url, target_file):
+        """ writes the response body to a temporary file in the target directory
+            and renames it to target_file (or moves it into the image store),
+            returns the number of bytes written
+        """
+        tmp_file = "%s.%d.part" % (target_file, threading.get_ident())
+        size = 0
+        try:
+            with open(tmp_file, 'wb') as fh:
+                for chunk in resp.iter_content(self.CHUNK_SIZE):
+                    fh.write(chunk)
+                    size += len(chunk)
+            if self.store is not None:
+                self.store.place(self.store.add(image_url, tmp_file), target_file)
+            else:
+                os.replace(tmp_file, target_file)
+        except:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        finally:
+            resp.close()
+
+        return size
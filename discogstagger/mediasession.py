@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from ext.mediafile import MediaFile
+from discogstagger.probe import probe, audio_info, ProbeError
+
+logger = logging
+
+class MediaSession(object):
+    """ the audio files of a single album, shared by the pipeline stages
+        (search, mapping, naming and tagging), so that every source file is
+        parsed once only: the tags are read from a single MediaFile (without
+        the pictures) and the stream information is probed once.
+        The target files are opened through the session as well, to count
+        them. flush drops the cached files and reports the number of parses,
+        more parses than files point to a stage reading the files again.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        # path -> MediaFile (read only, without pictures)
+        self._files = {}
+        # path -> AudioInfo
+        self._infos = {}
+        self._lock = threading.Lock()
+        # number of parses by kind (mutagen, probe, target)
+        self.parses = {'mutagen': 0, 'probe': 0, 'target': 0}
+
+    @classmethod
+    def from_config(cls, tagger_config):
+        return cls(tagger_config.getint("batch", "probe_workers"))
+
+    def _count(self, kind):
+        with self._lock:
+            self.parses[kind] = self.parses[kind] + 1
+
+    def metadata(self, path):
+        """ the (read only) MediaFile of the given source file """
+        path = os.path.abspath(path)
+        with self._lock:
+            metadata = self._files.get(path)
+        if metadata is None:
+            metadata = MediaFile(path, pictures=False)
+            self._count('mutagen')
+            with self._lock:
+                metadata = self._files.setdefault(path, metadata)
+        return metadata
+
+    def tags(self, path, fields):
+        """ the values of the given fields of the source file (as_dict) """
+        return self.metadata(path).as_dict(fields)
+
+    def info(self, path):
+        """ the AudioInfo of the given source file, flac and mp3 files are
+            probed, the others are read from their MediaFile
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            info = self._infos.get(path)
+        if info is None:
+            try:
+                info = probe(path)
+                self._count('probe')
+            except ProbeError as ex:
+                logger.debug("%s, using mutagen" % ex)
+                info = audio_info(path, self.metadata(path))
+            with self._lock:
+                info = self._infos.setdefault(path, info)
+        return info
+
+    def infos(self, paths, fields=None):
+        """ the AudioInfo of the given source files (in this order), read by
+            a pool of threads. If `fields` are given, these tags are read
+            as well (AudioInfo.tags).
+        """
+        def read(path):
+            info = self.info(path)
+            if fields:
+                info = info._replace(tags=self.tags(path, fields))
+            return info
+
+        paths = list(paths)
+        if self.workers <= 1 or len(paths) <= 1:
+            return [read(path) for path in paths]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(read, paths))
+
+    def target(self, path):
+        """ opens a target file for writing, the target files are not cached
+            (they are saved right away)
+        """
+        metadata = MediaFile(path)
+        self._count('target')
+        return metadata
+
+    def flush(self, name=None):
+        """ drops the cached files (once the tags are written) and logs the
+            number of parses, returns the number of parses by kind
+        """
+        with self._lock:
+            files = len(set(self._files) | set(self._infos))
+            self._files = {}
+            self._infos = {}
+            parses = dict(self.parses)
+
+        logger.info("Parsed {0} files{1}: {2} mutagen, {3} probed, {4} targets".format(
+                    files, " of %s" % name if name else "", parses['mutagen'],
+                    parses['probe'], parses['target']))
+        if parses['mutagen'] > files or parses['probe'] > files:
+            logger.warn("source files parsed more than once: %s" % parses)
+        return parses
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import logging
+import queue
+
+logger = logging
+
+# marks the end of the input of a stage
+_DONE = object()
+
+class Stage(object):
+    """ a single step of the pipeline, `func` is called with an item and
+        returns the item to hand over to the next stage or None, if the item
+        should not be processed any further. `workers` is the number of
+        threads running this stage concurrently.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        # statistics
+        self.items = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, busy, idle):
+        with self._lock:
+            self.items += 1
+            self.busy += busy
+            self.idle += idle
+
+class Pipeline(object):
+    """ runs items through a list of stages, each stage runs in its own
+        threads and is connected to the next stage by a bounded queue. This
+        way the network bound stages (e.g. fetching the release) overlap with
+        the disk and cpu bound stages (e.g. copying and tagging) of other
+        items, the throughput is limited by the slowest stage.
+
+        If a stage raises an exception, `error_handler(item, stage, exception)`
+        is called and the item is dropped.
+    """
+
+    def __init__(self, stages, queue_size=2, error_handler=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.error_handler = error_handler
+        self.completed = []
+        self.elapsed = 0.0
+
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        """ processes all items (any iterable) and returns the items, which
+            passed all stages
+        """
+        start = time.time()
+        # the input of the first stage is not bounded, it is filled upfront
+        queues = [queue.Queue()] + [queue.Queue(self.queue_size) for stage in self.stages[1:]]
+        remaining = [stage.workers for stage in self.stages]
+
+        threads = []
+        for no, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(no, queues, remaining),
+                                          name="%s-%d" % (stage.name, worker))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        # items might be a generator (e.g. the directories found while the
+        # source directory is still scanned)
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for worker in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+
+            for thread in threads:
+                thread.join()
+
+        self.elapsed = time.time() - start
+        return self.completed
+
+    def _work(self, no, queues, remaining):
+        stage = self.stages[no]
+        last = no == len(self.stages) - 1
+
+        try:
+            while True:
+                waiting = time.time()
+                item = queues[no].get()
+                if item is _DONE:
+                    break
+
+                started = time.time()
+                try:
+                    result = stage.func(item)
+                except Exception as ex:
+                    result = None
+                    self._error(item, stage, ex)
+                stage.record(time.time() - started, started - waiting)
+
+                if result is None:
+                    continue
+                if last:
+                    with self._lock:
+                        self.completed.append(result)
+                else:
+                    queues[no + 1].put(result)
+        finally:
+            # the last worker of a stage closes the input of the next stage,
+            # even if this worker failed (otherwise run would wait forever)
+            with self._lock:
+                remaining[no] -= 1
+                closing = remaining[no] == 0
+            if closing and not last:
+                for worker in range(self.stages[no + 1].workers):
+                    queues[no + 1].put(_DONE)
+
+    def _error(self, item, stage, ex):
+        """ reports the exception of a stage, a failing error handler does
+            not stop the worker
+        """
+        if self.error_handler is None:
+            logger.error("Error in stage {0}: {1}".format(stage.name, ex))
+            return
+        try:
+            self.error_handler(item, stage, ex)
+        except Exception as handler_ex:
+            logger.error("Error in stage {0}: {1} (error handler failed: {2})".format(
+                         stage.name, ex, handler_ex))
+
+    def log_summary(self):
+        logger.info("pipeline finished in {0:.1f}s".format(self.elapsed))
+        for stage in self.stages:
+            logger.info("stage {0}: {1} items, {2:.1f}s busy, {3:.1f}s idle ({4} workers)".format(
+                        stage.name, stage.items, stage.busy, stage.idle, stage.workers))
+
+        if self.elapsed:
+            slowest = max(self.stages, key=lambda stage: stage.busy / stage.workers)
+            logger.info("slowest stage: {0}".format(slowest.name))
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from ext.mediafile import MediaFile
+
+logger = logging
+
+AudioInfo = namedtuple('AudioInfo', ['path', 'type', 'samplerate', 'bitdepth',
+                                     'channels', 'bitrate', 'length', 'tags'])
+
+# number of bytes read at once, enough for the frame headers of a mp3 file
+# or the metadata block headers of a flac file
+READ_SIZE = 4096
+
+FLAC_STREAMINFO = 0
+
+# the extensions of the files probed as mp3, the other files (except flac
+# files, which are recognized by their magic bytes) are read by mutagen
+MP3_EXTENSIONS = ('.mp3',)
+
+# MPEG audio versions (header bits 19-20)
+MPEG25, MPEG2, MPEG1 = 0, 2, 3
+# bitrates in kbit/s by (version 1 or not, layer)
+MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLERATES = {
+    MPEG1: [44100, 48000, 32000],
+    MPEG2: [22050, 24000, 16000],
+    MPEG25: [11025, 12000, 8000],
+}
+
+class ProbeError(Exception):
+    """ the file cannot be probed (unsupported or unexpected format) """
+    pass
+
+def probe(path):
+    """ reads the stream information of a flac or mp3 file with a few small
+        reads (pread) of the headers, instead of parsing the whole file.
+        Flac files are recognized by their magic bytes, mp3 files by their
+        extension (see MP3_EXTENSIONS), raises ProbeError for other files
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        head = os.pread(fd, READ_SIZE, 0)
+        start = _id3v2_size(head)
+        if start:
+            head = os.pread(fd, READ_SIZE, start)
+        else:
+            start = 0
+
+        if head[:4] == b'fLaC':
+            return _probe_flac(fd, path, size, start, head)
+        if os.path.splitext(path)[1].lower() in MP3_EXTENSIONS:
+            return _probe_mp3(fd, path, size, start, head)
+        raise ProbeError("%s: neither a flac nor a mp3 file" % path)
+    finally:
+        os.close(fd)
+
+def _id3v2_size(data):
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in bytearray(data[6:10]):
+        size = (size << 7) | (byte & 0x7f)
+    return size + (20 if bytearray(data)[5] & 0x10 else 10)
+
+def _probe_flac(fd, path, size, start, head):
+    streaminfo = None
+    offset = start + 4
+    last = False
+    while not last:
+        header = bytearray(os.pread(fd, 4, offset))
+        if len(header) < 4:
+            raise ProbeError("%s: truncated flac metadata" % path)
+        last = bool(header[0] & 0x80)
+        length = struct.unpack('>I', b'\x00' + bytes(header[1:]))[0]
+        if header[0] & 0x7f == FLAC_STREAMINFO:
+            streaminfo = os.pread(fd, length, offset + 4)
+        offset += 4 + length
+
+    if streaminfo is None or len(streaminfo) < 18:
+        raise ProbeError("%s: no flac stream info" % path)
+
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1,
+    # 36 bits total samples
+    bits = int.from_bytes(streaminfo[10:18], 'big')
+    samplerate = bits >> 44
+    channels = ((bits >> 41) & 0x07) + 1
+    bitdepth = ((bits >> 36) & 0x1f) + 1
+    samples = bits & 0xfffffffff
+
+    length = float(samples) / samplerate if samplerate else 0.0
+    bitrate = int((size - offset) * 8 / length) if length else 0
+    return AudioInfo(path, 'flac', samplerate, bitdepth, channels, bitrate, length, None)
+
+def _mp3_frame(data, pos):
+    """ the properties of the mp3 frame starting at pos or None, if there
+        is no valid frame header
+    """
+    if pos + 4 > len(data):
+        return None
+    header = struct.unpack('>I', data[pos:pos + 4])[0]
+    if header >> 21 != 0x7ff:
+        return None
+    version = (header >> 19) & 0x03
+    layer = 4 - ((header >> 17) & 0x03)
+    bitrate_index = (header >> 12) & 0x0f
+    samplerate_index = (header >> 10) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or samplerate_index == 3:
+        return None
+
+    bitrate = MP3_BITRATES[(version == MPEG1, layer)][bitrate_index] * 1000
+    samplerate = MP3_SAMPLERATES[version][samplerate_index]
+    padding = (header >> 9) & 0x01
+    mono = (header >> 6) & 0x03 == 3
+
+    if layer == 1:
+        samples = 384
+        frame_size = (12 * bitrate // samplerate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == MPEG1 else 576
+        frame_size = samples // 8 * bitrate // samplerate + padding
+
+    return dict(version=version, layer=layer, bitrate=bitrate, samplerate=samplerate,
+                mono=mono, samples=samples, frame_size=frame_size)
+
+def _vbr_header(head, pos, frame):
+    """ the kind ('xing' or 'vbri') and the position of the Xing/Info or
+        VBRI header within the frame starting at pos, or None
+    """
+    if frame['version'] == MPEG1:
+        xing = pos + 4 + (17 if frame['mono'] else 32)
+    else:
+        xing = pos + 4 + (9 if frame['mono'] else 17)
+
+    if head[xing:xing + 4] in (b'Xing', b'Info'):
+        return 'xing', xing
+    if head[pos + 36:pos + 40] == b'VBRI':
+        return 'vbri', pos + 36
+    return None
+
+def _confirmed(fd, head, start, pos, frame):
+    """ True, if the frame starting at pos is followed by a matching frame
+        header (read from the file, if it is not within the head) or
+        contains a Xing/Info or VBRI header. A single sync word is no proof,
+        it is found in any binary data.
+    """
+    following = pos + frame['frame_size']
+    if following + 4 <= len(head):
+        data = head[following:following + 4]
+    else:
+        data = os.pread(fd, 4, start + following)
+    next_frame = _mp3_frame(data, 0)
+    if next_frame is not None and all(next_frame[key] == frame[key]
+                                      for key in ('version', 'layer', 'samplerate')):
+        return True
+    return _vbr_header(head, pos, frame) is not None
+
+def _probe_mp3(fd, path, size, start, head):
+    # the first confirmed frame
+    frame = None
+    for pos in range(len(head) - 4):
+        frame = _mp3_frame(head, pos)
+        if frame is not None and _confirmed(fd, head, start, pos, frame):
+            break
+        frame = None
+    if frame is None:
+        raise ProbeError("%s: no mp3 frame found" % path)
+
+    audio_start = start + pos
+    audio_size = size - audio_start
+    if audio_size >= 128 and os.pread(fd, 3, size - 128) == b'TAG':
+        audio_size -= 128
+
+    # a Xing/Info or VBRI header within the first frame contains the
+    # number of frames (like mutagen, the encoder delay and padding of the
+    # LAME header are not counted)
+    bitrate = frame['bitrate']
+    vbr = _vbr_header(head, pos, frame)
+
+    if vbr is not None and vbr[0] == 'xing':
+        xing = vbr[1]
+        flags = struct.unpack('>I', head[xing + 4:xing + 8])[0]
+        offset = xing + 8
+        frames = frame_bytes = None
+        if flags & 0x01:
+            frames = struct.unpack('>I', head[offset:offset + 4])[0]
+            offset += 4
+        if flags & 0x02:
+            frame_bytes = struct.unpack('>I', head[offset:offset + 4])[0]
+            offset += 4
+        offset += (100 if flags & 0x04 else 0) + (4 if flags & 0x08 else 0)
+
+        if frames is None:
+            length = float(audio_size) * 8 / bitrate
+        else:
+            samples = frames * frame['samples']
+            if frame_bytes is not None and samples > 0:
+                # the first frame is not counted in the frames
+                bitrate = int(round(max(0, frame_bytes - frame['frame_size']) * 8 *
+                                    frame['samplerate'] / float(samples)))
+            if head[offset:offset + 4] == b'LAME' and bytearray(head[offset + 9:offset + 10]) < b'\x10':
+                delay = int.from_bytes(head[offset + 21:offset + 24], 'big')
+                samples -= (delay >> 12) + (delay & 0xfff)
+            length = float(max(0, samples)) / frame['samplerate']
+    elif vbr is not None:
+        frame_bytes, frames = struct.unpack('>II', head[pos + 46:pos + 54])
+        length = float(frames * frame['samples']) / frame['samplerate']
+        if length:
+            bitrate = int(frame_bytes * 8 / length)
+    else:
+        length = float(audio_size) * 8 / bitrate
+
+    return AudioInfo(path, 'mp3', frame['samplerate'], 0, 1 if frame['mono'] else 2,
+                     bitrate, length, None)
+
+def audio_info(path, metadata):
+    """ the AudioInfo of an already opened MediaFile """
+    return AudioInfo(path, metadata.type, metadata.samplerate, metadata.bitdepth,
+                     metadata.channels, metadata.bitrate, metadata.length, None)
+
+def _read(path, fields):
+    """ probes the file, falls back to mutagen for other formats, the given
+        tags are read using the MediaFile (without the pictures)
+    """
+    info = None
+    try:
+        info = probe(path)
+    except ProbeError as ex:
+        logger.debug("%s, using mutagen" % ex)
+
+    if info is None or fields:
+        metadata = MediaFile(path, pictures=False)
+        if info is None:
+            info = audio_info(path, metadata)
+        if fields:
+            info = info._replace(tags=metadata.as_dict(fields))
+    return info
+
+def probe_many(paths, workers=4, fields=None):
+    """ probes the given files using a pool of threads (hiding the latency
+        of network filesystems) and returns the AudioInfo of each file in
+        the order of the paths. If `fields` are given, these tags are read
+        as well (AudioInfo.tags).
+    """
+    paths = list(paths)
+    if workers <= 1 or len(paths) <= 1:
+        return [_read(path, fields) for path in paths]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda path: _read(path, fields), paths))
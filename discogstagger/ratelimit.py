@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import os
+import fcntl
+import json
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from urllib.parse import urlparse
+
+import requests
+from discogs_client.fetchers import OAuth2Fetcher, UserTokenRequestsFetcher
+
+logger = logging
+
+class TokenBucket(object):
+    """ a token bucket for a single request class, `rate` is the number of
+        requests per second, `capacity` the number of requests, that can be
+        send in a burst.
+    """
+
+    def __init__(self, name, rate, capacity=1):
+        self.name = name
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.blocked_until = 0
+        self.updated = self._clock()
+        self.throttled = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _clock(self):
+        return time.monotonic()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            yield
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """ takes a token from the bucket and returns the number of seconds
+            the caller has to wait before the request is allowed. The token
+            is reserved for the caller, even if the bucket is empty.
+        """
+        with self._locked():
+            now = self._clock()
+            self._refill(now)
+            self.tokens -= 1
+            self.calls += 1
+
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+            if self.blocked_until > now + wait:
+                wait = self.blocked_until - now
+
+            self.throttled += wait
+
+        return wait
+
+    def acquire(self):
+        """ blocks until a request of this class is allowed """
+        wait = self.reserve()
+        if wait > 0:
+            logger.debug("rate limit ({0}): waiting {1:.2f}s".format(self.name, wait))
+            time.sleep(wait)
+        return wait
+
+    def update(self, limit=None, remaining=None, window=60):
+        """ adapts the bucket to the rate limit reported by the server,
+            `limit` is the number of requests allowed in the moving `window`
+            and `remaining` the number of requests left in the window
+        """
+        with self._locked():
+            self._refill(self._clock())
+            if limit:
+                self.rate = min(self.max_rate, float(limit) / window)
+            if remaining is not None and self.tokens > remaining:
+                self.tokens = remaining
+
+    def backoff(self, seconds):
+        """ blocks all requests of this class for the given number of seconds """
+        with self._locked():
+            now = self._clock()
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0)
+
+class SharedTokenBucket(TokenBucket):
+    """ a token bucket, whose state is shared between several processes on
+        one host. The state of all buckets is stored in a json file, which is
+        locked (flock) while a bucket is used.
+    """
+
+    def __init__(self, name, rate, capacity=1, state_file=None):
+        self.state_file = state_file
+        TokenBucket.__init__(self, name, rate, capacity)
+
+    def _clock(self):
+        # the monotonic clock is not comparable between processes
+        return time.time()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            with open(self.state_file, 'a+') as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                try:
+                    fh.seek(0)
+                    content = fh.read()
+                    state = json.loads(content) if content else {}
+
+                    if self.name in state:
+                        self.tokens, self.updated, self.blocked_until, self.rate = state[self.name]
+
+                    yield
+
+                    state[self.name] = [self.tokens, self.updated, self.blocked_until, self.rate]
+                    fh.seek(0)
+                    fh.truncate()
+                    fh.write(json.dumps(state))
+                    fh.flush()
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+class RateLimiter(object):
+    """ rate limiting for the discogs api, the api requests (metadata,
+        search) share one token bucket, as they count against the same
+        quota, the images get their own. The buckets are adapted using the
+        X-Discogs-Ratelimit headers of the responses and blocked for the
+        Retry-After period on 429 (too many requests) responses.
+    """
+
+    REQUEST_CLASSES = ('metadata', 'search', 'image')
+    # the bucket used by each request class
+    BUCKETS = {'metadata': 'api', 'search': 'api', 'image': 'image'}
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rates, burst=1, max_retries=3, state_file=None):
+        """ `rates` maps the buckets (api, image) to the allowed number of
+            requests per minute. If a `state_file` is given, the budget is
+            shared with all other processes using the same file.
+        """
+        self.buckets = {}
+        for name in set(self.BUCKETS.values()):
+            rate = rates.get(name, 60) / 60.0
+            if state_file:
+                self.buckets[name] = SharedTokenBucket(name, rate, burst, state_file)
+            else:
+                self.buckets[name] = TokenBucket(name, rate, burst)
+        self.max_retries = max_retries
+
+    @classmethod
+    def from_config(cls, tagger_config):
+        rates = {}
+        for name in set(cls.BUCKETS.values()):
+            rates[name] = tagger_config.getfloat("ratelimit", name)
+
+        state_file = tagger_config.get("ratelimit", "shared_state_file")
+        if state_file:
+            state_file = os.path.expanduser(state_file)
+            state_dir = os.path.dirname(state_file)
+            if state_dir and not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+
+        return cls(rates,
+                   tagger_config.getint("ratelimit", "burst"),
+                   tagger_config.getint("ratelimit", "max_retries"),
+                   state_file)
+
+    @classmethod
+    def shared(cls, tagger_config):
+        """ returns the process-wide rate limiter, all connectors have to use
+            the same limiter to respect the quota
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.from_config(tagger_config)
+            return cls._shared
+
+    @classmethod
+    def reset_shared(cls):
+        cls._shared_lock = threading.Lock()
+        cls._shared = None
+
+    @staticmethod
+    def classify(url):
+        """ determines the request class of the given url """
+        parts = urlparse(url)
+        if parts.path.startswith("/database/search"):
+            return 'search'
+        elif parts.hostname in ("img.discogs.com", "i.discogs.com") or parts.path.startswith("/image/"):
+            return 'image'
+        return 'metadata'
+
+    def acquire(self, request_class='metadata'):
+        return self.buckets[self.BUCKETS[request_class]].acquire()
+
+    def update_from_headers(self, request_class, headers):
+        """ reads the X-Discogs-Ratelimit headers of a response, the quota is
+            shared between all api request classes
+        """
+        limit = _int_header(headers, 'X-Discogs-Ratelimit')
+        remaining = _int_header(headers, 'X-Discogs-Ratelimit-Remaining')
+        used = _int_header(headers, 'X-Discogs-Ratelimit-Used')
+
+        if limit is None and remaining is None:
+            return
+
+        logger.debug("rate limit: {0} used, {1} remaining of {2}".format(used, remaining, limit))
+
+        self.buckets[self.BUCKETS[request_class]].update(limit, remaining)
+
+    def backoff(self, request_class, headers=None):
+        """ blocks the request class after a 429 response, using the
+            Retry-After header if available
+        """
+        retry_after = _int_header(headers or {}, 'Retry-After')
+        if retry_after is None:
+            retry_after = 60
+
+        logger.warn("rate limit exceeded ({0}), backing off for {1}s".format(request_class, retry_after))
+
+        self.buckets[self.BUCKETS[request_class]].backoff(retry_after)
+
+    @property
+    def throttled(self):
+        """ the total number of seconds spent waiting for the rate limit """
+        return sum(b.throttled for b in self.buckets.values())
+
+    def log_summary(self):
+        for name in sorted(self.buckets):
+            bucket = self.buckets[name]
+            if bucket.calls:
+                logger.info("rate limit ({0}): {1} calls, {2:.1f}s throttled".format(
+                            name, bucket.calls, bucket.throttled))
+
+class RateLimitedFetcher(object):
+    """ wraps the fetcher of a discogs_client.Client, to run all api calls
+        through the rate limiter. The HTTP request is executed here (and not
+        in the wrapped fetcher), to be able to read the response headers.
+    """
+
+    def __init__(self, fetcher, limiter, session=None):
+        self.fetcher = fetcher
+        self.limiter = limiter
+        self.session = session or requests.Session()
+
+    def __getattr__(self, name):
+        # token handling and the like is done by the wrapped fetcher
+        return getattr(self.fetcher, name)
+
+    def fetch(self, client, method, url, data=None, headers=None, json=True):
+        request_class = self.limiter.classify(url)
+
+        for attempt in range(self.limiter.max_retries + 1):
+            self.limiter.acquire(request_class)
+
+            resp = self._request(method, url, data, headers, json)
+            self.limiter.update_from_headers(request_class, resp.headers)
+
+            if resp.status_code != 429:
+                break
+
+            self.limiter.backoff(request_class, resp.headers)
+
+        return resp.content, resp.status_code
+
+    def _request(self, method, url, data=None, headers=None, json_format=True):
+        params = None
+
+        # the body is sent as json (like the discogs_client fetchers do), the
+        # api expects json for its write endpoints
+        if json_format and data:
+            data = json.dumps(data)
+            headers = dict(headers or {})
+            headers['Content-Type'] = 'application/json'
+
+        if isinstance(self.fetcher, OAuth2Fetcher):
+            # the signature contains a nonce, sign every attempt again (a json
+            # body is not part of the signature)
+            url, headers, body = self.fetcher.client.sign(url, http_method=method,
+                                                          body=None if json_format else data,
+                                                          headers=headers)
+            if not json_format:
+                data = body
+        elif isinstance(self.fetcher, UserTokenRequestsFetcher):
+            params = {'token': self.fetcher.user_token}
+
+        return self.session.request(method, url, params=params, data=data, headers=headers)
+
+def _int_header(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
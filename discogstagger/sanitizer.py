@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import threading
+import logging
+from functools import lru_cache
+from unicodedata import normalize
+
+logger = logging
+
+# characters allowed in file names, all others are removed
+DISALLOWED = re.compile(r"[^-\w.,()\[\]\s#@&!']")
+# windows doesn't like folders ending with '.'
+TRAILING_DOT = re.compile(r'\.$')
+
+class FilenameSanitizer(object):
+    """ Removes unwanted characters from file names (see
+        TaggerUtils.get_clean_filename).
+
+        The replacements ($ -> S and the character_exceptions of the
+        configuration) are applied by a single str.translate, if this gives
+        the same result as replacing them one after another (single
+        characters, no replacement containing a character replaced later),
+        otherwise by str.replace. The results are memoized, the same names
+        are cleaned several times while building the paths of an album.
+    """
+
+    # (replacements, normalize, lower, file types) -> FilenameSanitizer,
+    # shared by all albums of a batch
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, exceptions, normalize=False, lower=False, file_types=(), cache_size=4096):
+        self.replacements = [('$', 'S')] + list(exceptions.items())
+        self.normalize = normalize
+        self.lower = lower
+        self.file_types = tuple(file_types)
+        self.table = self._translation(self.replacements)
+        if self.table is None:
+            logger.debug("character exceptions are replaced one by one: %s" % self.replacements)
+        self.clean = lru_cache(maxsize=cache_size)(self._clean)
+
+    @classmethod
+    def shared(cls, exceptions, normalize=False, lower=False, file_types=()):
+        """ returns the sanitizer of the given configuration, which is shared
+            by all albums (and threads) of the process
+        """
+        key = (tuple(exceptions.items()), normalize, lower, tuple(file_types))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(exceptions, normalize, lower, file_types)
+            return cls._shared[key]
+
+    @classmethod
+    def reset_shared(cls):
+        cls._shared_lock = threading.Lock()
+        cls._shared = {}
+
+    @staticmethod
+    def _translation(replacements):
+        """ the table for str.translate or None, if the replacements depend
+            on their order
+        """
+        table = {}
+        for i, (old, new) in enumerate(replacements):
+            if len(old) != 1:
+                return None
+            if any(later in new for later, ignored in replacements[i + 1:]):
+                return None
+            # a character replaced twice keeps its first replacement
+            table.setdefault(ord(old), new)
+        return table
+
+    def _clean(self, f):
+        filename, fileext = os.path.splitext(f)
+
+        if not fileext in self.file_types:
+            filename = f
+            fileext = ""
+
+        a = TRAILING_DOT.sub('', str(filename))
+
+        if self.table is not None:
+            a = a.translate(self.table)
+        else:
+            for k, v in self.replacements:
+                a = a.replace(k, v)
+
+        if self.normalize:
+            a = normalize("NFKD", a)
+
+        # Don't force space/underscore replacement. If the user wants this it
+        # can be done via config. The user may _want_ spaces.
+        cf = DISALLOWED.sub("", a) + fileext
+
+        if self.lower:
+            cf = cf.lower()
+
+        return cf
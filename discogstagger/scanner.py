@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from discogstagger.cache import mkdir_p
+
+logger = logging
+
+DirListing = namedtuple('DirListing', ['dirs', 'files'])
+
+class ScanIndex(object):
+    """ persistent index of the directory listings of the source tree. The
+        listing of a directory is only read again, if the mtime (or inode) of
+        the directory changed, this way a rescan of a huge (network mounted)
+        library needs a single stat per directory instead of listing and
+        checking all the entries.
+    """
+
+    DB_NAME = "scan.db"
+    # listings of directories modified within this number of seconds before
+    # the scan are not trusted (the mtime might not change on a further
+    # modification within the same timestamp granularity)
+    RACY_SECONDS = 2
+    COMMIT_INTERVAL = 1000
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+        mkdir_p(cache_dir)
+
+        self._lock = threading.Lock()
+        self._changes = 0
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.DB_NAME),
+                                   timeout=30, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                                path TEXT PRIMARY KEY,
+                                mtime INTEGER NOT NULL,
+                                inode INTEGER NOT NULL,
+                                dirs TEXT NOT NULL,
+                                files TEXT NOT NULL)""")
+        self._db.commit()
+
+    @classmethod
+    def from_config(cls, tagger_config):
+        """ creates the scan index as configured in the [cache] section,
+            returns None if the index is disabled
+        """
+        if not tagger_config.getboolean("cache", "scan_index"):
+            return None
+
+        return cls(os.path.expanduser(tagger_config.get("cache", "cache_dir")))
+
+    @classmethod
+    def shared(cls, tagger_config):
+        """ returns the process-wide scan index (or None, if disabled) """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.from_config(tagger_config) or False
+            return cls._shared or None
+
+    def listdir(self, path):
+        """ returns the DirListing (names of the subdirectories and of the
+            files) of the given directory, raises OSError if the directory
+            cannot be read
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        with self._lock:
+            row = self._db.execute("SELECT mtime, inode, dirs, files FROM dirs WHERE path = ?",
+                                   (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_ino:
+            self.hits += 1
+            return DirListing(json.loads(row[2]), json.loads(row[3]))
+
+        self.misses += 1
+        listing = scandir(path)
+
+        mtime = stat.st_mtime_ns
+        if time.time() - stat.st_mtime < self.RACY_SECONDS:
+            mtime = -1
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO dirs (path, mtime, inode, dirs, files) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (path, mtime, stat.st_ino, json.dumps(listing.dirs), json.dumps(listing.files)))
+            self._changes += 1
+            if self._changes >= self.COMMIT_INTERVAL:
+                self._db.commit()
+                self._changes = 0
+
+        return listing
+
+    def flush(self):
+        with self._lock:
+            self._db.commit()
+            self._changes = 0
+        logger.debug("scan index: %d directories unchanged, %d listed" % (self.hits, self.misses))
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+class ParallelScanner(object):
+    """ walks a directory tree using a pool of threads, the subtrees are
+        listed concurrently, which hides the latency of network filesystems.
+        The directories are listed with `listdir` (scandir or the listdir of
+        the ScanIndex).
+    """
+
+    def __init__(self, listdir=None, workers=8):
+        self.listdir = listdir or scandir
+        self.workers = max(1, workers)
+
+    def walk(self, top, visit):
+        """ calls `visit(root, dirs, files)` for every directory below top
+            (in the worker threads), visit returns a tuple (result, dirs), the
+            walk descends into the returned dirs only. The results, which are
+            not None, are yielded as soon as they are available (in no
+            particular order).
+        """
+        results = queue.Queue()
+        # number of directories listed or waiting to get listed
+        pending = [1]
+        lock = threading.Lock()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            def scan(root):
+                try:
+                    listing = self.listdir(root)
+                    result, dirs = visit(root, list(listing.dirs), list(listing.files))
+                    if result is not None:
+                        results.put(result)
+                    with lock:
+                        pending[0] += len(dirs)
+                    for name in dirs:
+                        executor.submit(scan, os.path.join(root, name))
+                except Exception as e:
+                    logger.warn("Unable to scan directory %s: %s" % (root, e))
+                finally:
+                    with lock:
+                        pending[0] -= 1
+                        finished = pending[0] == 0
+                    if finished:
+                        results.put(_DONE)
+
+            executor.submit(scan, top)
+
+            while True:
+                result = results.get()
+                if result is _DONE:
+                    break
+                yield result
+
+# marks the end of a walk
+_DONE = object()
+
+def scandir(path):
+    """ lists the given directory, symbolic links to directories are treated
+        as files (like os.walk, which does not follow them)
+    """
+    dirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    return DirListing(sorted(dirs), sorted(files))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import re, os
+import ast
+import threading
 
 class StringFormatting(object):
     """ The goal here is to have one formatting string that can cope with any
@@ -12,8 +14,8 @@ class StringFormatting(object):
         http://wiki.hydrogenaud.io/index.php?title=Foobar2000:Title_Formatting_Reference
 
         Limitations:
-            don't leave empty conditions (or potentiall empty), blank
-            placeholders.
+            quote the arguments of the functions, whitespace outside of the
+            quotes is ignored.
 
             $if1($strcmp('%artist%','%albumartist%'),'','%artist% - ') -- good
             $if1($strcmp(%artist%,%albumartist%),,%artist% - ) -- bad
@@ -22,12 +24,16 @@ class StringFormatting(object):
         stringFormatting = StringFormatting()
         stringFormatting.test()
 
-        string = "%albumartist%/[%year%] %album%/$num(%track%,2) $if1($strcmp('%artist%','%albumartist%'),'','%artist% - ')%title%%fileext%"
-        new_string = stringFormatting.parseString(string)
+        string = "%albumartist%/[%year%] %album%/$num('%track%',2) $if1($strcmp('%artist%','%albumartist%'),'','%artist% - ')%title%%fileext%"
+        new_string = stringFormatting.parseString(string, {'%artist%': 'Advance', ...})
 
         See tests for more examples
     """
 
+    # format string -> Template, shared by all instances
+    _templates = {}
+    _templates_lock = threading.Lock()
+
     def __init__(self):
         self.functions = {
             '$if1': 3,  # cannot use $if
@@ -66,7 +72,7 @@ class StringFormatting(object):
         '''
         itm = '' if i == 'None' else str(i)
         l = re.sub(r'\\', '', l)
-        lst = eval(l)
+        lst = ast.literal_eval(l)
         result = itm in lst
 
         return result
@@ -112,63 +118,29 @@ class StringFormatting(object):
         '''
         return str(string).upper()
 
-    def parseString(self, string):
-        """ Walk through the input string, collecting functions along the way.
-
-            string = 'some text $functionname(arg1,arg2, ...)'
-
-            There is probably a clever way to do this with regex, but doing
-            it this way to properly manage nested functions
+    @classmethod
+    def compile(cls, string):
+        """ returns the compiled template of the given format string, each
+            format string is parsed once only (see Template)
         """
-        output = ''
+        template = cls._templates.get(string)
+        if template is None:
+            template = Template(string)
+            with cls._templates_lock:
+                template = cls._templates.setdefault(string, template)
+        return template
+
+    def parseString(self, string, values=None):
+        """ Evaluates the format string using the given values of the
+            placeholders ('%artist%' -> 'Advance'), placeholders without a
+            value are kept as they are.
 
-        # print('parseString, input: {}'.format(string))
-
-        command = ''
-        """hierarchy used to track & collect nested functions
-        """
-        hierarchy = 0
-        lastchar = ''
-        for c in string:
-            # print(command)
-            if c == '$':
-                hierarchy = hierarchy + 1
-                command += c
-            elif re.search(r'\(', c) and lastchar != '\\':
-                command += c
-            elif re.search(r'\)', c) and lastchar != '\\':
-                hierarchy = hierarchy -1
-                command += c
-                if hierarchy == 0:
-                    result = self.execute(command)
-                    output += result
-                    command = ''
-            elif hierarchy > 0:
-                command += c
-            else:
-                output += c
-            lastchar = c
-
-        # print('parseString, output: {}'.format(output))
-
-        return output
+            string = 'some text $functionname(arg1,arg2, ...)'
 
-    def execute(self, string):
-        """ Unpick the command, validate the function name and arguments
-            Returns a string
+            The format string is compiled once (see Template), no code is
+            evaluated.
         """
-        output = ''
-
-#TODO:  regex to capture empty & unquoted parameters
-
-        functNameMatch = re.findall(r'(\$[a-z0-9_]+)\(', string)
-        for match in functNameMatch:
-            if match not in self.functions:
-                 return 'unknown command'
-        string = re.sub(r'\$', 'self.', string)
-        result = eval(string)
-
-        return result
+        return self.compile(string).evaluate(self, values or {})
 
     def test(self):
         track = {
@@ -221,19 +193,200 @@ class StringFormatting(object):
         print(output)
 
         """Test 2: track from a single artist album"""
-        result = stringFormatting.parseString(track['formatted_string'], track)
+        result = self.parseString(track['formatted_string'], track)
         output = 'Output should read "{}": {}'.format(track['test'], failMessage if result != track['test'] else passMessage)
         print(output)
 
         """Test 3: track from a various artist album"""
-        result = stringFormatting.parseString(various['formatted_string'], various)
+        result = self.parseString(various['formatted_string'], various)
         output = 'Output should read "{}": {}'.format(various['test'], failMessage if result != various['test'] else passMessage)
         print(output)
 
         """Test 4: track from a multidisc album"""
-        result = stringFormatting.parseString(multidisctrack['formatted_string'], multidisctrack)
+        result = self.parseString(multidisctrack['formatted_string'], multidisctrack)
         output = 'Output should read "{}": {}'.format(multidisctrack['test'], failMessage if result != multidisctrack['test'] else passMessage)
         print(output)
 
-# stringFormatting = StringFormatting()
-# stringFormatting.test()
+# a function call: $name( ... )
+CALL = re.compile(r'\$([a-z0-9_]+)\(')
+# a placeholder: %name%
+PLACEHOLDER = re.compile(r'%[^%\'"$(),\\]+%')
+INTEGER = re.compile(r'-?[0-9]+$')
+
+class Template(object):
+    """ A format string compiled into a tree of closures, which is evaluated
+        against the values of the placeholders (no eval).
+
+        text        literal text, placeholders and function calls, a
+                    backslash escapes the next character
+        %name%      the value of the placeholder (or the text itself, if
+                    there is no value)
+        $name(a, b) calls the function with the given arguments, an
+                    argument is a quoted string ('...' or "..."), which may
+                    contain placeholders, a function call or an integer
+    """
+
+    def __init__(self, string):
+        self.string = string
+        # the names of the placeholders used ('%artist%', ...)
+        self.placeholders = set()
+        parts, pos = self._parse(0, False)
+        self._evaluate = _concat(parts)
+
+    def evaluate(self, formatting, values):
+        """ the resulting string, the functions are called on the given
+            StringFormatting instance
+        """
+        return str(self._evaluate(formatting, values))
+
+    def _parse(self, pos, in_args):
+        """ parses the text (or a function argument, which ends with , or
+            ) at the same level) starting at pos, returns the parts (literal
+            text or nodes) and the position after the text
+        """
+        string = self.string
+        parts = []
+        text = []
+        while pos < len(string):
+            c = string[pos]
+            if c == '\\' and pos + 1 < len(string):
+                text.append(string[pos + 1])
+                pos += 2
+                continue
+            if in_args and c in ',)':
+                break
+
+            node = None
+            if c == '$':
+                match = CALL.match(string, pos)
+                if match is not None:
+                    node, pos = self._parse_call(match)
+            elif c == '%':
+                node, pos = self._parse_placeholder(pos)
+            elif in_args and c in '\'"':
+                node, pos = self._parse_quoted(pos)
+            elif in_args and c.isspace():
+                # whitespace between the arguments
+                pos += 1
+                continue
+
+            if node is None:
+                text.append(c)
+                pos += 1
+            else:
+                if text:
+                    parts.append(''.join(text))
+                    text = []
+                parts.append(node)
+
+        if text:
+            parts.append(''.join(text))
+        return parts, pos
+
+    def _parse_placeholder(self, pos, quoted=False):
+        match = PLACEHOLDER.match(self.string, pos)
+        if match is None:
+            return None, pos
+        self.placeholders.add(match.group(0))
+        return _placeholder(match.group(0), quoted), match.end()
+
+    def _parse_quoted(self, pos):
+        string = self.string
+        quote = string[pos]
+        pos += 1
+        parts = []
+        text = []
+        while pos < len(string) and string[pos] != quote:
+            c = string[pos]
+            node = None
+            if c == '\\' and pos + 1 < len(string):
+                text.append(string[pos + 1])
+                pos += 2
+                continue
+            if c == '%':
+                node, pos = self._parse_placeholder(pos, True)
+            if node is None:
+                text.append(c)
+                pos += 1
+            else:
+                if text:
+                    parts.append(''.join(text))
+                    text = []
+                parts.append(node)
+
+        if pos >= len(string):
+            raise ValueError("unterminated string in format '%s'" % string)
+        if text:
+            parts.append(''.join(text))
+        return _concat(parts), pos + 1
+
+    def _parse_call(self, match):
+        name = '$' + match.group(1)
+        pos = match.end()
+        args = []
+        while True:
+            parts, pos = self._parse(pos, True)
+            if pos >= len(self.string):
+                raise ValueError("missing ) after %s in format '%s'" % (name, self.string))
+            args.append(_argument(parts))
+            pos += 1
+            if self.string[pos - 1] == ')':
+                break
+        if len(args) == 1 and args[0] is EMPTY:
+            # $name()
+            args = []
+        return _call(name, args), pos
+
+def _constant(value):
+    return lambda formatting, values: value
+
+EMPTY = _constant('')
+
+def _placeholder(name, quoted=False):
+    def placeholder(formatting, values):
+        try:
+            return str(values[name])
+        except KeyError:
+            return name
+    if not quoted:
+        placeholder.name = name
+    return placeholder
+
+def _value(name):
+    """ an unquoted placeholder passed as argument keeps its type (e.g.
+        None or an int)
+    """
+    def value(formatting, values):
+        try:
+            return values[name]
+        except KeyError:
+            return name
+    return value
+
+def _concat(parts):
+    if all(isinstance(part, str) for part in parts):
+        return _constant(''.join(parts)) if parts else EMPTY
+    nodes = [_constant(part) if isinstance(part, str) else part for part in parts]
+    if len(nodes) == 1:
+        return nodes[0]
+    return lambda formatting, values: ''.join([str(node(formatting, values)) for node in nodes])
+
+def _argument(parts):
+    """ a single node keeps its type (e.g. the bool of $strcmp), bare
+        integers are passed as int, unquoted placeholders as their value
+    """
+    if len(parts) == 1 and isinstance(parts[0], str) and INTEGER.match(parts[0]):
+        return _constant(int(parts[0]))
+    if len(parts) == 1 and getattr(parts[0], 'name', None) is not None:
+        return _value(parts[0].name)
+    if len(parts) == 1 and not isinstance(parts[0], str):
+        return parts[0]
+    return _concat(parts)
+
+def _call(name, args):
+    method = name[1:]
+    def call(formatting, values):
+        if name not in formatting.functions:
+            return 'unknown command'
+        return getattr(formatting, method)(*[arg(formatting, values) for arg in args])
+    return call
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import io
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import logging
+
+from ext.mediafile import MediaFile
+
+logger = logging
+
+# file types, whose tags are stored in a header in front of the audio frames
+STREAMABLE = ('flac', 'mp3')
+# number of audio bytes read together with the header, mutagen needs the
+# first frames to read the stream information
+PROBE_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# the copies get the permissions of a newly created file (mkstemp uses 0600)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def id3v2_size(header):
+    """ the size of the ID3v2 tag at the start of the given bytes (0, if
+        there is none)
+    """
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    flags = header[5]
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    size += 10
+    if flags & 0x10:
+        # footer present
+        size += 10
+    return size
+
+def flac_header_size(fh):
+    """ the offset of the first audio frame of a flac file, the metadata
+        blocks (and an ID3v2 tag in front of them) are skipped
+    """
+    fh.seek(0)
+    offset = id3v2_size(fh.read(10))
+    fh.seek(offset)
+    if fh.read(4) != b'fLaC':
+        return None
+    offset += 4
+
+    while True:
+        block = fh.read(4)
+        if len(block) < 4:
+            return None
+        length = struct.unpack('>I', b'\x00' + block[1:])[0]
+        offset += 4 + length
+        fh.seek(offset)
+        if block[0] & 0x80:
+            return offset
+
+def audio_range(fh, filetype):
+    """ returns the offsets (start, end) of the audio frames in the given
+        file, None if the file cannot be streamed
+    """
+    fh.seek(0, os.SEEK_END)
+    end = fh.tell()
+
+    if filetype == 'flac':
+        start = flac_header_size(fh)
+    elif filetype == 'mp3':
+        fh.seek(0)
+        start = id3v2_size(fh.read(10))
+        # an ID3v1 tag at the end is removed just like by MediaFile.delete
+        if end - start >= 128:
+            fh.seek(end - 128)
+            if fh.read(3) == b'TAG':
+                end -= 128
+    else:
+        start = None
+
+    if start is None or start > end:
+        return None
+    return start, end
+
+def tagged_copy(source_file, target_file, plan, copy=shutil.copyfile, padding=None):
+    """ copies the source file to the target file and writes the tags of
+        the given TagPlan into the copy at the same time. The source file
+        is read once (sequentially) and never modified, the target file is
+        written once: the new header is built in memory and the audio frames
+        are streamed behind it. Returns the number of bytes written.
+
+        Files, whose tags are not stored in front of the audio (e.g. mp4),
+        are copied (using the given copy function) and tagged afterwards.
+        `padding` is the padding callback passed to MediaFile.save.
+    """
+    if plan.type in STREAMABLE:
+        with open(source_file, "rb") as source:
+            audio = audio_range(source, plan.type)
+            if audio is not None:
+                return _stream(source, target_file, plan, padding, *audio)
+        logger.debug("unable to stream %s, copying it" % source_file)
+
+    return _copy_and_tag(source_file, target_file, plan, copy, padding)
+
+def read_head(fh, start, end):
+    """ reads the header and the first audio frames (see PROBE_SIZE) into
+        a BytesIO, which can be opened as a MediaFile
+    """
+    fh.seek(0)
+    return io.BytesIO(fh.read(min(start + PROBE_SIZE, end)))
+
+def tags_changed(path, plan):
+    """ True, if writing the TagPlan would change the tags of the given
+        file. The plan is applied to an in-memory copy of the header and
+        the resulting tags are compared with the current ones (pictures by
+        their hash). Files, which cannot be checked this way, are always
+        reported as changed.
+    """
+    if plan.type not in STREAMABLE:
+        return True
+
+    with open(path, "rb") as fh:
+        audio = audio_range(fh, plan.type)
+        if audio is None or audio[1] != fh.seek(0, os.SEEK_END):
+            # e.g. an ID3v1 tag, which would be removed
+            return True
+        head = read_head(fh, *audio)
+
+    current = tag_state(MediaFile(io.BytesIO(head.getvalue())))
+
+    metadata = MediaFile(head)
+    plan.apply(metadata)
+    metadata.save()
+    return tag_state(MediaFile(head)) != current
+
+def tag_state(metadata):
+    """ the raw tags (and pictures) of the given MediaFile in a comparable
+        form, independent of their order within the file
+    """
+    state = []
+    if metadata.mgfile.tags is not None:
+        state.extend((str(key), _digest(value)) for key, value in metadata.mgfile.tags.items())
+    for picture in getattr(metadata.mgfile, 'pictures', []):
+        state.append(('picture', _digest(picture)))
+    return sorted(state)
+
+def _digest(value):
+    if isinstance(value, bytes):
+        return hashlib.sha1(value).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return tuple(_digest(v) for v in value)
+    data = getattr(value, 'data', None)
+    if isinstance(data, bytes):
+        # pictures (flac and ID3 APIC)
+        return (type(value).__name__, hashlib.sha1(data).hexdigest(),
+                repr(getattr(value, 'type', None)), getattr(value, 'desc', None),
+                getattr(value, 'mime', None))
+    return repr(value)
+
+def _stream(source, target_file, plan, padding, start, end):
+    # the header and the first audio frames are tagged in memory
+    head = read_head(source, start, end)
+    head_end = len(head.getvalue())
+    metadata = MediaFile(head)
+    plan.apply(metadata)
+    metadata.save(padding=padding)
+    header = head.getvalue()
+
+    # the target file appears, once it is complete
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(target_file),
+                                     prefix="." + os.path.basename(target_file), suffix=".part")
+    try:
+        os.chmod(temp_file, 0o666 & ~_UMASK)
+        with os.fdopen(fd, "wb") as target:
+            target.write(header)
+            written = len(header)
+
+            remaining = end - head_end
+            while remaining > 0:
+                chunk = source.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                target.write(chunk)
+                written += len(chunk)
+                remaining -= len(chunk)
+        os.replace(temp_file, target_file)
+    except:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    return written
+
+def _copy_and_tag(source_file, target_file, plan, copy, padding):
+    copy(source_file, target_file)
+    metadata = MediaFile(target_file)
+    plan.apply(metadata)
+    metadata.save(padding=padding)
+    return os.path.getsize(target_file)
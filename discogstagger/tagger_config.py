@@ -3,13 +3,14 @@ import errno
 import logging
 
 import inspect
+from collections import namedtuple
 
 try:
     import configparser
 except:
     from six.moves import configparser
 
-from configparser import RawConfigParser
+from configparser import RawConfigParser, SectionProxy
 
 logger = logging
 #.getLogger(__name__)
@@ -27,14 +28,93 @@ class memoized_property(object):
         obj.__dict__[self.__name__] = result = self.fget(obj)
         return result
 
+# the values read for every track, parsed once per configuration (see
+# TaggerConfig.settings)
+Settings = namedtuple("Settings", ["id_tag_name", "tags", "keep_tags", "variousartists",
+                                   "skip_unchanged", "tag_padding"])
+
 class TaggerConfig(RawConfigParser):
-    """ provides the configuration mechanisms for the discogstagger """
+    """ provides the configuration mechanisms for the discogstagger
+
+        The configuration files are parsed once, the album specific options
+        (id.txt) are read into an overlay of this configuration (see overlay).
+    """
+
+    # the memoized properties, which depend on the configured values
+    MEMOIZED = ("settings", "get_character_exceptions", "get_configured_tags")
 
     def __init__(self, config_file):
         RawConfigParser.__init__(self, strict=False)
+        # the sections shared with the configuration this one overlays,
+        # these are copied before they are changed
+        self._shared_sections = set()
         self.read(os.path.join("conf", "default.conf"))
         self.read(config_file)
 
+    def overlay(self):
+        """ returns a copy of this configuration, which shares the parsed
+            sections with this one until they are changed (read or set) in
+            the copy, so that the options of an album do not change the
+            configuration of the other albums
+        """
+        overlay = self.__class__.__new__(self.__class__)
+        RawConfigParser.__init__(overlay, strict=False)
+        overlay._defaults = self._dict(self._defaults)
+        overlay._sections = self._dict(self._sections)
+        overlay._shared_sections = set(self._sections)
+        for section in self._sections:
+            overlay._proxies[section] = SectionProxy(overlay, section)
+        # RawConfigParser.__init__ evaluated the memoized properties (see
+        # ConverterMapping) before the sections were assigned
+        overlay._invalidate()
+        # the settings do not change until the overlay is changed
+        if "settings" in self.__dict__:
+            overlay.__dict__["settings"] = self.__dict__["settings"]
+        return overlay
+
+    def _own(self, section):
+        if section in self._shared_sections:
+            self._sections[section] = self._dict(self._sections[section])
+            self._shared_sections.discard(section)
+
+    def _invalidate(self):
+        for name in self.MEMOIZED:
+            self.__dict__.pop(name, None)
+
+    def read(self, filenames, encoding=None):
+        self._invalidate()
+        if not self._shared_sections:
+            return RawConfigParser.read(self, filenames, encoding=encoding)
+
+        # parse the files separately and copy the changed sections only
+        parser = RawConfigParser(strict=False)
+        read_ok = parser.read(filenames, encoding=encoding)
+        self._defaults.update(parser._defaults)
+        for section in parser.sections():
+            if not self.has_section(section):
+                self.add_section(section)
+            self._own(section)
+            self._sections[section].update(parser._sections[section])
+        return read_ok
+
+    def set(self, section, option, value=None):
+        self._invalidate()
+        self._own(section)
+        RawConfigParser.set(self, section, option, value)
+
+    @memoized_property
+    def settings(self):
+        """ the (immutable) values read for every track """
+        return Settings(
+            id_tag_name=self.id_tag_name,
+            # the tags overwritten by the configuration (without empty ones)
+            tags=tuple((name, self.get("tags", name)) for name in self.get_configured_tags
+                       if self.get("tags", name) is not None),
+            keep_tags=self.get("details", "keep_tags"),
+            variousartists=self.get("details", "variousartists"),
+            skip_unchanged=self.getboolean("details", "skip_unchanged"),
+            tag_padding=self.getint("details", "tag_padding"))
+
     @property
     def id_tag_name(self):
         source_name = self.get("source", "name")
@@ -65,7 +145,7 @@ class TaggerConfig(RawConfigParser):
         """ placeholders for special characters within character exceptions. """
 
 
-        exceptions = self._sections["character_exceptions"] if "character_exceptions" in self._sections else {}
+        exceptions = dict(self._sections.get("character_exceptions", {}))
 
         KEYS = {
             "{space}": " ",
@@ -90,7 +170,7 @@ class TaggerConfig(RawConfigParser):
             return all configured tags to be able to overwrite certain
             tags via a configuration file (e.g. id.txt)
         """
-        tags = self._sections["tags"] if 'tags' in self._sections else {}
+        tags = dict(self._sections.get("tags", {}))
 
         try:
             del tags["__name__"]
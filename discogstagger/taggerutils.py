@@ -6,6 +6,8 @@ import re
 import sys
 import logging
 import shutil
+import threading
+import time
 from shutil import copy2, copystat, Error, ignore_patterns
 import imghdr
 from datetime import datetime, timedelta
@@ -14,7 +16,6 @@ from datetime import datetime, timedelta
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
-from unicodedata import normalize
 
 from mako.template import Template
 from mako.lookup import TemplateLookup
@@ -22,8 +23,12 @@ from mako.lookup import TemplateLookup
 from discogstagger.discogsalbum import DiscogsAlbum
 from discogstagger.album import Album, Disc, Track
 from discogstagger.stringformatting import StringFormatting
+from discogstagger.tagcopy import tagged_copy, tags_changed
+from discogstagger.copystrategy import FileCopier
+from discogstagger.mediasession import MediaSession
+from discogstagger.sanitizer import FilenameSanitizer
 
-from ext.mediafile import MediaFile
+from ext.mediafile import MediaFile, PaddingPolicy
 
 logger = logging
 
@@ -45,23 +50,80 @@ class TaggerError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class TagPlan(object):
+    """ the complete set of tags of a single track, which is build in memory
+        (using the attribute names of the MediaFile) before the target file
+        is written
+    """
+
+    def __init__(self, disc, track, filetype):
+        # disc and track are tags as well
+        self.__dict__['album_disc'] = disc
+        self.__dict__['album_track'] = track
+        self.__dict__['type'] = filetype
+        self.__dict__['values'] = {}
+
+    def __setattr__(self, name, value):
+        self.values[name] = value
+
+    def __getattr__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def apply(self, metadata):
+        """ replaces all tags of the given MediaFile with the planned ones,
+            the file is written by MediaFile.save
+        """
+        metadata.apply(self.values)
+
 class TagHandler(object):
     """ Uses the album (taggerutils) and tags all given files using the given
         tags (album)
+
+        The tags are planned first (tag_album), this does not touch any file.
+        All tags (including the cover art) are written at once into the target
+        files (write_album), therefore every file is saved once only.
+
+        If replaygain is set (-g), the existing replaygain values of the
+        source (and target) files are kept, so that the replaygain tools do
+        not have to run again. Otherwise the replaygain tags are removed like
+        all other tags.
     """
 
-    def __init__(self, album, tagger_config):
+    REPLAYGAIN_FIELDS = ('rg_track_gain', 'rg_track_peak', 'rg_album_gain', 'rg_album_peak')
+
+    def __init__(self, album, tagger_config, session=None, replaygain=False):
         self.album = album
         self.config = tagger_config
+        self.replaygain = replaygain
+        # the source and target files are opened through the album session
+        self.session = session if session is not None else MediaSession.from_config(tagger_config)
 
-        self.keep_tags = self.config.get("details", "keep_tags")
+        # the values used for every track, parsed once
+        self.settings = self.config.settings
+        self.keep_tags = self.settings.keep_tags
         self.user_agent = self.config.get("common", "user_agent")
-        self.variousartists = self.config.get("details", "variousartists")
+        self.variousartists = self.settings.variousartists
+        self.skip_unchanged = self.settings.skip_unchanged
+        # the padding reserved behind the tags, later changes of the tags
+        # (e.g. a larger cover) are written in place
+        self.padding = PaddingPolicy(self.settings.tag_padding * 1024)
+
+        self.plans = []
+        # statistics of write_album
+        self.files_copied = 0
+        self.files_written = 0
+        self.files_rewritten = 0
+        self.files_unchanged = 0
+        self.bytes_written = 0
 
     def tag_album(self):
-        """ tags all tracks in an album, the filenames are determined using
-            the given properties on the tracks
+        """ plans the tags of all tracks in an album, the source files are
+            read only, use write_album to write the tags
         """
+        self.plans = []
         for disc in self.album.discs:
             # if disc.target_dir != None:
             #     target_folder = os.path.join(self.album.target_dir, disc.target_dir)
@@ -70,27 +132,35 @@ class TagHandler(object):
             #
             for track in disc.tracks:
                 path, file = os.path.split(track.full_path)
-                self.tag_single_track(path, track)
+                self.plans.append(self.tag_single_track(path, track, disc))
 
-    def tag_single_track(self, target_folder, track):
+    def tag_single_track(self, target_folder, track, disc=None):
+        """ returns the TagPlan of a single track, the existing tags (e.g.
+            keep_tags) are read from the given folder
+        """
         # load metadata information
         logger.debug("target_folder: %s" % target_folder)
 
-        metadata = MediaFile(os.path.join(target_folder, track.orig_file))
+        source_file = os.path.join(target_folder, track.orig_file)
+        metadata = TagPlan(disc, track, self.session.metadata(source_file).type)
+
+        keep_names = self.keep_tags.split(",") if self.keep_tags is not None else []
+        rg_names = list(self.REPLAYGAIN_FIELDS) if self.replaygain else []
+        existing = self.session.tags(source_file, keep_names + rg_names)
 
         # read already existing (and still wanted) properties
         keepTags = {}
-        if self.keep_tags is not None:
-            for name in self.keep_tags.split(","):
-                logger.debug("name %s" % name)
-                if getattr(metadata, name):
-                    keepTags[name] = getattr(metadata, name)
+        for name in keep_names:
+            logger.debug("name %s" % name)
+            if existing[name]:
+                keepTags[name] = existing[name]
 
-        # remove current metadata
-        metadata.delete()
+        # existing replaygain values are valid for the copied audio as well
+        for name in rg_names:
+            if existing[name] is not None:
+                setattr(metadata, name, existing[name])
 
         self.album.codec = metadata.type
-
         # set album metadata
         metadata.album = self.album.title
         metadata.composer = self.album.artist
@@ -122,7 +192,7 @@ class TagHandler(object):
 
         # this assumes, that there is a metadata-tag with the id_tag_name in the
         # metadata object
-        setattr(metadata, self.config.id_tag_name, self.album.id)
+        setattr(metadata, self.settings.id_tag_name, self.album.id)
         metadata.discogs_release_url = self.album.url
 
         metadata.disctitle = track.discsubtitle
@@ -138,12 +208,9 @@ class TagHandler(object):
         else:
             metadata.comments = self.album.notes
 
-        tags = self.config.get_configured_tags
-        logger.debug("tags: %s" % tags)
-        for name in tags:
-            value = self.config.get("tags", name)
-            if not value == None:
-                setattr(metadata, name, value)
+        # the tags overwritten by the configuration (e.g. id.txt)
+        for name, value in self.settings.tags:
+            setattr(metadata, name, value)
 
         # set track metadata
         metadata.title = track.title
@@ -163,7 +230,74 @@ class TagHandler(object):
             for name in keepTags:
                 setattr(metadata, name, keepTags[name])
 
-        metadata.save()
+        return metadata
+
+    def add_art(self, imgdata):
+        """ adds the cover art to the tags of all tracks """
+        for plan in self.plans:
+            plan.art = imgdata
+
+    def has_replaygain(self):
+        """ True, if all tracks have replaygain values already """
+        return len(self.plans) > 0 and all('rg_track_gain' in plan.values and
+                                           'rg_album_gain' in plan.values for plan in self.plans)
+
+    def write_album(self, file_handler):
+        """ writes the planned tags into the target files (see
+            FileHandler.track_file), each file is opened and saved once.
+            Files, whose copy was deferred (see FileHandler.copy_files), are
+            copied including the tags in a single pass (see tagged_copy).
+            Existing target files (e.g. --force) are only saved, if their tags
+            differ from the planned ones (skip_unchanged), the replaygain
+            values of the targets are kept.
+            Returns the number of bytes written, if a file has to be rewritten
+            (e.g. the tags do not fit into the padding) the whole file counts.
+        """
+        for plan in self.plans:
+            track_file = file_handler.track_file(plan.album_disc, plan.album_track)
+
+            source_file = file_handler.pending_copies.pop(track_file, None)
+            if source_file is not None:
+                logger.debug("copying and tagging %s" % source_file)
+                file_handler.bytes_copied += tagged_copy(source_file, track_file, plan,
+                                                         file_handler.audio_copier.copy,
+                                                         self.padding.initial)
+                self.files_copied += 1
+                continue
+
+            metadata = self.session.target(track_file)
+            # the target has been copied from the same audio
+            for name in self.REPLAYGAIN_FIELDS if self.replaygain else ():
+                value = getattr(metadata, name)
+                if value is not None and name not in plan.values:
+                    setattr(plan, name, value)
+
+            if self.skip_unchanged and not tags_changed(track_file, plan):
+                logger.debug("tags of %s unchanged" % track_file)
+                self.files_unchanged += 1
+                continue
+
+            size = os.path.getsize(track_file)
+            saves = self.padding.in_place + self.padding.rewrites
+            rewrites = self.padding.rewrites
+            plan.apply(metadata)
+            metadata.save(padding=self.padding)
+
+            self.files_written += 1
+            if self.padding.in_place + self.padding.rewrites > saves:
+                rewritten = self.padding.rewrites > rewrites
+            else:
+                # no padding (e.g. APEv2 tags)
+                rewritten = os.path.getsize(track_file) != size
+            if rewritten:
+                self.files_rewritten += 1
+                self.bytes_written += os.path.getsize(track_file)
+
+        logger.info("Tagged {0} files ({1} copied, {2} unchanged, {3} in place, {4} rewritten, "
+                    "{5} bytes written)".format(
+                    self.files_copied + self.files_written, self.files_copied, self.files_unchanged,
+                    self.files_written - self.files_rewritten, self.files_rewritten, self.bytes_written))
+        return self.bytes_written
 
 class FileHandler(object):
     """ this class contains all file handling tasks for the tagger,
@@ -175,12 +309,20 @@ class FileHandler(object):
     """
 
 
-    def __init__(self, album, tagger_config):
+    def __init__(self, album, tagger_config, session=None):
         self.config = tagger_config
         self.album = album
+        self.session = session if session is not None else MediaSession.from_config(tagger_config)
         self.cue_done_dir = self.config.get('cue', 'cue_done_dir')
         self.rg_process = self.config.getboolean('replaygain', 'add_tags')
         self.rg_application = self.config.get('replaygain', 'application')
+        # number of bytes written by copy_files (or the tagged copies)
+        self.bytes_copied = 0
+        # target file -> source file of the copies deferred by copy_files
+        self.pending_copies = {}
+        # the audio files are tagged after the copy, they must not be linked
+        self.audio_copier = FileCopier.from_config(self.config, "audio_strategy")
+        self.other_copier = FileCopier.from_config(self.config, "other_files_strategy", allow_link=True)
 
     def mkdir_p(self, path):
         try:
@@ -200,10 +342,15 @@ class FileHandler(object):
         if not os.path.exists(self.album.target_dir):
             self.mkdir_p(self.album.target_dir)
 
-    def copy_files(self):
+    def copy_files(self, defer=False):
         """
             copy an album and all its files to the new location, rename those
             files if necessary
+
+            if defer is set, the audio files are not copied yet, but recorded
+            in pending_copies, TagHandler.write_album copies them including
+            the tags, this way the source files are read once and the target
+            files are written once
         """
         logger.debug("album sourcedir: %s" % self.album.sourcedir)
         logger.debug("album targetdir: %s" % self.album.target_dir)
@@ -241,10 +388,31 @@ class FileHandler(object):
                     if not os.path.exists(source_file):
                         logger.error("Source does not exists")
                         # throw error
+                    if defer:
+                        self.pending_copies[target_file] = source_file
+                        continue
                     logger.debug("copying files (%s/%s)", source_folder, track.orig_file)
 
-                    shutil.copyfile(os.path.join(source_folder, track.orig_file),
-                        os.path.join(target_folder, track.new_file))
+                    self.audio_copier.copy(source_file, target_file)
+                    self.bytes_copied += os.path.getsize(target_file)
+
+        self.audio_copier.log_summary("audio files copied")
+
+    def track_file(self, disc, track):
+        """
+            returns the path of the file of the given track, this is the copied
+            file in the target directory, if the file was not copied (the
+            source and target directories are the same), the source file
+        """
+        if disc.target_dir != None:
+            track_dir = os.path.join(self.album.target_dir, disc.target_dir)
+        else:
+            track_dir = self.album.target_dir
+
+        track_file = os.path.join(track_dir, track.new_file)
+        if not os.path.exists(track_file) and track_file not in self.pending_copies:
+            track_file = track.full_path
+        return track_file
 
     def remove_source_dir(self):
         """
@@ -279,9 +447,10 @@ class FileHandler(object):
 
                 for fname in copy_files:
                     if os.path.isdir(os.path.join(self.album.sourcedir, fname)):
-                        copytree_multi(os.path.join(self.album.sourcedir, fname), os.path.join(self.album.target_dir, fname))
+                        copytree_multi(os.path.join(self.album.sourcedir, fname), os.path.join(self.album.target_dir, fname),
+                                       copy_function=self.other_copier.copy2)
                     else:
-                        shutil.copyfile(os.path.join(self.album.sourcedir, fname), os.path.join(self.album.target_dir, fname))
+                        self.other_copier.copy(os.path.join(self.album.sourcedir, fname), os.path.join(self.album.target_dir, fname))
 
             for disc in self.album.discs:
                 copy_files = disc.copy_files
@@ -305,9 +474,12 @@ class FileHandler(object):
                             self.mkdir_p(target_path)
 
                         if os.path.isdir(os.path.join(source_path, fname)):
-                            copytree_multi(os.path.join(source_path, fname), os.path.join(target_path, fname))
+                            copytree_multi(os.path.join(source_path, fname), os.path.join(target_path, fname),
+                                           copy_function=self.other_copier.copy2)
                         else:
-                            shutil.copyfile(os.path.join(source_path, fname), os.path.join(target_path, fname))
+                            self.other_copier.copy(os.path.join(source_path, fname), os.path.join(target_path, fname))
+
+            self.other_copier.log_summary("other files copied")
 
     def get_images(self, conn_mgr):
         """
@@ -318,7 +490,12 @@ class FileHandler(object):
 
             we need http access here as well (see discogsalbum), and therefore the
             user-agent
+
+            The downloads are running in the background, use wait_for_images
+            to wait until all images are stored.
         """
+        self.image_batch = None
+
         if self.album.images:
             images = self.album.images
 
@@ -333,29 +510,52 @@ class FileHandler(object):
 
             self.create_album_dir()
 
+            downloads = []
             no = 0
             for i, image_url in enumerate(images, 0):
-                logger.debug("Downloading image '%s'" % image_url)
-                try:
-                    picture_name = ""
-                    if i == 0 and use_folder_jpg:
-                        picture_name = "folder.jpg"
-                    else:
-                        no = no + 1
-                        picture_name = image_format + "-%.2d.jpg" % no
+                picture_name = ""
+                if i == 0 and use_folder_jpg:
+                    picture_name = "folder.jpg"
+                else:
+                    no = no + 1
+                    picture_name = image_format + "-%.2d.jpg" % no
+
+                downloads.append((image_url, os.path.join(self.album.target_dir, picture_name)))
+
+                if i == 0 and download_only_cover:
+                    break
+
+            logger.debug("Downloading %d images" % len(downloads))
+            self.image_batch = conn_mgr.fetch_images(downloads)
+
+        return self.image_batch
 
-                    conn_mgr.fetch_image(os.path.join(self.album.target_dir, picture_name), image_url)
+    def wait_for_images(self):
+        """
+            Waits until the images requested by get_images are downloaded and
+            returns the timings of the single downloads
+        """
+        if getattr(self, 'image_batch', None) is None:
+            return []
+
+        timings = self.image_batch.wait()
+        self.image_batch = None
 
-                    if i == 0 and download_only_cover:
-                        break
+        if timings:
+            logger.info("Stored {0}/{1} images ({2} cached, {3} bytes) in {4:.2f}s".format(
+                        len([t for t in timings if t.ok]), len(timings),
+                        len([t for t in timings if t.cached]),
+                        sum(t.size for t in timings), max(t.seconds for t in timings)))
+        for timing in timings:
+            logger.debug("image {0}: {1} bytes, {2:.2f}s ({3:.2f}s throttled)".format(
+                         os.path.basename(timing.path), timing.size, timing.seconds, timing.throttled))
 
-                except Exception as e:
-                    logger.error("Unable to download image '%s', skipping." % image_url)
-                    print(e)
+        return timings
 
-    def embed_coverart_album(self):
+    def load_coverart(self):
         """
-            Embed cover art into all album files
+            Returns the image data of the cover art to embed, or None if
+            the cover art should not be embedded (or is not available)
         """
         embed_coverart = self.config.getboolean("details", "embed_coverart")
         image_format = self.config.get("file-formatting", "image")
@@ -368,38 +568,13 @@ class FileHandler(object):
 
         image_file = os.path.join(self.album.target_dir, first_image_name)
 
-        logger.debug("Start to embed coverart (on request)...")
-
         if embed_coverart and os.path.exists(image_file):
-            logger.debug("embed_coverart and image_file")
-            with open(image_file, 'rb') as f:
-                imgdata = f.read()
-                imgtype = imghdr.what(image_file)
-
-                if imgtype in ("jpeg", "png"):
-                    logger.info("Embedding album art...")
-                    for disc in self.album.discs:
-                        for track in disc.tracks:
-                            self.embed_coverart_track(disc, track, imgdata)
-
-    def embed_coverart_track(self, disc, track, imgdata):
-        """
-            Embed cover art into a single file
-        """
-
-        if disc.target_dir != None:
-            track_dir = os.path.join(self.album.target_dir, disc.target_dir)
-        else:
-            track_dir = self.album.target_dir
+            imgtype = imghdr.what(image_file)
+            if imgtype in ("jpeg", "png"):
+                with open(image_file, 'rb') as f:
+                    return f.read()
 
-        track_file = os.path.join(track_dir, track.new_file)
-        metadata = MediaFile(track_file)
-        try:
-            metadata.art = imgdata
-            metadata.save()
-        except Exception as e:
-            logger.error("Unable to embed image '{}'".format(track_file))
-            print(e)
+        return None
 
     def add_replay_gain_tags(self):
         """
@@ -477,6 +652,118 @@ class FileHandler(object):
         )
 
 
+class FormattingContext(object):
+    """ the values of the placeholders of the format strings (e.g. %album%)
+        of an album. The values, which depend on the release only, are
+        computed once per album, the values of the tracks and discs (and of
+        the audio files, which are read later) on demand, so that building
+        a name costs the placeholders used by its format only.
+        Add further placeholders here.
+    """
+
+    # placeholder -> function(utils, album), computed once
+    ALBUM_VALUES = {
+        '%album artist%': lambda utils, album: utils.join_artists.join(album.artists),
+        '%albumartist%': lambda utils, album: utils.join_artists.join(album.artists),
+        '%album%': lambda utils, album: album.title,
+        '%catno%': lambda utils, album: ', '.join(album.catnumbers),
+        '%year%': lambda utils, album: album.year,
+        '%totaldiscs%': lambda utils, album: album.disctotal,
+        '%format%': lambda utils, album: album.format,
+        '%format_description%': lambda utils, album: album.format_description,
+        '%filesize%': lambda utils, album: '',
+        '%filesize_natural%': lambda utils, album: '',
+        '%length_samples%': lambda utils, album: '',
+
+        "%ALBTITLE%": lambda utils, album: album.title,
+        "%ALBARTIST%": lambda utils, album: album.artist,
+        "%YEAR%": lambda utils, album: album.year,
+        "%CATNO%": lambda utils, album: album.catnumbers[0],
+        "%GENRE%": lambda utils, album: album.genre,
+        "%STYLE%": lambda utils, album: album.style,
+        "%LABEL%": lambda utils, album: album.labels[0],
+    }
+
+    # placeholder -> function(values), computed on each use
+    TRACK_VALUES = {
+        '%artist%': lambda values: values.track.artist,
+        '%discnumber%': lambda values: values.discno,
+        '%mediatype%': lambda values: values.disc.mediatype,
+        '%disctitle%': lambda values: values.disc.discsubtitle,
+        '%track artist%': lambda values: values.track.artist,
+        '%title%': lambda values: values.track.title,
+        '%tracknumber%': lambda values: values.context.utils.get_real_track_number(
+                                            values.format, values.discno, values.trackno),
+        '%track number%': lambda values: values.trackno,
+        '%fileext%': lambda values: values.disc.filetype,
+        '%bitdepth%': lambda values: values.track.bitdepth,
+        '%bitrate%': lambda values: values.track.bitrate,
+        '%channels%': lambda values: values.track.channels,
+        '%codec%': lambda values: values.track.codec,
+        '%encoding%': lambda values: values.track.encoding,
+        '%samplerate%': lambda values: values.track.samplerate,
+        '%length_seconds_fp%': lambda values: values.track.length_seconds_fp,
+        '%length%': lambda values: values.track.length,
+        '%length_ex%': lambda values: values.track.length_ex,
+        '%length_seconds%': lambda values: values.track.length_seconds,
+
+        "%ARTIST%": lambda values: values.track.artist,
+        "%TITLE%": lambda values: values.track.title,
+        "%DISCNO%": lambda values: values.discno,
+        "%TRACKNO%": lambda values: "%.2d" % values.trackno,
+        "%TYPE%": lambda values: values.filetype,
+        # set while planning the tags
+        "%CODEC%": lambda values: values.context.album.codec,
+    }
+
+    def __init__(self, utils):
+        self.utils = utils
+        self.album = utils.album
+        self._album_values = {}
+
+    def album_value(self, name):
+        try:
+            return self._album_values[name]
+        except KeyError:
+            value = self.ALBUM_VALUES[name](self.utils, self.album)
+            self._album_values[name] = value
+            return value
+
+    def values(self, format, discno=1, trackno=1, filetype=".mp3"):
+        """ the values of a single track (usable as mapping) """
+        return TrackValues(self, format, discno, trackno, filetype)
+
+class TrackValues(object):
+    """ the values of the placeholders of a single track (and disc), see
+        FormattingContext
+    """
+
+    def __init__(self, context, format, discno, trackno, filetype):
+        self.context = context
+        self.format = format
+        self.discno = discno
+        self.trackno = trackno
+        self.filetype = filetype
+
+    @property
+    def disc(self):
+        return self.context.album.disc(self.discno)
+
+    @property
+    def track(self):
+        return self.disc.track(self.trackno)
+
+    def __contains__(self, name):
+        return name in FormattingContext.ALBUM_VALUES or name in FormattingContext.TRACK_VALUES
+
+    def __getitem__(self, name):
+        if name in FormattingContext.ALBUM_VALUES:
+            return self.context.album_value(name)
+        return FormattingContext.TRACK_VALUES[name](self)
+
+    def keys(self):
+        return list(FormattingContext.ALBUM_VALUES) + list(FormattingContext.TRACK_VALUES)
+
 class TaggerUtils(object):
     """ Accepts a destination directory name and discogs release id.
         TaggerUtils returns a the corresponding metadata information, in which
@@ -488,9 +775,14 @@ class TaggerUtils(object):
 
     # supported file types.
     FILE_TYPE = (".mp3", ".flac",)
-
-    def __init__(self, sourcedir, destdir, tagger_config, album=None):
+    # the directory of the templates (nfo, m3u)
+    TEMPLATE_DIR = "templates"
+    # the template lookups shared by all albums (see shared_template_lookup)
+    _shared_lookups = {}
+    _shared_lock = threading.Lock()
+    def __init__(self, sourcedir, destdir, tagger_config, album=None, session=None):
         self.config = tagger_config
+        self.session = session if session is not None else MediaSession.from_config(tagger_config)
 
         # ignore directory where old cue files are stashed
         self.cue_done_dir = self.config.get('cue', 'cue_done_dir')
@@ -504,13 +796,19 @@ class TaggerUtils(object):
         self.m3u_format = self.config.get("file-formatting", "m3u")
         self.nfo_format = self.config.get("file-formatting", "nfo")
         self.disc_folder_name = self.config.get("file-formatting", "discs")
-        self.normalize = self.config.get("file-formatting", "normalize")
+        # any value is accepted (like the former string comparison), only the
+        # boolean ones switch the normalization on
+        normalize = self.config.get("file-formatting", "normalize")
+        self.normalize = normalize is not None and self.config.BOOLEAN_STATES.get(normalize.lower(), False)
         self.use_lower = self.config.getboolean("details", "use_lower_filenames")
         self.join_artists = self.config.get("details", "join_artists")
 
 #        self.first_image_name = "folder.jpg"
         self.copy_other_files = self.config.getboolean("details", "copy_other_files")
         self.char_exceptions = self.config.get_character_exceptions
+        self.sanitizer = FilenameSanitizer.shared(self.char_exceptions, self.normalize, self.use_lower,
+                                                  TaggerUtils.FILE_TYPE + (".m3u", ".nfo"))
+        self.string_formatting = StringFormatting()
 
         self.sourcedir = sourcedir
         self.destdir = destdir
@@ -520,6 +818,7 @@ class TaggerUtils(object):
         else:
             raise RuntimeException('Cannot tag, no album given')
 
+        self.formatting_context = FormattingContext(self)
         self.map_format_description()
 
         self.album.sourcedir = sourcedir
@@ -530,7 +829,9 @@ class TaggerUtils(object):
         logging.debug("album.target_dir: %s" % self.dest_dir_name)
 
         # add template functionality ;-)
-        self.template_lookup = TemplateLookup(directories=["templates"])
+        self.template_lookup = TaggerUtils.shared_template_lookup(self.config)
+        # time spent rendering the templates (create_nfo, create_m3u)
+        self.render_seconds = 0.0
 
     def map_format_description(self):
         """ Gets format desription, and maps to user defined variations,
@@ -548,6 +849,13 @@ class TaggerUtils(object):
                 if self.format_mapping[desc.lower()] is not None:
                     self.album.format_description[i] = self.format_mapping[desc.lower()]
 
+    def _format_values(self, format, discno=1, trackno=1, filetype=".mp3"):
+        """ the values of the placeholders of the format strings using the
+            track information (see FormattingContext), the values are
+            computed when used only
+        """
+        return self.formatting_context.values(format, discno, trackno, filetype)
+
     def _value_from_tag_format(self, format, discno=1, trackno=1, filetype=".mp3"):
         """ Fill in the used variables using the track information
             Transform all variables and use them in the given format string, make this
@@ -555,58 +863,11 @@ class TaggerUtils(object):
 
             Transfer this via a map.
         """
+        property_map = self._format_values(format, discno, trackno, filetype)
 
-        property_map = {
-
-            '%album artist%': self.join_artists.join(self.album.artists),
-            '%albumartist%': self.join_artists.join(self.album.artists),
-            '%album%': self.album.title,
-            '%catno%': ', '.join(self.album.catnumbers),
-            "%year%": self.album.year,
-            '%artist%': self.album.disc(discno).track(trackno).artist,
-            '%totaldiscs%': self.album.disctotal,
-            '%discnumber%': discno,
-            '%mediatype%': self.album.disc(discno).mediatype,
-            '%disctitle%': self.album.disc(discno).discsubtitle,
-            '%track artist%': self.album.disc(discno).track(trackno).artist,
-            '%title%': self.album.disc(discno).track(trackno).title,
-            '%tracknumber%': self.get_real_track_number(format, discno, trackno),
-            '%track number%': trackno,
-            '%format%': self.album.format,
-            '%format_description%': self.album.format_description,
-            '%fileext%': self.album.disc(discno).filetype,
-            '%bitdepth%': self.album.disc(discno).track(trackno).bitdepth,
-            '%bitrate%': self.album.disc(discno).track(trackno).bitrate,
-            '%channels%': self.album.disc(discno).track(trackno).channels,
-            '%codec%': self.album.disc(discno).track(trackno).codec,
-            '%filesize%':'',
-            '%filesize_natural%':'',
-            '%length_samples%':'',
-            '%encoding%': self.album.disc(discno).track(trackno).encoding,
-            '%samplerate%': self.album.disc(discno).track(trackno).samplerate,
-            '%channels%': self.album.disc(discno).track(trackno).channels,
-            '%length_seconds_fp%': self.album.disc(discno).track(trackno).length_seconds_fp,
-            '%length%': self.album.disc(discno).track(trackno).length,
-            '%length_ex%': self.album.disc(discno).track(trackno).length_ex,
-            '%length_seconds%': self.album.disc(discno).track(trackno).length_seconds,
-
-            "%ALBTITLE%": self.album.title,
-            "%ALBARTIST%": self.album.artist,
-            "%YEAR%": self.album.year,
-            "%CATNO%": self.album.catnumbers[0],
-            "%GENRE%": self.album.genre,
-            "%STYLE%": self.album.style,
-            "%ARTIST%": self.album.disc(discno).track(trackno).artist,
-            "%TITLE%": self.album.disc(discno).track(trackno).title,
-            "%DISCNO%": discno,
-            "%TRACKNO%": "%.2d" % trackno,
-            "%TYPE%": filetype,
-            "%LABEL%": self.album.labels[0],
-            "%CODEC%": self.album.codec,
-        }
-
-        for hashtag in property_map.keys():
-            format = format.replace(hashtag, re.escape(str(property_map[hashtag])))
+        for hashtag in StringFormatting.compile(format).placeholders:
+            if hashtag in property_map:
+                format = format.replace(hashtag, re.escape(str(property_map[hashtag])))
 
         return format
 
@@ -621,9 +882,9 @@ class TaggerUtils(object):
             avoid usage of file extension here already, could lead to problems
         """
 
-        stringFormatting = StringFormatting()
-        format = self._value_from_tag_format(format, discno, trackno, filetype)
-        format = stringFormatting.parseString(format)
+        # the format strings are compiled once (see StringFormatting.compile)
+        format = self.string_formatting.parseString(format,
+                     self._format_values(format, discno, trackno, filetype))
         format = self.get_clean_filename(format)
 
         logger.debug("output: %s" % format)
@@ -659,31 +920,27 @@ class TaggerUtils(object):
     def gather_addional_properties(self):
         ''' Fetches additional technical information about the tracks
         '''
-        for disc in self.album.discs:
-            dn = disc.discnumber
-            for track in disc.tracks:
-                tn = track.tracknumber
-                metadata = MediaFile(track.full_path)
-                # for field in metadata.readable_fields():
-                #     print('fieldname: {}: '.format(field)) #, getattr(metadata, field)
-
-                self.album.disc(dn).track(tn).codec = metadata.type
-                codec = metadata.type
-                lossless = ('flac', 'alac', 'wma', 'ape', 'wav')
-                encod = 'lossless' if codec.lower() in lossless else 'lossy'
-                self.album.disc(dn).track(tn).encoding = encod
-                self.album.disc(dn).track(tn).samplerate = metadata.samplerate
-                self.album.disc(dn).track(tn).bitrate = metadata.bitrate
-                self.album.disc(dn).track(tn).bitdepth = metadata.bitdepth
-                chans = metadata.channels
-                ch_opts = {1: 'mono', 2: 'stereo'}
-                self.album.disc(dn).track(tn).channels = ch_opts[chans] if chans in ch_opts else '{}ch'.format(chans)
-                self.album.disc(dn).track(tn).length_seconds_fp = metadata.length
-                length_seconds_fp = metadata.length
-                self.album.disc(dn).track(tn).length_seconds = int(length_seconds_fp)
-                self.album.disc(dn).track(tn).length = str(timedelta(seconds = int(length_seconds_fp)))
-                length_ex_str = str(timedelta(seconds = round(length_seconds_fp, 4)))
-                self.album.disc(dn).track(tn).length_ex = length_ex_str[:-2]
+        tracks = [(disc.discnumber, track.tracknumber, track.full_path)
+                  for disc in self.album.discs for track in disc.tracks]
+        infos = self.session.infos([full_path for dn, tn, full_path in tracks])
+        for (dn, tn, full_path), info in zip(tracks, infos):
+            self.album.disc(dn).track(tn).codec = info.type
+            codec = info.type
+            lossless = ('flac', 'alac', 'wma', 'ape', 'wav')
+            encod = 'lossless' if codec.lower() in lossless else 'lossy'
+            self.album.disc(dn).track(tn).encoding = encod
+            self.album.disc(dn).track(tn).samplerate = info.samplerate
+            self.album.disc(dn).track(tn).bitrate = info.bitrate
+            self.album.disc(dn).track(tn).bitdepth = info.bitdepth
+            chans = info.channels
+            ch_opts = {1: 'mono', 2: 'stereo'}
+            self.album.disc(dn).track(tn).channels = ch_opts[chans] if chans in ch_opts else '{}ch'.format(chans)
+            self.album.disc(dn).track(tn).length_seconds_fp = info.length
+            length_seconds_fp = info.length
+            self.album.disc(dn).track(tn).length_seconds = int(length_seconds_fp)
+            self.album.disc(dn).track(tn).length = str(timedelta(seconds = int(length_seconds_fp)))
+            length_ex_str = str(timedelta(seconds = round(length_seconds_fp, 4)))
+            self.album.disc(dn).track(tn).length_ex = length_ex_str[:-2]
 
     def _directory_has_audio_files(self, dir):
         codecs = ('.flac', '.ogg', '.mp3')
@@ -853,46 +1110,46 @@ class TaggerUtils(object):
 
 
     def get_clean_filename(self, f):
-        """ Removes unwanted characters from file names """
-
-        filename, fileext = os.path.splitext(f)
-
-        if not fileext in TaggerUtils.FILE_TYPE and not fileext in [".m3u", ".nfo"]:
-            logger.debug("fileext: {}".format(fileext))
-            filename = f
-            fileext = ""
-
-        a = str(filename)
-        a = re.sub(r'\.$', '', a) # windows doesn't like folders ending with '.'
-        a = re.sub(r'\$', 'S', a) # Replace $ with S
-
-        for k, v in self.char_exceptions.items():
-            a = a.replace(k, v)
-
-        if self.normalize == True:
-            a = normalize("NFKD", a)
-
-        cf = re.compile(r"[^-\w.,()\[\]\s#@&!']") # allowed characters
-        cf = cf.sub("", str(a))
-
-
-        # Don't force space/underscore replacement. If the user wants this it
-        # can be done via config. The user may _want_ spaces.
-        # cf = cf.replace(" ", "_")
-        # cf = cf.replace("__", "_")
-        # cf = cf.replace("_-_", "-")
-
-        cf = "".join([cf, fileext])
-
-        if self.use_lower:
-            cf = cf.lower()
-
-        return cf
+        """ Removes unwanted characters from file names (see
+            FilenameSanitizer, shared by all albums)
+        """
+        return self.sanitizer.clean(f)
+
+    @classmethod
+    def shared_template_lookup(cls, tagger_config):
+        """ returns the TemplateLookup shared by all albums of the process,
+            each template is compiled once. If template_cache is set, the
+            compiled templates are stored as modules in the cache directory
+            and reused by the next runs, a modified template is compiled
+            again (checked by its modification time).
+        """
+        module_directory = None
+        if tagger_config.getboolean("cache", "template_cache"):
+            module_directory = os.path.join(os.path.expanduser(tagger_config.get("cache", "cache_dir")),
+                                            "templates")
+        key = (cls.TEMPLATE_DIR, module_directory)
+
+        with cls._shared_lock:
+            if key not in cls._shared_lookups:
+                cls._shared_lookups[key] = TemplateLookup(directories=[cls.TEMPLATE_DIR],
+                                                          module_directory=module_directory,
+                                                          filesystem_checks=True)
+            return cls._shared_lookups[key]
+
+    @classmethod
+    def reset_shared(cls):
+        cls._shared_lock = threading.Lock()
+        cls._shared_lookups = {}
 
     def create_file_from_template(self, template_name, file_name):
+        started = time.time()
         file_template = self.template_lookup.get_template(template_name)
-        return write_file(file_template.render(album=self.album),
-            os.path.join(self.album.target_dir, file_name))
+        contents = file_template.render(album=self.album)
+        seconds = time.time() - started
+        self.render_seconds += seconds
+        logger.debug("rendered {0} in {1:.1f} ms".format(template_name, seconds * 1000))
+
+        return write_file(contents, os.path.join(self.album.target_dir, file_name))
 
     def create_nfo(self, dest_dir):
         """ Writes the .nfo file to disk. """
@@ -931,7 +1188,7 @@ def write_file(filecontents, filename):
     return True
 
 
-def copytree_multi(src, dst, symlinks=False, ignore=None):
+def copytree_multi(src, dst, symlinks=False, ignore=None, copy_function=copy2):
     names = os.listdir(src)
     if ignore is not None:
         ignored_names = ignore(src, names)
@@ -955,9 +1212,9 @@ def copytree_multi(src, dst, symlinks=False, ignore=None):
                 linkto = os.readlink(srcname)
                 os.symlink(linkto, dstname)
             elif os.path.isdir(srcname):
-                copytree_multi(srcname, dstname, symlinks, ignore)
+                copytree_multi(srcname, dstname, symlinks, ignore, copy_function)
             else:
-                copy2(srcname, dstname)
+                copy_function(srcname, dstname)
         except (IOError, os.error) as why:
             errors.append((srcname, dstname, str(why)))
         except Error as err:
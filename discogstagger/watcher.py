@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sqlite3
+import threading
+import time
+import logging
+
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+from discogstagger.cache import mkdir_p
+
+logger = logging
+
+class WorkQueue(object):
+    """ persistent queue of the album directories waiting to get tagged. An
+        entry is removed only after the directory has been processed, entries
+        taken but not finished (e.g. the daemon was stopped) are queued again
+        on restart.
+    """
+
+    def __init__(self, queue_file):
+        mkdir_p(os.path.dirname(os.path.abspath(queue_file)))
+
+        self._cond = threading.Condition()
+        self._db = sqlite3.connect(queue_file, timeout=30, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS queue (
+                                dir TEXT PRIMARY KEY,
+                                queued REAL NOT NULL,
+                                taken INTEGER NOT NULL DEFAULT 0)""")
+        self._db.execute("UPDATE queue SET taken = 0")
+        self._db.commit()
+
+    def put(self, album_dir):
+        """ queues the directory, if it is not queued already (a directory,
+            which is processed right now, is queued again)
+        """
+        with self._cond:
+            self._db.execute("INSERT OR REPLACE INTO queue (dir, queued, taken) VALUES (?, ?, 0)",
+                             (album_dir, time.time()))
+            self._db.commit()
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """ returns the directory queued first, blocks until a directory is
+            queued (or the timeout is reached, returning None)
+        """
+        with self._cond:
+            while True:
+                row = self._db.execute("SELECT dir FROM queue WHERE taken = 0 "
+                                       "ORDER BY queued LIMIT 1").fetchone()
+                if row is not None:
+                    self._db.execute("UPDATE queue SET taken = 1 WHERE dir = ?", row)
+                    self._db.commit()
+                    return row[0]
+                if not self._cond.wait(timeout):
+                    return None
+
+    def done(self, album_dir):
+        with self._cond:
+            self._db.execute("DELETE FROM queue WHERE dir = ? AND taken = 1", (album_dir,))
+            self._db.commit()
+
+    def __len__(self):
+        with self._cond:
+            return self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def close(self):
+        with self._cond:
+            self._db.close()
+
+class AlbumEventHandler(FileSystemEventHandler):
+    """ maps the file system events to the album directories and remembers
+        the time of the last event per directory
+    """
+
+    DISC_DIR = re.compile(r'^(cd|disc)\s*\d+', re.IGNORECASE)
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def album_dir(self, path):
+        """ the album directory of the given file, files in disc subdirectories
+            (e.g. CD1) belong to the parent directory
+        """
+        album_dir = os.path.dirname(path)
+        if self.DISC_DIR.match(os.path.basename(album_dir)):
+            album_dir = os.path.dirname(album_dir)
+        return album_dir
+
+    def on_any_event(self, event):
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+
+        if event.is_directory:
+            # the files within new directories cause events of their own,
+            # only directories moved into the tree are of interest
+            if event.event_type == 'moved' and not self.watcher.ignored(event.dest_path):
+                self.watcher.touch(event.dest_path)
+            return
+
+        paths = [event.src_path]
+        if event.event_type == 'moved':
+            paths.append(event.dest_path)
+
+        for path in paths:
+            if not self.watcher.ignored(path):
+                self.watcher.touch(self.album_dir(path))
+
+class WatchDaemon(object):
+    """ watches the source directory (using inotify where available) and
+        queues album directories, as soon as they have settled: no events
+        arrived for `quiet_period` seconds and the size and mtime of the files
+        did not change between two checks. The queued directories are
+        processed by a pool of `workers` threads calling `process(album_dir)`,
+        the album directory might contain further albums (e.g. if a whole
+        artist directory was moved into the source directory).
+    """
+
+    def __init__(self, source_dir, process, work_queue, quiet_period=30,
+                 poll_interval=5, workers=1, ignore_names=(), ignore_dirs=()):
+        self.source_dir = os.path.abspath(source_dir)
+        self.process = process
+        self.work_queue = work_queue
+        self.quiet_period = quiet_period
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.ignore_names = set(ignore_names)
+        self.ignore_dirs = [os.path.abspath(d) for d in ignore_dirs if d]
+
+        # album directory -> time of the last event
+        self.pending = {}
+        # album directory -> signature of the last settle check
+        self.signatures = {}
+        # album directories processed right now
+        self.active = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self.observer = None
+
+    @classmethod
+    def from_config(cls, tagger_config, source_dir, process, ignore_dirs=()):
+        queue_file = tagger_config.get("watch", "queue_file")
+        if not queue_file:
+            queue_file = os.path.join(tagger_config.get("cache", "cache_dir"), "watch.db")
+
+        return cls(source_dir, process, WorkQueue(os.path.expanduser(queue_file)),
+                   tagger_config.getfloat("watch", "quiet_period"),
+                   tagger_config.getfloat("watch", "poll_interval"),
+                   tagger_config.getint("watch", "workers"),
+                   (tagger_config.get("details", "done_file"),),
+                   ignore_dirs)
+
+    def ignored(self, path):
+        if os.path.basename(path) in self.ignore_names:
+            return True
+        for ignore_dir in self.ignore_dirs:
+            if path == ignore_dir or path.startswith(ignore_dir + os.sep):
+                return True
+        return False
+
+    def touch(self, album_dir):
+        """ records an event in the given album directory, events outside of
+            the source directory and of files directly in the source directory
+            (which belong to no album) are ignored
+        """
+        if not album_dir.startswith(self.source_dir + os.sep):
+            if album_dir == self.source_dir:
+                logger.debug("ignoring change in the source directory %s" % album_dir)
+            return
+        with self._lock:
+            if self._is_active(album_dir):
+                # the changes are made by the tagger (e.g. tags written to
+                # the source files)
+                return
+            if album_dir not in self.pending:
+                logger.debug("change detected in %s" % album_dir)
+            self.pending[album_dir] = time.time()
+
+    def _is_active(self, album_dir):
+        for active_dir in self.active:
+            if album_dir == active_dir or album_dir.startswith(active_dir + os.sep):
+                return True
+        return False
+
+    def signature(self, album_dir):
+        """ size and mtime of all files in the album directory (including the
+            disc subdirectories), or None if the directory does not exist
+        """
+        entries = []
+        try:
+            for root, dirs, files in os.walk(album_dir):
+                for name in files:
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((root, name, stat.st_size, stat.st_mtime))
+        except OSError:
+            return None
+        if not os.path.isdir(album_dir):
+            return None
+        return sorted(entries)
+
+    def settle(self):
+        """ queues the pending album directories, that have settled """
+        now = time.time()
+        with self._lock:
+            quiet = [d for d, last in self.pending.items() if now - last >= self.quiet_period]
+
+        for album_dir in quiet:
+            signature = self.signature(album_dir)
+            with self._lock:
+                if self.pending.get(album_dir, now) > now - self.quiet_period:
+                    # new events arrived in the meantime
+                    continue
+                if signature is None:
+                    # the directory was removed (or moved away)
+                    del self.pending[album_dir]
+                    self.signatures.pop(album_dir, None)
+                    continue
+                if self.signatures.get(album_dir) != signature:
+                    # check again after the next interval
+                    self.signatures[album_dir] = signature
+                    continue
+                del self.pending[album_dir]
+                del self.signatures[album_dir]
+
+            logger.info("queueing %s" % album_dir)
+            self.work_queue.put(album_dir)
+
+    def _work(self):
+        while not self._stop.is_set():
+            album_dir = self.work_queue.take(self.poll_interval)
+            if album_dir is None:
+                continue
+            with self._lock:
+                self.active.add(album_dir)
+            try:
+                self.process(album_dir)
+            except Exception as ex:
+                logger.error("Error processing %s: %s" % (album_dir, ex))
+            finally:
+                with self._lock:
+                    self.active.discard(album_dir)
+                    for pending_dir in list(self.pending):
+                        if pending_dir == album_dir or pending_dir.startswith(album_dir + os.sep):
+                            del self.pending[pending_dir]
+                            self.signatures.pop(pending_dir, None)
+            self.work_queue.done(album_dir)
+
+    def start(self):
+        self.observer = Observer()
+        self.observer.schedule(AlbumEventHandler(self), path=self.source_dir, recursive=True)
+        self.observer.start()
+
+        for no in range(self.workers):
+            thread = threading.Thread(target=self._work, name="watch-worker-%d" % no)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        logger.info("watching %s (%d directories queued)" % (self.source_dir, len(self.work_queue)))
+
+    def run(self):
+        """ runs until interrupted """
+        self.start()
+        try:
+            while not self._stop.is_set():
+                self.settle()
+                self._stop.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stop.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        for thread in self._threads:
+            thread.join()
+        self.work_queue.close()
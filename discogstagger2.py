@@ -5,10 +5,10 @@ import errno
 import logging
 import logging.config
 import sys
+import threading
+import multiprocessing
 
 import time
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
@@ -20,6 +20,9 @@ from discogstagger.fileutils import FileUtils
 from discogstagger.tagger_config import TaggerConfig
 from discogstagger.discogsalbum import DiscogsAlbum, DiscogsConnector, LocalDiscogsConnector, AlbumError, DiscogsSearch
 from discogstagger.taggerutils import TaggerUtils, TagHandler, FileHandler, TaggerError
+from discogstagger.mediasession import MediaSession
+from discogstagger.pipeline import Pipeline, Stage
+from discogstagger.watcher import WatchDaemon
 
 p = OptionParser(version="discogstagger3 3.0")
 p.add_option("-r", "--releaseid", action="store", dest="releaseid",
@@ -38,11 +41,17 @@ p.add_option("-g", "--replay-gain", action="store_true", dest="replaygain",
              help="Should replaygain tags be added to the album? (metaflac needs to be installed)")
 p.add_option("-w", "--watch", action="store_true", dest="watch",
              help="Watches for changes in the source directory (daemon mode)")
+p.add_option("--offline", action="store_true", dest="offline",
+             help="Use cached releases only, do not access the discogs api")
+p.add_option("--workers", action="store", type="int", dest="workers",
+             help="Number of processes used to tag the albums in batch mode")
 
 p.set_defaults(conffile="conf/default.conf")
 p.set_defaults(recursive=False)
 p.set_defaults(forceUpdate=False)
 p.set_defaults(replaygain=False)
+p.set_defaults(offline=False)
+p.set_defaults(workers=1)
 
 if len(sys.argv) == 1:
     p.print_help()
@@ -61,6 +70,8 @@ if options.destdir and os.path.exists(options.destdir):
 tagger_config = TaggerConfig(options.conffile)
 # options.replaygain = tagger_config.get("batch", "replaygain")
 tagger_config.set('details', 'source_dir', options.sourcedir)
+if options.offline:
+    tagger_config.set('cache', 'offline', 'True')
 # initialize logging
 logger_config_file = tagger_config.get("logging", "config_file")
 logging.config.fileConfig(logger_config_file)
@@ -74,163 +85,252 @@ options.searchDiscogs = tagger_config.get('batch', 'searchDiscogs')
 
 file_utils = FileUtils(tagger_config, options)
 
-def getSourceDirs():
+def getSourceDirs(start_dir=None):
+    """ yields the source directories to process, the directories are
+        yielded while the rest of the tree is still scanned
+    """
     source_dirs = None
+    start_dir = start_dir or options.sourcedir
     if options.recursive:
         logger.debug("determine sourcedirs")
-        source_dirs = file_utils.walk_dir_tree(options.sourcedir, id_file)
+        source_dirs = file_utils.walk_dir_tree(start_dir, id_file)
     elif options.searchDiscogs:
         logger.debug("looking for audio files")
-        source_dirs = file_utils.get_audio_dirs(options.sourcedir)
+        source_dirs = file_utils.get_audio_dirs(start_dir)
     else:
-        logger.debug("using sourcedir: %s" % options.sourcedir)
-        source_dirs = [options.sourcedir]
-    logger.info('Found {} audio source directories to process'.format(len(source_dirs)))
-    return source_dirs
-
-
-def processSourceDirs(source_dirs, tagger_config):
-    # initialize connection (could be a problem if using multiple sources...)
-    discogs_connector = DiscogsConnector(tagger_config)
-    local_discogs_connector = LocalDiscogsConnector(discogs_connector)
-    # try to re-use search, may be useful if working with several releases by the same artist
-    discogsSearch = DiscogsSearch(tagger_config)
-
-    logger.info("start tagging")
-    discs_with_errors = []
-
-    converted_discs = 0
+        logger.debug("using sourcedir: %s" % start_dir)
+        source_dirs = [start_dir]
 
+    found = 0
     for source_dir in source_dirs:
-        releaseid = None
-        release = None
-        connector = None
-
-        try:
-            done_file = tagger_config.get("details", "done_file")
-            done_file_path = os.path.join(source_dir, done_file)
-
-            if os.path.exists(done_file_path) and not options.forceUpdate:
-                logger.warn('Do not read {}, because {} exists and forceUpdate is false'.format(source_dir, done_file))
-                continue
-
-            # reread config to make sure, that the album specific options are reset for each
-            # album
-            tagger_config = TaggerConfig(options.conffile)
-
-            if options.releaseid is not None:
-                releaseid = options.releaseid
-            else:
-                releaseid = file_utils.read_id_file(source_dir, id_file, options)
-
-            if not releaseid:
-                searchParams = discogsSearch.getSearchParams(source_dir)
-                # release = discogsSearch.search_discogs(searchParams)
-                release = discogsSearch.search_discogs()
-                # reuse the Discogs Release class, it saves re-fetching later
-                if release is not None and type(release).__name__ in ('Release', 'Version'):
-                    releaseid = release.id
-                    connector = discogs_connector
-
-            if not releaseid:
-                logger.warn('No releaseid for {}'.format(source_dir))
-                continue
-
-            # if not releaseid:
-            #     p.error("Please specify the discogs.com releaseid ('-r')")
-
-            logger.info('Found release ID: {} for source dir: {}'.format(releaseid, source_dir))
-
-            # read destination directory
-            # !TODO if both are the same, we are not copying anything,
-            # this should be "configurable"
-            if not options.destdir:
-                destdir = source_dir
-            else:
-                destdir = options.destdir
-                logger.debug('destdir set to {}'.format(options.destdir))
-
-            logger.info('Using destination directory: {}'.format(destdir))
-            logger.debug("starting tagging...")
-
-
-            if releaseid is not None and release is None:
-                #! TODO this is dirty, refactor it to be able to reuse it for later enhancements
-                if tagger_config.get("source", "name") == "local":
-                    release = local_discogs_connector.fetch_release(releaseid, source_dir)
-                    connector = local_discogs_connector
-                else:
-                    release = discogs_connector.fetch_release(releaseid)
-                    connector = discogs_connector
-
-            discogs_album = DiscogsAlbum(release)
-
+        found = found + 1
+        yield source_dir
+    logger.info('Found {} audio source directories to process'.format(found))
+
+
+class AlbumJob(object):
+    """ the state of a single source directory on its way through the
+        pipeline
+    """
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.releaseid = None
+        self.release = None
+        self.connector = None
+        self.tagger_config = None
+        self.destdir = None
+        self.album = None
+        self.tagHandler = None
+        self.taggerUtils = None
+        self.fileHandler = None
+        # the audio files of the album, read once by all stages
+        self.session = None
+        # (stage, seconds) of the album
+        self.timings = []
+
+class AlbumProcessor(object):
+    """ the stages used to process the source directories, the stages are
+        run by a pipeline, so that the metadata of the next albums is fetched
+        while the current album is tagged and copied
+    """
+
+    def __init__(self, tagger_config, total, progress=None):
+        # initialize connection (could be a problem if using multiple sources...)
+        self.discogs_connector = DiscogsConnector(tagger_config)
+        self.local_discogs_connector = LocalDiscogsConnector(self.discogs_connector)
+        # try to re-use search, may be useful if working with several releases by the same artist
+        # (the search shares the discogs client and the rate limiter with the connector)
+        self.discogsSearch = DiscogsSearch(tagger_config)
+
+        self.tagger_config = tagger_config
+        # the total is unknown, while the source directory is still scanned
+        self.total = total
+        self.touched = 0
+        # number of converted discs shared by all worker processes
+        self.progress = progress
+        self.converted_discs = 0
+        self.discs_with_errors = []
+        self._lock = threading.Lock()
+
+    def stages(self, tagger_config):
+        """ returns the pipeline stages, the concurrency of the stages is read
+            from the [pipeline] section of the configuration
+        """
+        def workers(stage):
+            return tagger_config.getint("pipeline", "%s_workers" % stage)
+
+        # the search keeps state between the calls, therefore the
+        # source directories are resolved one by one
+        return [Stage("resolve", self.timed("resolve", self.resolve), 1),
+                Stage("fetch", self.timed("fetch", self.fetch), workers("fetch")),
+                Stage("map", self.timed("map", self.map), workers("map")),
+                Stage("tag", self.timed("tag", self.tag), workers("tag")),
+                Stage("art", self.timed("art", self.art), workers("art")),
+                Stage("loudness", self.timed("loudness", self.loudness), workers("loudness")),
+                Stage("finalize", self.finalize, workers("finalize"))]
+
+    def timed(self, stage, func):
+        """ records the time spent on an album by the given stage (see
+            AlbumJob.timings)
+        """
+        def run(job):
+            started = time.time()
             try:
-                album = discogs_album.map()
-            except AlbumError as ae:
-                msg = "Error during mapping ({0}), {1}: {2}".format(releaseid, source_dir, ae)
-                logger.error(msg)
-                discs_with_errors.append(msg)
-                continue
-
-            logger.info('Tagging album "{} - {}"'.format(album.artist, album.title))
-
-            tagHandler = TagHandler(album, tagger_config)
-
-            taggerUtils = TaggerUtils(source_dir, destdir, tagger_config, album)
-
-            fileHandler = FileHandler(album, tagger_config)
-
-            try:
-                taggerUtils._get_target_list()
-            except TaggerError as te:
-                msg = "Error during Tagging ({0}), {1}: {2}".format(releaseid, source_dir, te)
-                logger.error(msg)
-                discs_with_errors.append(msg)
-                continue
-
-            tagHandler.tag_album()
-            taggerUtils.gather_addional_properties()
-            # reset the target directory now that we have discogs metadata and
-            #  filedata - otherwise this is declared too early in the process
-            album.target_dir = taggerUtils.dest_dir_name
-
-            fileHandler.copy_files()
-
-            logger.debug("Tagging files")
-
-            # Do replaygain analysis before copying other files, the directory
-            #  contents are cleaner, less prone to mistakes
-            if options.replaygain:
-                logger.debug("Add ReplayGain tags (if requested)")
-                fileHandler.add_replay_gain_tags()
-
-            logger.debug("Copy other interesting files (on request)")
-            fileHandler.copy_other_files()
-
-            logger.debug("Downloading and storing images")
-            fileHandler.get_images(connector)
-
-            logger.debug("Embedding Albumart")
-            fileHandler.embed_coverart_album()
-
+                return func(job)
+            finally:
+                job.timings.append((stage, time.time() - started))
+        return run
+
+    def resolve(self, job):
+        """ determines the release id of the source directory """
+        self.touched = self.touched + 1
+
+        done_file = self.tagger_config.get("details", "done_file")
+        done_file_path = os.path.join(job.source_dir, done_file)
+
+        if os.path.exists(done_file_path) and not options.forceUpdate:
+            logger.warn('Do not read {}, because {} exists and forceUpdate is false'.format(job.source_dir, done_file))
+            return None
+
+        # the album specific options are read into an overlay of the
+        # configuration, so that they are reset for each album
+        job.tagger_config = self.tagger_config.overlay()
+
+        if options.releaseid is not None:
+            job.releaseid = options.releaseid
+        else:
+            # the album specific options of the id file are read into the
+            # configuration of this album only
+            job.releaseid = FileUtils(job.tagger_config, options).read_id_file(job.source_dir, id_file, options)
+
+        job.session = MediaSession.from_config(job.tagger_config)
+        if not job.releaseid:
+            searchParams = self.discogsSearch.getSearchParams(job.source_dir, job.session)
+            # release = discogsSearch.search_discogs(searchParams)
+            release = self.discogsSearch.search_discogs()
+            # reuse the Discogs Release class, it saves re-fetching later
+            if release is not None and type(release).__name__ in ('Release', 'Version'):
+                job.releaseid = release.id
+                job.release = release
+                job.connector = self.discogs_connector
+
+        if not job.releaseid:
+            logger.warn('No releaseid for {}'.format(job.source_dir))
+            return None
+
+        # if not releaseid:
+        #     p.error("Please specify the discogs.com releaseid ('-r')")
+
+        logger.info('Found release ID: {} for source dir: {}'.format(job.releaseid, job.source_dir))
+
+        # read destination directory
+        # !TODO if both are the same, we are not copying anything,
+        # this should be "configurable"
+        if not options.destdir:
+            job.destdir = job.source_dir
+        else:
+            job.destdir = options.destdir
+            logger.debug('destdir set to {}'.format(options.destdir))
+
+        logger.info('Using destination directory: {}'.format(job.destdir))
+        return job
+
+    def fetch(self, job):
+        """ fetches the release from discogs (or the local source) """
+        if job.release is None:
+            #! TODO this is dirty, refactor it to be able to reuse it for later enhancements
+            if job.tagger_config.get("source", "name") == "local":
+                job.release = self.local_discogs_connector.fetch_release(job.releaseid, job.source_dir)
+                job.connector = self.local_discogs_connector
+            else:
+                job.release = self.discogs_connector.fetch_release(job.releaseid)
+                job.connector = self.discogs_connector
+        return job
+
+    def map(self, job):
+        """ maps the release to the album and the source files to the tracks """
+        logger.debug("starting tagging...")
+        discogs_album = DiscogsAlbum(job.release)
+        job.album = discogs_album.map()
+
+        logger.info('Tagging album "{} - {}"'.format(job.album.artist, job.album.title))
+
+        job.tagHandler = TagHandler(job.album, job.tagger_config, job.session, options.replaygain)
+        job.taggerUtils = TaggerUtils(job.source_dir, job.destdir, job.tagger_config, job.album, job.session)
+        job.fileHandler = FileHandler(job.album, job.tagger_config, job.session)
+
+        job.taggerUtils._get_target_list()
+        return job
+
+    def tag(self, job):
+        """ plans the tags and copies the files to the target directory (the
+            audio files are copied by the art stage, if tag_while_copy is set)
+        """
+        job.tagHandler.tag_album()
+        job.taggerUtils.gather_addional_properties()
+        # reset the target directory now that we have discogs metadata and
+        #  filedata - otherwise this is declared too early in the process
+        job.album.target_dir = job.taggerUtils.dest_dir_name
+
+        # the other files are copied before the images are downloaded, the
+        # downloaded images (e.g. folder.jpg) replace the copied ones
+        logger.debug("Copy other interesting files (on request)")
+        job.fileHandler.copy_other_files()
+
+        # the images are downloaded in the background, while the files
+        # are copied
+        logger.debug("Downloading and storing images")
+        job.fileHandler.get_images(job.connector)
+
+        job.fileHandler.copy_files(defer=job.tagger_config.getboolean("details", "tag_while_copy"))
+        return job
+
+    def art(self, job):
+        """ writes the tags including the downloaded cover art, every file
+            is saved once
+        """
+        job.fileHandler.wait_for_images()
+
+        logger.debug("Embedding Albumart")
+        imgdata = job.fileHandler.load_coverart()
+        if imgdata is not None:
+            job.tagHandler.add_art(imgdata)
+
+        logger.debug("Tagging files")
+        job.tagHandler.write_album(job.fileHandler)
+        logger.info("Wrote {0} bytes for {1}".format(
+                    job.fileHandler.bytes_copied + job.tagHandler.bytes_written, job.album.target_dir))
+        # all files are read and written
+        job.session.flush(job.album.target_dir)
+        return job
+
+    def loudness(self, job):
+        """ adds the replaygain tags """
+        # the replaygain tools process the audio files (by their extension)
+        #  only, the other files copied by the tag stage are not touched
+        if options.replaygain and job.tagHandler.has_replaygain():
+            logger.debug("ReplayGain tags of the source files are kept")
+        elif options.replaygain:
+            logger.debug("Add ReplayGain tags (if requested)")
+            job.fileHandler.add_replay_gain_tags()
+        return job
+
+    def finalize(self, job):
+        """ creates the playlist, the nfo and the done file """
         # !TODO make this more generic to use different templates and files,
         # furthermore adopt to reflect multi-disc-albums
-            logger.debug("Generate m3u")
-            taggerUtils.create_m3u(album.target_dir)
+        logger.debug("Generate m3u")
+        job.taggerUtils.create_m3u(job.album.target_dir)
 
-            logger.debug("Generate nfo")
-            taggerUtils.create_nfo(album.target_dir)
+        logger.debug("Generate nfo")
+        job.taggerUtils.create_nfo(job.album.target_dir)
 
-            fileHandler.create_done_file()
-        except Exception as ex:
-            if releaseid:
-                msg = "Error during tagging ({0}), {1}: {2}".format(releaseid, source_dir, ex)
-            else:
-                msg = "Error during tagging (no relid) {0}: {1}".format(source_dir, ex)
-            logger.error(msg)
-            discs_with_errors.append(msg)
-            continue
+        job.fileHandler.create_done_file()
+
+        job.timings.append(("render", job.taggerUtils.render_seconds))
+        logger.info("Timings of {0}: {1}".format(job.album.target_dir, ", ".join(
+                    "{0} {1:.3f}s".format(stage, seconds) for stage, seconds in job.timings)))
 
         # !TODO - make this a check during the taggerutils run
         # ensure we were able to map the release appropriately.
@@ -238,67 +338,147 @@ def processSourceDirs(source_dirs, tagger_config):
         #    logger.error("Unable to match file list to discogs release '%s'" %
         #                  releaseid)
         #    sys.exit()
-        converted_discs = converted_discs + 1
-        logger.info("Converted %d/%d" % (converted_discs, len(source_dirs)))
+        with self._lock:
+            self.converted_discs = self.converted_discs + 1
+            converted = self.converted_discs
+        if self.progress is not None:
+            with self.progress.get_lock():
+                self.progress.value = self.progress.value + 1
+                converted = self.progress.value
+        if self.total:
+            logger.info("Converted %d/%d" % (converted, self.total))
+        else:
+            logger.info("Converted %d" % converted)
+        return job
+
+    def error(self, job, stage, ex):
+        """ collects the errors of the single albums for the summary """
+        if isinstance(ex, AlbumError):
+            msg = "Error during mapping ({0}), {1}: {2}".format(job.releaseid, job.source_dir, ex)
+        elif isinstance(ex, TaggerError):
+            msg = "Error during Tagging ({0}), {1}: {2}".format(job.releaseid, job.source_dir, ex)
+        elif job.releaseid:
+            msg = "Error during tagging ({0}), {1}: {2}".format(job.releaseid, job.source_dir, ex)
+        else:
+            msg = "Error during tagging (no relid) {0}: {1}".format(job.source_dir, ex)
+        logger.error(msg)
+
+        # do not leave pending image downloads behind
+        if job.fileHandler is not None:
+            job.fileHandler.wait_for_images()
+
+        with self._lock:
+            self.discs_with_errors.append(msg)
+
+def tagSourceDirs(source_dirs, tagger_config, total=None, progress=None):
+    """ tags the given source directories (any iterable, the tagging starts
+        with the first directory) in this process, returns the number of
+        converted discs, the errors and the number of touched directories
+    """
+    processor = AlbumProcessor(tagger_config, total, progress)
+    pipeline = Pipeline(processor.stages(tagger_config),
+                        tagger_config.getint("pipeline", "queue_size"),
+                        processor.error)
+
+    pipeline.run(AlbumJob(source_dir) for source_dir in source_dirs)
+
+    pipeline.log_summary()
+    # the rate limiter is shared by all connectors
+    processor.discogs_connector.rate_limiter.log_summary()
+
+    return processor.converted_discs, processor.discs_with_errors, processor.touched
+
+# shared between the worker processes, set by initWorker
+worker_progress = None
+worker_total = None
+
+def initWorker(progress, total):
+    global worker_progress, worker_total
+    worker_progress = progress
+    worker_total = total
+    # the connections of the parent process must not be reused
+    DiscogsConnector.reset_shared()
+
+def tagInWorker(source_dir):
+    try:
+        return tagSourceDirs([source_dir], tagger_config, worker_total, worker_progress)
+    except Exception as ex:
+        msg = "Error in worker process ({0}): {1}".format(source_dir, ex)
+        logger.error(msg)
+        return 0, [msg], 1
+
+def processInWorkers(source_dirs, tagger_config, workers):
+    """ spreads the source directories over a pool of worker processes, the
+        workers take the next album as soon as they are done with the last
+        one (each album runs through a pipeline of its own). The rate limit
+        is shared by all workers using the shared state file of the rate
+        limiter.
+    """
+    if not tagger_config.get("ratelimit", "shared_state_file"):
+        cache_dir = os.path.expanduser(tagger_config.get("cache", "cache_dir"))
+        tagger_config.set("ratelimit", "shared_state_file", os.path.join(cache_dir, "ratelimit.json"))
+
+    # authenticate once (this might be interactive) before the workers are
+    # started, the workers use the stored token
+    DiscogsConnector(tagger_config)
+
+    workers = min(workers, len(source_dirs))
+    logger.info("Using {0} worker processes".format(workers))
+
+    converted_discs = 0
+    discs_with_errors = []
+    touched = 0
+
+    # fork, the workers need the options and configuration of this process
+    context = multiprocessing.get_context("fork")
+    progress = context.Value('i', 0)
+    with context.Pool(workers, initWorker, (progress, len(source_dirs))) as pool:
+        for converted, errors, touched_dirs in pool.imap_unordered(tagInWorker, source_dirs, chunksize=1):
+            converted_discs = converted_discs + converted
+            discs_with_errors.extend(errors)
+            touched = touched + touched_dirs
+
+    return converted_discs, discs_with_errors, touched
+
+def processSourceDirs(source_dirs, tagger_config):
+    logger.info("start tagging")
+
+    if options.workers > 1:
+        # the source directories are distributed upfront
+        source_dirs = list(source_dirs)
+
+    if options.workers > 1 and len(source_dirs) > 1:
+        converted_discs, discs_with_errors, touched = processInWorkers(source_dirs, tagger_config, options.workers)
+    else:
+        converted_discs, discs_with_errors, touched = tagSourceDirs(source_dirs, tagger_config)
 
     logger.info("Tagging complete.")
     logger.info("converted successful: %d" % converted_discs)
     logger.info("converted with Errors %d" % len(discs_with_errors))
-    logger.info("releases touched: %s" % len(source_dirs))
+    logger.info("releases touched: %s" % touched)
 
     if discs_with_errors:
         logger.error("The following discs could not get converted.")
         for msg in discs_with_errors:
             logger.error(msg)
 
-def process():
-    source_dirs = getSourceDirs()
-    if len(source_dirs) > 0:
-        processSourceDirs(source_dirs, tagger_config)
-
-class DirectoryWatcher():
-
-    def __init__(self):
-        self.total_size = -1
-
-    def dir_size(self, root_dir):
-        total_size = -1
-        for (dirpath, dirs, files) in os.walk(root_dir):
-            for filename in files:
-                file_size = os.stat(os.path.join(dirpath, filename)).st_size
-                total_size += file_size
-        return total_size
-
-    def watch(self, root_dir):
-        while self.total_size != self.dir_size(root_dir):
-            self.total_size = self.dir_size(root_dir)
-            time.sleep(60)
-        # return 'Finished function'
-
-
-class MyHandler(FileSystemEventHandler):
-    def on_modified(self, event):
-        print(f'event type: {event.event_type}  path : {event.src_path}')
-        waitfor = DirectoryWatcher()
-        waitfor.watch(options.sourcedir)
-        print('Finished')
-        process()
+def processWatchedDir(album_dir):
+    """ tags the albums in the given directory, which was changed in daemon
+        mode
+    """
+    converted_discs, discs_with_errors, touched = tagSourceDirs(getSourceDirs(album_dir), tagger_config)
+    for msg in discs_with_errors:
+        logger.error(msg)
 
 
 if __name__ == "__main__":
     if options.watch == True:
         logger.info('Daemon mode')
-        event_handler = MyHandler()
-        observer = Observer()
-        observer.schedule(event_handler, path=options.sourcedir, recursive=False)
-        observer.start()
-
-        try:
-            time.sleep(1)
-        except KeyboardInterrupt:
-            observer.stop()
-        observer.join()
+        # the tagged files must not trigger the watcher, if the destination
+        # is within the source directory
+        daemon = WatchDaemon.from_config(tagger_config, options.sourcedir, processWatchedDir,
+                                         ignore_dirs=[options.destdir])
+        daemon.run()
     else:
-        source_dirs = getSourceDirs()
-        if len(source_dirs) > 0:
-            processSourceDirs(source_dirs, tagger_config)
+        # the tagging starts, while the source directory is still scanned
+        processSourceDirs(getSourceDirs(), tagger_config)
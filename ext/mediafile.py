@@ -40,6 +40,7 @@ import mutagen.id3
 import mutagen.mp4
 import mutagen.flac
 import mutagen.asf
+import mutagen._vorbis
 
 import codecs
 import datetime
@@ -49,14 +50,16 @@ import binascii
 import math
 import struct
 import imghdr
+import io
 import os
+import threading
 import traceback
 import enum
 import logging
 import six
 
 
-__all__ = ['UnreadableFileError', 'FileTypeError', 'MediaFile']
+__all__ = ['UnreadableFileError', 'FileTypeError', 'MediaFile', 'PaddingPolicy']
 
 log = logging.getLogger(__name__)
 
@@ -137,6 +140,138 @@ def mutagen_call(action, path, func, *args, **kwargs):
         raise MutagenError(path, exc)
 
 
+class PaddingPolicy(object):
+    """A padding callback for Mutagen's `save`, which avoids rewriting
+    the whole file whenever possible.
+
+    If the new tags fit into the existing padding, the remaining padding is
+    kept as it is (Mutagen's default would shrink a large padding, which
+    moves the audio data as well). Otherwise the file has to be rewritten
+    anyway and `reserve` bytes of padding are added, so later changes (e.g.
+    a larger cover) can be written in place.
+
+    The number of saves written in place and of full rewrites is counted.
+    """
+    def __init__(self, reserve=64 * 1024):
+        self.reserve = reserve
+        self.in_place = 0
+        self.rewrites = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, info):
+        with self._lock:
+            if info.padding >= 0:
+                self.in_place += 1
+                return info.padding
+            self.rewrites += 1
+            return self.reserve
+
+    def initial(self, info):
+        """The padding of a newly written file (nothing is counted).
+        """
+        return self.reserve
+
+
+def _open_flac_without_pictures(path):
+    """Open a FLAC file with Mutagen, without reading the picture blocks
+    (they are skipped on disk). Returns None, if the file is not a FLAC
+    file or cannot be read this way.
+    """
+    with open(path, 'rb') as fh:
+        offset = 0
+        header = fh.read(10)
+        if len(header) == 10 and header[:3] == b'ID3':
+            # an ID3v2 tag in front of the FLAC stream
+            for byte in bytearray(header[6:10]):
+                offset = (offset << 7) | (byte & 0x7f)
+            offset += 20 if bytearray(header)[5] & 0x10 else 10
+        fh.seek(offset)
+        if fh.read(4) != b'fLaC':
+            return None
+
+        blocks = []
+        last = False
+        while not last:
+            header = bytearray(fh.read(4))
+            if len(header) < 4:
+                return None
+            code = header[0] & 0x7f
+            last = bool(header[0] & 0x80)
+            size = struct.unpack('>I', b'\x00' + bytes(header[1:]))[0]
+            if code == mutagen.flac.Picture.code:
+                fh.seek(size, os.SEEK_CUR)
+            else:
+                blocks.append((code, fh.read(size)))
+        audio_start = fh.tell()
+        fh.seek(0, os.SEEK_END)
+        audio_size = fh.tell() - audio_start
+
+    data = [b'fLaC']
+    for no, (code, block) in enumerate(blocks):
+        if no == len(blocks) - 1:
+            code |= 0x80
+        data.append(struct.pack('>I', (code << 24) | len(block)))
+        data.append(block)
+    mgfile = mutagen.flac.FLAC(io.BytesIO(b''.join(data)))
+
+    # The audio is missing in the buffer.
+    if mgfile.info.length:
+        mgfile.info.bitrate = int(float(audio_size) * 8 / mgfile.info.length)
+    return mgfile
+
+
+def _drop_pictures(mgfile):
+    """Remove the pictures from the tags of a loaded Mutagen file (in
+    memory), the picture data is released this way.
+    """
+    tags = mgfile.tags
+    if isinstance(tags, mutagen.id3.ID3):
+        tags.delall('APIC')
+    elif isinstance(tags, mutagen._vorbis.VComment):
+        for key in ('metadata_block_picture', 'coverart', 'coverartmime'):
+            if key in tags:
+                del tags[key]
+    elif isinstance(tags, mutagen.mp4.MP4Tags):
+        tags.pop('covr', None)
+    elif isinstance(tags, mutagen.asf.ASFTags):
+        if 'WM/Picture' in tags:
+            del tags['WM/Picture']
+    if hasattr(mgfile, 'clear_pictures'):
+        mgfile.clear_pictures()
+
+
+class _TagSnapshot(object):
+    """A read-only view of a Mutagen file, whose Vorbis comments are
+    indexed once. Mutagen's Vorbis comment dictionary scans the complete
+    list of comments on every lookup, reading many fields this way costs a
+    pass over the comments per field.
+
+    Everything else is passed to the wrapped file, it even reports the
+    class of the wrapped file, which selects the storage styles.
+    """
+    def __init__(self, mgfile):
+        self._mgfile = mgfile
+        self._index = {}
+        for key, value in mgfile.tags:
+            self._index.setdefault(key.lower(), []).append(value)
+
+    @property
+    def __class__(self):
+        return self._mgfile.__class__
+
+    def __getitem__(self, key):
+        try:
+            return self._index[key.lower()]
+        except KeyError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key.lower() in self._index
+
+    def __getattr__(self, name):
+        return getattr(self._mgfile, name)
+
+
 # Utility.
 
 def _safe_cast(out_type, val):
@@ -1182,14 +1317,22 @@ class MediaField(object):
         """
         self.out_type = kwargs.get('out_type', six.text_type)
         self._styles = styles
+        # Mutagen class -> the styles handling this format, resolved on
+        # first access instead of on every get and set.
+        self._class_styles = {}
 
     def styles(self, mutagen_file):
-        """Yields the list of storage styles of this field that can
+        """Returns the list of storage styles of this field that can
         handle the MediaFile's format.
         """
-        for style in self._styles:
-            if mutagen_file.__class__.__name__ in style.formats:
-                yield style
+        cls = mutagen_file.__class__
+        try:
+            return self._class_styles[cls]
+        except KeyError:
+            styles = tuple(style for style in self._styles
+                           if cls.__name__ in style.formats)
+            self._class_styles[cls] = styles
+            return styles
 
     def __get__(self, mediafile, owner=None):
         out = None
@@ -1458,6 +1601,21 @@ class ImageListField(ListMediaField):
             out_type=Image,
         )
 
+    # The pictures of files opened without pictures are loaded on the
+    # first access.
+
+    def __get__(self, mediafile, owner=None):
+        mediafile._load_pictures()
+        return super(ImageListField, self).__get__(mediafile, owner)
+
+    def __set__(self, mediafile, values):
+        mediafile._load_pictures()
+        super(ImageListField, self).__set__(mediafile, values)
+
+    def __delete__(self, mediafile):
+        mediafile._load_pictures()
+        super(ImageListField, self).__delete__(mediafile)
+
 
 # MediaFile is a collection of fields.
 
@@ -1465,16 +1623,37 @@ class MediaFile(object):
     """Represents a multimedia file on disk and provides access to its
     metadata.
     """
-    def __init__(self, path, id3v23=False):
+    def __init__(self, path, id3v23=False, pictures=True):
         """Constructs a new `MediaFile` reflecting the file at path. May
         throw `UnreadableFileError`.
 
         By default, MP3 files are saved with ID3v2.4 tags. You can use
         the older ID3v2.3 standard by specifying the `id3v23` option.
+
+        `path` might be a file-like object as well (e.g. the header of a
+        file read into a `BytesIO`), the tags are written back into it.
+
+        If `pictures` is False, the embedded pictures are not loaded
+        (FLAC picture blocks are not even read) until `art` or `images`
+        is accessed. Such a `MediaFile` is read-only.
         """
         self.path = path
+        self._fileobj = path if hasattr(path, 'read') else None
+        self._cleared = False
+        self._pictures = pictures or self._fileobj is not None
+        self._pictures_loaded = self._pictures
 
-        self.mgfile = mutagen_call('open', path, mutagen.File, path)
+        self.mgfile = None
+        if not self._pictures:
+            try:
+                self.mgfile = _open_flac_without_pictures(path)
+            except Exception as exc:
+                log.debug(u'unable to skip the pictures of %s: %s', path, exc)
+        if self.mgfile is None:
+            self.mgfile = mutagen_call('open', path, mutagen.File,
+                                       *(self._filething() or (path,)))
+            if not self._pictures:
+                _drop_pictures(self.mgfile)
 
         if self.mgfile is None:
             # Mutagen couldn't guess the type
@@ -1515,12 +1694,24 @@ class MediaFile(object):
         # Set the ID3v2.3 flag only for MP3s.
         self.id3v23 = id3v23 and self.type == 'mp3'
 
-    def save(self):
+    def save(self, padding=None):
         """Write the object's tags back to the file. May
         throw `UnreadableFileError`.
+
+        `padding` is a callback deciding on the padding left behind the
+        tags (see `PaddingPolicy`), it is ignored for formats without
+        padding (APEv2 tags).
         """
+        if not self._pictures:
+            raise UnreadableFileError(self.path, u'opened without pictures, read-only')
+
         # Possibly save the tags to ID3v2.3.
         kwargs = {}
+        if padding is not None and self.type not in ('ape', 'wv', 'mpc'):
+            kwargs['padding'] = padding
+        if self._cleared and self.type == 'mp3':
+            # remove an ID3v1 tag as well
+            kwargs['v1'] = 0
         if self.id3v23:
             id3 = self.mgfile
             if hasattr(id3, 'tags'):
@@ -1529,13 +1720,45 @@ class MediaFile(object):
             id3.update_to_v23()
             kwargs['v2_version'] = 3
 
-        mutagen_call('save', self.path, self.mgfile.save, **kwargs)
+        mutagen_call('save', self.path, self.mgfile.save, *self._filething(), **kwargs)
 
     def delete(self):
         """Remove the current metadata tag from the file. May
         throw `UnreadableFileError`.
         """
-        mutagen_call('delete', self.path, self.mgfile.delete)
+        if not self._pictures:
+            raise UnreadableFileError(self.path, u'opened without pictures, read-only')
+        mutagen_call('delete', self.path, self.mgfile.delete, *self._filething())
+
+    def _load_pictures(self):
+        """Load the complete file, if it was opened without pictures.
+        """
+        if self._pictures_loaded:
+            return
+        self.mgfile = mutagen_call('open', self.path, mutagen.File, self.path)
+        if self.mgfile.tags is None:
+            self.mgfile.add_tags()
+        self._pictures_loaded = True
+
+    def clear(self):
+        """Remove all tags in memory, unlike `delete` the file is not
+        touched until `save` is called (this way the tags are not written
+        twice and the padding is kept). Like `delete`, the pictures of
+        FLAC files (stored outside of the tags) are kept.
+        """
+        tags = self.mgfile.tags
+        if tags is not None:
+            tags.clear()
+        self._cleared = True
+
+    def _filething(self):
+        """The positional arguments telling Mutagen where to write to,
+        Mutagen only remembers file names, not file objects.
+        """
+        if self._fileobj is None:
+            return ()
+        self._fileobj.seek(0)
+        return (self._fileobj,)
 
     # Convenient access to the set of available fields.
 
@@ -1625,6 +1848,55 @@ class MediaFile(object):
                 else:
                     setattr(self, field, dict[field])
 
+    def as_dict(self, fields=None):
+        """Read several fields at once and return a dictionary mapping
+        the field names to their values.
+
+        `fields` are names of fields and audio properties (see
+        :meth:`readable_fields`), all readable fields by default. The
+        tags are read in a single pass (Vorbis comments are indexed
+        once instead of being scanned for every field).
+        """
+        if fields is None:
+            fields = self.readable_fields()
+
+        mgfile = self.mgfile
+        if isinstance(mgfile.tags, mutagen._vorbis.VComment):
+            self.mgfile = _TagSnapshot(mgfile)
+        try:
+            return dict((name, getattr(self, name)) for name in fields)
+        finally:
+            if isinstance(self.mgfile, _TagSnapshot):
+                # otherwise the pictures were loaded in the meantime
+                self.mgfile = mgfile
+
+    @classmethod
+    def read_many(cls, paths, fields=None, pictures=True):
+        """Read the given fields (see :meth:`as_dict`) of several files,
+        returns a list of dictionaries, which contain the `type` of the
+        file as well. See :meth:`__init__` for `pictures`.
+        """
+        result = []
+        for path in paths:
+            mediafile = cls(path, pictures=pictures)
+            values = mediafile.as_dict(fields)
+            values['type'] = mediafile.type
+            result.append(values)
+        return result
+
+    def apply(self, values, clear=True):
+        """Replace the tags with the values of the given dictionary in a
+        single call, the fields are set in the order they should be written
+        (see :meth:`sorted_fields`). All other tags are removed (in memory,
+        see :meth:`clear`), unless `clear` is False. Call :meth:`save` to
+        write the tags.
+        """
+        if clear:
+            self.clear()
+        for field in self.sorted_fields():
+            if field in values:
+                setattr(self, field, values[field])
+
     # Field definitions.
 
     title = MediaField(
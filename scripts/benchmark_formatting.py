@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+""" measures the time per track to build a file name from the format
+    strings, substituting the placeholders and parsing the result on every
+    call (before) and using the compiled format strings (after)
+"""
+import os, sys
+import re
+import timeit
+
+from optparse import OptionParser
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.tagger_config import TaggerConfig
+from discogstagger.stringformatting import StringFormatting
+
+# the foobar2000 like format of the StringFormatting docstring
+EXAMPLE = "%albumartist%/[%year%] %album%$if1($strcmp('%totaldiscs%',''),'',$ifgreater('%totaldiscs%', 1,'/CD %discnumber%',''))$if1($strcmp('%disctitle%',''),'',', %disctitle%')/$num('%track%','2') $if1($strcmp('%artist%','%albumartist%'),'','%artist% - ')%title%%fileext%"
+
+VALUES = {
+    '%albumartist%': 'Various Artists', '%ALBARTIST%': 'Various',
+    '%album%': 'Modern EBM', '%ALBTITLE%': 'Modern EBM',
+    '%year%': '2016', '%YEAR%': '2016', '%CATNO%': 'CD 1234',
+    '%artist%': 'Advance', '%ARTIST%': 'Advance',
+    '%title%': 'Dead technology', '%TITLE%': 'Dead technology',
+    '%track%': '5', '%TRACKNO%': '05', '%totaldiscs%': '2', '%discnumber%': '1',
+    '%disctitle%': 'Bonus tracks', '%fileext%': '.flac', '%TYPE%': '.flac',
+}
+
+def legacy_parse(formatting, string):
+    """ the former StringFormatting.parseString (walking the characters,
+        evaluating the functions using eval)
+    """
+    output = ''
+    command = ''
+    hierarchy = 0
+    lastchar = ''
+    for c in string:
+        if c == '$':
+            hierarchy = hierarchy + 1
+            command += c
+        elif re.search(r'\(', c) and lastchar != '\\':
+            command += c
+        elif re.search(r'\)', c) and lastchar != '\\':
+            hierarchy = hierarchy -1
+            command += c
+            if hierarchy == 0:
+                for match in re.findall(r'(\$[a-z0-9_]+)\(', command):
+                    if match not in formatting.functions:
+                        return 'unknown command'
+                output += eval(re.sub(r'\$', 'formatting.', command))
+                command = ''
+        elif hierarchy > 0:
+            command += c
+        else:
+            output += c
+        lastchar = c
+    return output
+
+def before(formatting, format):
+    for hashtag in VALUES:
+        format = format.replace(hashtag, re.escape(str(VALUES[hashtag])))
+    return legacy_parse(formatting, format)
+
+def after(formatting, format):
+    return formatting.parseString(format, VALUES)
+
+def measure(function, format, number):
+    formatting = StringFormatting()
+    seconds = min(timeit.repeat(lambda: function(formatting, format), number=number, repeat=3))
+    return seconds / number * 1e9
+
+parser = OptionParser(usage="usage: %prog [options]")
+parser.add_option("-n", "--number", type="int", dest="number", default=10000,
+                  help="number of tracks")
+parser.add_option("-c", "--conf", dest="conffile", default=os.path.join(parentdir, "conf", "default.conf"),
+                  help="the configuration containing the song and dir formats")
+(options, args) = parser.parse_args()
+
+config = TaggerConfig(options.conffile)
+formats = [("song", config.get("file-formatting", "song")),
+           ("dir", config.get("file-formatting", "dir")),
+           ("example", EXAMPLE)]
+
+for name, format in formats:
+    ns_before = measure(before, format, options.number)
+    ns_after = measure(after, format, options.number)
+    print("%s (%s): %.0f ns per track before, %.0f ns after (%.1fx)" % (
+          name, format, ns_before, ns_after, ns_before / ns_after))
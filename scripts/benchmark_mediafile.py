@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+""" measures the overhead of reading and writing the MediaFile fields (in
+    memory, nothing is saved) with the storage styles resolved on every
+    access (before) and resolved once per mutagen class (after)
+"""
+import os, sys
+import timeit
+
+from optparse import OptionParser
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from ext.mediafile import MediaFile, MediaField
+
+# the fields set by TagHandler.tag_single_track
+FIELDS = ['album', 'composer', 'albumartist', 'albumartist_sort', 'label',
+          'year', 'country', 'catalognum', 'groupings', 'genres',
+          'disctitle', 'disc', 'disctotal', 'media', 'comp', 'comments',
+          'title', 'artists', 'artist', 'artist_sort', 'track', 'tracktotal']
+FIELDS = [name for name in FIELDS if name in set(MediaFile.fields())]
+
+def uncached_styles(self, mutagen_file):
+    for style in self._styles:
+        if mutagen_file.__class__.__name__ in style.formats:
+            yield style
+
+def access_fields(metadata):
+    for name in FIELDS:
+        setattr(metadata, name, getattr(metadata, name))
+
+# the fields with storage styles of their own (e.g. not year, which is
+# a part of the date field)
+STYLED_FIELDS = [MediaFile.__dict__[name] for name in FIELDS
+                 if hasattr(MediaFile.__dict__[name], '_styles')]
+
+def resolve_styles(metadata):
+    for field in STYLED_FIELDS:
+        for style in field.styles(metadata.mgfile):
+            pass
+
+def measure_resolve(metadata, number):
+    seconds = min(timeit.repeat(lambda: resolve_styles(metadata), number=number, repeat=3))
+    return seconds / (number * len(STYLED_FIELDS)) * 1e6
+
+def measure(metadata, number):
+    seconds = min(timeit.repeat(lambda: access_fields(metadata), number=number, repeat=3))
+    # one get and one set per field
+    return seconds / (number * len(FIELDS) * 2) * 1e6
+
+parser = OptionParser(usage="usage: %prog [options] audio-file ...")
+parser.add_option("-n", "--number", type="int", dest="number", default=1000,
+                  help="number of passes over all fields")
+(options, args) = parser.parse_args()
+
+if not args:
+    args = [os.path.join(parentdir, "test", "files", name) for name in ("test.flac", "test.mp3")]
+
+cached_styles = MediaField.styles
+
+for path in args:
+    metadata = MediaFile(path)
+
+    MediaField.styles = uncached_styles
+    before = measure(metadata, options.number)
+    resolve_before = measure_resolve(metadata, options.number)
+    MediaField.styles = cached_styles
+    after = measure(metadata, options.number)
+    resolve_after = measure_resolve(metadata, options.number)
+
+    print("%s (%s): %.2f us per field access before, %.2f us after (%.1fx)" % (
+          os.path.basename(path), metadata.type, before, after, before / after))
+    print("%s (%s): %.2f us per style resolution before, %.2f us after (%.1fx)" % (
+          os.path.basename(path), metadata.type, resolve_before, resolve_after,
+          resolve_before / resolve_after))
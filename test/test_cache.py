@@ -0,0 +1,128 @@
+import os, sys
+import shutil
+import tempfile
+import time
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.cache import ReleaseCache, ImageStore
+
+def test_release_cache_get_put():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ReleaseCache(cache_dir)
+
+        assert cache.get(1448190) is None
+
+        cache.put(1448190, {"id": 1448190, "title": "Megahits 2001 Die Erste"})
+
+        assert 1448190 in cache
+        assert cache.get("1448190")["title"] == "Megahits 2001 Die Erste"
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+        # the cache is persistent
+        cache.close()
+        cache = ReleaseCache(cache_dir)
+        assert cache.get(1448190)["id"] == 1448190
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_release_cache_ttl():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ReleaseCache(cache_dir, ttl=1)
+        cache.put(3083, {"id": 3083})
+
+        assert cache.get(3083) is not None
+
+        cache._db.execute("UPDATE releases SET fetched = ?", (time.time() - 10,))
+
+        assert cache.get(3083) is None
+        assert cache.get(3083, allow_stale=True) is not None
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_release_cache_eviction():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ReleaseCache(cache_dir, max_size=120)
+        cache.put(1, {"id": 1, "notes": "x" * 30})
+        cache.put(2, {"id": 2, "notes": "x" * 30})
+
+        # make the second release the least recently used one
+        cache._db.execute("UPDATE releases SET accessed = 0 WHERE id = 2")
+        cache.put(3, {"id": 3, "notes": "x" * 30})
+
+        assert 1 in cache
+        assert 2 not in cache
+        assert 3 in cache
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_image_store():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        store = ImageStore(cache_dir)
+
+        assert store.lookup("https://i.discogs.com/R-1.jpg") is None
+
+        for name in ("first", "second"):
+            with open(os.path.join(cache_dir, name), "wb") as fh:
+                fh.write(b"image-data")
+
+        # two urls pointing to the same content share one stored image
+        path = store.add("https://i.discogs.com/R-1.jpg", os.path.join(cache_dir, "first"))
+        assert store.add("https://i.discogs.com/R-2.jpg", os.path.join(cache_dir, "second")) == path
+        assert not os.path.exists(os.path.join(cache_dir, "second"))
+        assert store.lookup("https://i.discogs.com/R-2.jpg") == path
+
+        target = os.path.join(cache_dir, "folder.jpg")
+        store.place(path, target)
+        with open(target, "rb") as fh:
+            assert fh.read() == b"image-data"
+        assert os.stat(target).st_ino != os.stat(path).st_ino
+
+        # writing the album file does not change the stored image
+        with open(target, "wb") as fh:
+            fh.write(b"other")
+        assert store.lookup("https://i.discogs.com/R-1.jpg") == path
+
+        # a corrupted image is not served again
+        with open(path, "wb") as fh:
+            fh.write(b"corrupted")
+        assert store.lookup("https://i.discogs.com/R-1.jpg") is None
+        assert store.lookup("https://i.discogs.com/R-2.jpg") is None
+        assert not os.path.exists(path)
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_image_store_eviction():
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        store = ImageStore(cache_dir, max_size=25)
+
+        for no in range(3):
+            source = os.path.join(cache_dir, "image-%d" % no)
+            with open(source, "wb") as fh:
+                fh.write(str(no).encode() * 10)
+            path = store.add("https://i.discogs.com/R-%d.jpg" % no, source)
+            store._db.execute("UPDATE blobs SET accessed = ? WHERE hash = ?",
+                              (no, os.path.basename(path)))
+
+        # the oldest image is evicted, the others fit into the store
+        assert store.lookup("https://i.discogs.com/R-0.jpg") is None
+        assert store.lookup("https://i.discogs.com/R-1.jpg") is not None
+        assert store.lookup("https://i.discogs.com/R-2.jpg") is not None
+    finally:
+        shutil.rmtree(cache_dir)
@@ -79,19 +79,23 @@ def test_overload_config():
 
 def test_get_character_exceptions():
 
+    config = TaggerConfig(os.path.join(parentdir, "test/empty.conf"))
+
+    # no characters are replaced by default
+    assert config.get_character_exceptions == {}
+
     config = TaggerConfig(os.path.join(parentdir, "test/test_values.conf"))
 
-    assert len(config.get_character_exceptions) == 10
+    assert len(config.get_character_exceptions) == 2
     assert config.get_character_exceptions[" "] == "_"
-    assert config.get_character_exceptions["\xc3\xb6"] == "oe"
-
+    assert config.get_character_exceptions["ö"] == "oe"
 
-    config = TaggerConfig(os.path.join(parentdir, "test/track_values.conf"))
+    config.read(os.path.join(parentdir, "test/track_values.conf"))
 
     logger.debug("config: %s" % config.get_character_exceptions)
 
-    assert len(config.get_character_exceptions) == 11
-    assert config.get_character_exceptions["\xc3\xa2"] == "a"
+    assert len(config.get_character_exceptions) == 3
+    assert config.get_character_exceptions["â"] == "a"
 
 def test_get_configured_tags():
 
@@ -102,3 +106,39 @@ def test_get_configured_tags():
     assert config.get_configured_tags["year"] == "1901"
     assert config.get_configured_tags["title"] == "Title"
     assert config.get_configured_tags["encoder"] == ""
+
+def test_overlay():
+
+    config = TaggerConfig(os.path.join(parentdir, "conf/discogs_tagger_sjb.conf"))
+    config.read(os.path.join(parentdir, "test/test_values.conf"))
+    settings = config.settings
+
+    assert ("title", "Title") in settings.tags
+    assert "encoder" not in dict(settings.tags)
+
+    overlay = config.overlay()
+    assert overlay.settings is settings
+    # the values of the base configuration are used without reading an id file
+    base = TaggerConfig(os.path.join(parentdir, "conf/discogs_tagger_sjb.conf"))
+    base.read(os.path.join(parentdir, "test/test_values.conf"))
+    overlay = base.overlay()
+    assert overlay.settings.tags == (("title", "Title"), ("year", "1901"))
+    assert overlay.get_configured_tags == {"title": "Title", "year": "1901", "encoder": ""}
+    assert overlay.get_character_exceptions == {" ": "_", "ö": "oe"}
+
+    overlay = config.overlay()
+
+    overlay.read(os.path.join(parentdir, "test/track_values.conf"))
+    overlay.set("source", "name", "amg")
+
+    assert overlay.get("tags", "encoder") == "myself"
+    assert dict(overlay.settings.tags)["encoder"] == "myself"
+    assert overlay.settings.id_tag_name == "amg_id"
+    assert overlay.getboolean("details", "use_style")
+
+    # the base configuration is unchanged
+    assert config.get("tags", "encoder") == None
+    assert config.get("source", "name") == "discogs"
+    assert config.settings is settings
+    assert config._sections["details"] is not overlay._sections["details"]
+    assert config._sections["file-formatting"] is overlay._sections["file-formatting"]
@@ -0,0 +1,122 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+import pytest
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.copystrategy import FileCopier, same_filesystem
+
+def test_copy_strategies():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        source_file = os.path.join(target_dir, "source.flac")
+        shutil.copyfile(os.path.join(parentdir, "test", "files", "test.flac"), source_file)
+        with open(source_file, "rb") as fh:
+            content = fh.read()
+        assert same_filesystem(source_file, os.path.join(target_dir, "target.flac"))
+
+        # reflink falls back to copy_file_range (or a plain copy), if the
+        # filesystem does not support it
+        copier = FileCopier()
+        method = copier.copy(source_file, os.path.join(target_dir, "auto.flac"))
+        assert method in ("reflink", "copy_file_range", "copy")
+        assert copier.counts == {method: 1}
+
+        for strategy in ("copy", "copy_file_range", "reflink"):
+            target_file = os.path.join(target_dir, strategy + ".flac")
+            FileCopier(strategy).copy(source_file, target_file, stat=True)
+            with open(target_file, "rb") as fh:
+                assert fh.read() == content
+            assert os.stat(target_file).st_ino != os.stat(source_file).st_ino
+
+        target_file = os.path.join(target_dir, "link.jpg")
+        assert FileCopier("hardlink", allow_link=True).copy(source_file, target_file) == "hardlink"
+        assert os.stat(target_file).st_ino == os.stat(source_file).st_ino
+
+        # the source files are only moved, if rename is set explicitly
+        target_file = os.path.join(target_dir, "auto-move.flac")
+        assert FileCopier(move=True).copy(source_file, target_file) != "rename"
+        assert os.path.exists(source_file)
+
+        target_file = os.path.join(target_dir, "moved.flac")
+        assert FileCopier("rename", move=True).copy(source_file, target_file) == "rename"
+        assert not os.path.exists(source_file)
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_copy_strategy_restrictions():
+
+    with pytest.raises(ValueError):
+        FileCopier("sendfile")
+    # the audio files are modified after the copy
+    with pytest.raises(ValueError):
+        FileCopier("hardlink")
+    # the source files are kept
+    assert FileCopier("rename").strategy == "auto"
+
+def test_copy_replaces_target():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        source_file = os.path.join(target_dir, "source.jpg")
+        linked_file = os.path.join(target_dir, "linked.jpg")
+        with open(source_file, "wb") as fh:
+            fh.write(b"new image")
+        with open(linked_file, "wb") as fh:
+            fh.write(b"linked image")
+
+        # an existing target linked to another file is replaced, not written
+        # through the link
+        for strategy in ("auto", "copy", "copy_file_range", "reflink"):
+            target_file = os.path.join(target_dir, "folder.jpg")
+            os.link(linked_file, target_file)
+            FileCopier(strategy).copy(source_file, target_file)
+            with open(target_file, "rb") as fh:
+                assert fh.read() == b"new image"
+            with open(linked_file, "rb") as fh:
+                assert fh.read() == b"linked image"
+            os.remove(target_file)
+
+        # reruns (e.g. --force) replace the existing links
+        copier = FileCopier("hardlink", allow_link=True)
+        target_file = os.path.join(target_dir, "scan.jpg")
+        assert copier.copy(linked_file, target_file) == "hardlink"
+        assert copier.copy(linked_file, target_file) == "hardlink"
+        assert copier.copy(source_file, target_file) == "hardlink"
+        assert os.stat(target_file).st_ino == os.stat(source_file).st_ino
+
+        moved_file = os.path.join(target_dir, "moved.jpg")
+        assert FileCopier("rename", move=True).copy(linked_file, moved_file) == "rename"
+        assert FileCopier("rename", move=True).copy(source_file, moved_file) == "rename"
+        with open(moved_file, "rb") as fh:
+            assert fh.read() == b"new image"
+
+        assert sorted(os.listdir(target_dir)) == ["moved.jpg", "scan.jpg"]
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_copy_range_short_copy(monkeypatch):
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        source_file = os.path.join(target_dir, "source.flac")
+        shutil.copyfile(os.path.join(parentdir, "test", "files", "test.flac"), source_file)
+
+        # the filesystem stops copying before the end of the file
+        def short_copy(source, target, count):
+            return 0
+        monkeypatch.setattr(os, "copy_file_range", short_copy)
+
+        target_file = os.path.join(target_dir, "target.flac")
+        assert FileCopier("copy_file_range").copy(source_file, target_file) == "copy"
+        assert os.path.getsize(target_file) == os.path.getsize(source_file)
+    finally:
+        shutil.rmtree(target_dir)
@@ -0,0 +1,66 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.ratelimit import RateLimiter
+from discogstagger.imagefetch import ImageDownloader
+
+class DummyResponse(object):
+
+    def __init__(self, status_code, body=b'', headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception("HTTP %d" % self.status_code)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+class DummySession(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, stream=False, timeout=None):
+        self.requests.append(url)
+        return self.responses[url].pop(0)
+
+def test_image_downloader_batch():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        limiter = RateLimiter({'api': 6000, 'image': 6000}, burst=5)
+        downloader = ImageDownloader(limiter, "discogstagger-test", workers=2)
+        downloader.session = DummySession({
+            'https://i.discogs.com/R-1.jpg': [DummyResponse(429, headers={'Retry-After': '0'}),
+                                              DummyResponse(200, b'a' * 100)],
+            'https://i.discogs.com/R-2.jpg': [DummyResponse(404)],
+        })
+
+        batch = downloader.submit([('https://i.discogs.com/R-1.jpg', os.path.join(target_dir, 'folder.jpg')),
+                                   ('https://i.discogs.com/R-2.jpg', os.path.join(target_dir, 'image-01.jpg'))])
+        timings = batch.wait()
+
+        assert batch.done()
+        assert [t.ok for t in timings] == [True, False]
+        assert timings[0].size == 100
+
+        # failed downloads do not leave temporary files behind
+        assert os.listdir(target_dir) == ['folder.jpg']
+    finally:
+        shutil.rmtree(target_dir)
@@ -0,0 +1,31 @@
+import os, sys
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from ext.mediafile import MediaFile
+from discogstagger.mediasession import MediaSession
+
+def test_media_session():
+
+    paths = [os.path.join(parentdir, "test", "files", "test." + filetype)
+             for filetype in ("flac", "mp3")]
+    session = MediaSession(workers=2)
+
+    # the search reads tags and the stream information
+    infos = session.infos(paths, ('title', 'artist'))
+    assert [info.type for info in infos] == ["flac", "mp3"]
+    assert infos[0].tags == MediaFile(paths[0]).as_dict(('title', 'artist'))
+
+    # the later stages get the same files without parsing them again
+    assert session.tags(paths[1], ('track', 'rg_track_gain')) == \
+        MediaFile(paths[1]).as_dict(('track', 'rg_track_gain'))
+    assert session.metadata(paths[0]) is session.metadata(os.path.join(parentdir, "test", "..", "test",
+                                                                       "files", "test.flac"))
+    assert session.infos(paths) == [info._replace(tags=None) for info in infos]
+
+    assert session.flush("test") == {'mutagen': 2, 'probe': 2, 'target': 0}
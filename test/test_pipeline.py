@@ -0,0 +1,84 @@
+import os, sys
+import threading
+import time
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.pipeline import Pipeline, Stage
+
+def test_pipeline_runs_all_stages():
+
+    def double(item):
+        return item * 2
+
+    def skip_odd(item):
+        return item if item % 4 == 0 else None
+
+    pipeline = Pipeline([Stage("double", double, 2), Stage("skip", skip_odd, 3)])
+    completed = pipeline.run(range(10))
+
+    assert sorted(completed) == [0, 4, 8, 12, 16]
+    assert pipeline.stages[0].items == 10
+    assert pipeline.stages[1].items == 10
+
+def test_pipeline_errors():
+
+    errors = []
+
+    def fail(item):
+        if item == 3:
+            raise ValueError("broken")
+        return item
+
+    pipeline = Pipeline([Stage("fail", fail), Stage("pass", lambda item: item)],
+                        error_handler=lambda item, stage, ex: errors.append((item, stage.name)))
+
+    assert sorted(pipeline.run(range(5))) == [0, 1, 2, 4]
+    assert errors == [(3, "fail")]
+
+def test_pipeline_failing_error_handler():
+
+    def fail(item):
+        if item % 2:
+            raise ValueError("broken")
+        return item
+
+    def handle(item, stage, ex):
+        # e.g. waiting for the images of the album raises again
+        raise IOError("handler broken")
+
+    pipeline = Pipeline([Stage("fail", fail, 2), Stage("pass", lambda item: item)],
+                        error_handler=handle)
+
+    # the workers keep running and the pipeline finishes
+    assert sorted(pipeline.run(range(6))) == [0, 2, 4]
+
+def test_pipeline_overlaps_stages():
+
+    active = set()
+    overlapped = []
+    lock = threading.Lock()
+
+    def stage(name):
+        def func(item):
+            with lock:
+                active.add(name)
+                if len(active) > 1:
+                    overlapped.append(item)
+            time.sleep(0.05)
+            with lock:
+                active.discard(name)
+            return item
+        return func
+
+    pipeline = Pipeline([Stage("fetch", stage("fetch")), Stage("copy", stage("copy"))])
+    pipeline.run(range(4))
+
+    # the next item is fetched while the current one is copied
+    assert overlapped
+    assert pipeline.elapsed < 4 * 2 * 0.05
@@ -0,0 +1,68 @@
+import os, sys
+import random
+import shutil
+import tempfile
+import logging
+
+import pytest
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from ext.mediafile import MediaFile
+from discogstagger.probe import probe, probe_many, ProbeError
+
+def test_probe():
+
+    for filetype in ("flac", "mp3"):
+        path = os.path.join(parentdir, "test", "files", "test." + filetype)
+        info = probe(path)
+        metadata = MediaFile(path)
+
+        assert info.type == metadata.type
+        assert info.samplerate == metadata.samplerate
+        assert info.bitdepth == metadata.bitdepth
+        assert info.channels == metadata.channels
+        assert info.length == pytest.approx(metadata.length, abs=0.001)
+        assert info.bitrate == pytest.approx(metadata.bitrate, rel=0.01)
+
+def test_probe_many():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(parentdir, "test", "files", "test." + filetype)
+                 for filetype in ("flac", "mp3", "flac")]
+        not_audio = os.path.join(target_dir, "notes.txt")
+        with open(not_audio, "w") as fh:
+            fh.write("no audio\n" * 100)
+
+        with pytest.raises(ProbeError):
+            probe(not_audio)
+
+        # binary data contains sync words, which are no mp3 frames
+        rnd = random.Random(4711)
+        for name in ("noise.wav", "noise.ape", "noise.mp3"):
+            noise = os.path.join(target_dir, name)
+            with open(noise, "wb") as fh:
+                fh.write(bytes(rnd.getrandbits(8) for i in range(64 * 1024)))
+            with pytest.raises(ProbeError):
+                probe(noise)
+
+        # mp3 files are recognized by their extension only
+        not_mp3 = os.path.join(target_dir, "test.wav")
+        shutil.copyfile(paths[1], not_mp3)
+        with pytest.raises(ProbeError):
+            probe(not_mp3)
+
+        infos = probe_many(paths, workers=2, fields=('title', 'track'))
+        assert [info.path for info in infos] == paths
+        assert [info.type for info in infos] == ["flac", "mp3", "flac"]
+        for info in infos:
+            assert info.tags == MediaFile(info.path).as_dict(('title', 'track'))
+
+        assert probe_many(paths[:1], workers=1)[0].tags is None
+    finally:
+        shutil.rmtree(target_dir)
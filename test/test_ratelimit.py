@@ -0,0 +1,151 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.ratelimit import TokenBucket, SharedTokenBucket, RateLimiter, RateLimitedFetcher
+
+def test_token_bucket_reserve():
+
+    bucket = TokenBucket("metadata", 1.0, capacity=2)
+
+    # the burst is allowed without waiting
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+
+    # afterwards the requests are spread using the rate
+    assert 0.9 < bucket.reserve() <= 1.0
+    assert 1.9 < bucket.reserve() <= 2.0
+    assert bucket.calls == 4
+    assert bucket.throttled > 2.8
+
+def test_token_bucket_update():
+
+    bucket = TokenBucket("metadata", 1.0, capacity=5)
+
+    # the server reports a lower limit and only one remaining request
+    bucket.update(limit=30, remaining=1)
+
+    assert bucket.rate == 0.5
+    assert bucket.reserve() == 0
+    assert 1.9 < bucket.reserve() <= 2.0
+
+    # the configured rate is never exceeded
+    bucket.update(limit=240)
+    assert bucket.rate == 1.0
+
+def test_token_bucket_backoff():
+
+    bucket = TokenBucket("image", 10.0, capacity=5)
+    bucket.backoff(30)
+
+    assert 29 < bucket.reserve() <= 30
+
+def test_shared_token_bucket():
+
+    state_dir = tempfile.mkdtemp()
+    try:
+        state_file = os.path.join(state_dir, "ratelimit.json")
+
+        # two buckets (e.g. in different processes) using the same state
+        first = SharedTokenBucket("metadata", 1.0, 2, state_file)
+        second = SharedTokenBucket("metadata", 1.0, 2, state_file)
+
+        assert first.reserve() == 0
+        assert second.reserve() == 0
+        assert 0.9 < first.reserve() <= 1.0
+        assert 1.9 < second.reserve() <= 2.0
+
+        # other request classes are not affected
+        assert SharedTokenBucket("image", 1.0, 2, state_file).reserve() == 0
+    finally:
+        shutil.rmtree(state_dir)
+
+def test_classify():
+
+    assert RateLimiter.classify("https://api.discogs.com/database/search?q=x") == "search"
+    assert RateLimiter.classify("https://api.discogs.com/releases/1448190") == "metadata"
+    assert RateLimiter.classify("https://img.discogs.com/abc/R-3083.jpg") == "image"
+
+def test_update_from_headers():
+
+    limiter = RateLimiter({'api': 60, 'image': 60}, burst=5)
+    limiter.update_from_headers('search', {'X-Discogs-Ratelimit': '25',
+                                           'X-Discogs-Ratelimit-Used': '25',
+                                           'X-Discogs-Ratelimit-Remaining': '0'})
+
+    # the quota is shared by the api request classes, but not the images
+    assert limiter.buckets['api'].tokens == 0
+    assert limiter.buckets['api'].rate == 25 / 60.0
+    assert limiter.buckets['image'].tokens == 5
+
+def test_api_classes_share_bucket():
+
+    limiter = RateLimiter({'api': 60, 'image': 60}, burst=2)
+
+    # searches and release requests together stay within one quota
+    limiter.acquire('metadata')
+    limiter.acquire('search')
+    assert limiter.buckets['api'].tokens < 1
+    assert limiter.buckets['api'].calls == 2
+    assert limiter.buckets['image'].calls == 0
+
+class DummyResponse(object):
+
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = b'{}'
+
+class DummySession(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, method, url, params=None, data=None, headers=None):
+        self.requests.append(url)
+        return self.responses.pop(0)
+
+class DummyFetcher(object):
+    pass
+
+def test_fetcher_retries_on_429():
+
+    limiter = RateLimiter({'api': 6000, 'image': 6000}, burst=5)
+    session = DummySession([DummyResponse(429, {'Retry-After': '0'}),
+                            DummyResponse(200, {'X-Discogs-Ratelimit-Remaining': '59'})])
+    fetcher = RateLimitedFetcher(DummyFetcher(), limiter, session)
+
+    content, status_code = fetcher.fetch(None, 'GET', 'https://api.discogs.com/releases/3083')
+
+    assert status_code == 200
+    assert len(session.requests) == 2
+
+def test_fetcher_sends_json():
+
+    limiter = RateLimiter({'api': 6000, 'image': 6000}, burst=5)
+    session = DummySession([DummyResponse(200, {}), DummyResponse(200, {})])
+    sent = []
+    request = session.request
+    def record(method, url, params=None, data=None, headers=None):
+        sent.append((data, headers))
+        return request(method, url, params, data, headers)
+    session.request = record
+    fetcher = RateLimitedFetcher(DummyFetcher(), limiter, session)
+
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    fetcher.fetch(None, 'POST', 'https://api.discogs.com/users/me/wants/3083', {'notes': 'x'}, headers)
+    assert sent[0] == ('{"notes": "x"}', {'Content-Type': 'application/json'})
+    # the headers of the client are not changed
+    assert headers == {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    fetcher.fetch(None, 'POST', 'https://api.discogs.com/users/me/wants/3083', {'notes': 'x'}, headers,
+                  json=False)
+    assert sent[1] == ({'notes': 'x'}, headers)
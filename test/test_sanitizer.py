@@ -0,0 +1,81 @@
+import os, sys
+import re
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.sanitizer import FilenameSanitizer
+
+FILE_TYPES = (".mp3", ".flac", ".m3u", ".nfo")
+
+def replace_one_by_one(f, exceptions):
+    """ the replacements of the former TaggerUtils.get_clean_filename """
+    filename, fileext = os.path.splitext(f)
+    if not fileext in FILE_TYPES:
+        filename = f
+        fileext = ""
+    a = re.sub(r'\.$', '', filename)
+    a = re.sub(r'\$', 'S', a)
+    for k, v in exceptions.items():
+        a = a.replace(k, v)
+    return re.sub(r"[^-\w.,()\[\]\s#@&!']", "", a) + fileext
+
+NAMES = ["01 Ke$ha & Björk - Tik.Tok (Mix).flac", "Öl + Bier: ä/ü?", "CD 1.", "Guns N' Roses.mp3", "a.b.c"]
+
+def test_translation():
+
+    exceptions = {"&": "_and_", " ": "_", "ö": "oe", "ä": "ae", "ü": "ue", ".": "_", "+": "_and_"}
+    sanitizer = FilenameSanitizer(exceptions, file_types=FILE_TYPES)
+    assert sanitizer.table is not None
+
+    for name in NAMES:
+        assert sanitizer.clean(name) == replace_one_by_one(name, exceptions)
+    assert sanitizer.clean(NAMES[0]) == "01_KeSha__and__Bjoerk_-_Tik_Tok_(Mix).flac"
+
+    # the results are memoized
+    sanitizer.clean(NAMES[0])
+    assert sanitizer.clean.cache_info().hits == 2
+
+def test_ordered_replacements():
+
+    # the replacement of the space contains a character replaced later
+    exceptions = {" ": "_", "_": "-", "oe": "ö"}
+    sanitizer = FilenameSanitizer(exceptions, lower=True, file_types=FILE_TYPES)
+    assert sanitizer.table is None
+
+    for name in NAMES:
+        assert sanitizer.clean(name) == replace_one_by_one(name, exceptions).lower()
+
+def test_shared():
+
+    FilenameSanitizer.reset_shared()
+    sanitizer = FilenameSanitizer.shared({" ": "_"}, file_types=FILE_TYPES)
+    assert FilenameSanitizer.shared({" ": "_"}, file_types=FILE_TYPES) is sanitizer
+    assert FilenameSanitizer.shared({" ": "_"}, True, file_types=FILE_TYPES) is not sanitizer
+    assert FilenameSanitizer.shared({" ": "_"}, True, file_types=FILE_TYPES).clean("Café") == "Cafe"
+
+def test_normalize_option():
+
+    from discogstagger.tagger_config import TaggerConfig
+    from discogstagger.album import Album, Disc, Track
+    from discogstagger.taggerutils import TaggerUtils
+
+    album = Album(4712, "Modern EBM", ["Various"])
+    album.year = "2016"
+    album.catnumbers = ["CD 1"]
+    album.format = "CD"
+    album.format_description = ["Compilation"]
+    album.disctotal = 1
+    disc = Disc(1)
+    disc.filetype = ".flac"
+    disc.tracks = [Track(1, "Intro", ["Advance"])]
+    album.discs = [disc]
+    tagger_config = TaggerConfig(os.path.join(parentdir, "conf", "discogs_tagger_sjb.conf"))
+    # values other than the boolean ones are accepted and read as False
+    for value, normalize in (("True", True), ("yes", True), ("False", False), ("", False), ("maybe", False)):
+        tagger_config.set("file-formatting", "normalize", value)
+        assert TaggerUtils("/tmp/source", "/tmp/target", tagger_config, album).normalize == normalize
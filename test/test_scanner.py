@@ -0,0 +1,79 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.scanner import ScanIndex, ParallelScanner
+
+def touch(path):
+    open(path, "w").close()
+
+def walk(index, top):
+    scanner = ParallelScanner(index.listdir, workers=4)
+    return sorted(scanner.walk(top, lambda root, dirs, files: ((root, dirs, files), dirs)))
+
+def test_scan_index():
+
+    source_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(source_dir, "artist", "album"))
+        touch(os.path.join(source_dir, "artist", "album", "01.flac"))
+
+        index = ScanIndex(cache_dir)
+        # the listings are not trusted right after a modification
+        index.RACY_SECONDS = 0
+
+        assert walk(index, source_dir) == [(source_dir, ["artist"], []),
+                                           (os.path.join(source_dir, "artist"), ["album"], []),
+                                           (os.path.join(source_dir, "artist", "album"), [], ["01.flac"])]
+        assert index.misses == 3
+        index.close()
+
+        # the second scan only lists the changed directory
+        touch(os.path.join(source_dir, "artist", "album", ".done"))
+        index = ScanIndex(cache_dir)
+        index.RACY_SECONDS = 0
+        listing = index.listdir(os.path.join(source_dir, "artist", "album"))
+        assert listing.files == [".done", "01.flac"]
+        assert walk(index, source_dir)[2][2] == [".done", "01.flac"]
+        assert index.misses == 1
+        assert index.hits == 3
+    finally:
+        shutil.rmtree(source_dir)
+        shutil.rmtree(cache_dir)
+
+def test_parallel_scanner():
+
+    source_dir = tempfile.mkdtemp()
+    try:
+        for artist in range(5):
+            for album in range(5):
+                album_dir = os.path.join(source_dir, "artist%d" % artist, "album%d" % album)
+                os.makedirs(album_dir)
+                touch(os.path.join(album_dir, "id.txt"))
+        os.makedirs(os.path.join(source_dir, "done", "album"))
+        touch(os.path.join(source_dir, "done", "album", "id.txt"))
+
+        def visit(root, dirs, files):
+            # the pruned directories are not scanned
+            dirs = [d for d in dirs if d != "done"]
+            return (root if "id.txt" in files else None), dirs
+
+        found = list(ParallelScanner(workers=4).walk(source_dir, visit))
+
+        assert len(found) == 25
+        assert os.path.join(source_dir, "artist3", "album2") in found
+    finally:
+        shutil.rmtree(source_dir)
+
+def test_parallel_scanner_errors():
+
+    found = list(ParallelScanner().walk("/does/not/exist", lambda root, dirs, files: (root, dirs)))
+    assert found == []
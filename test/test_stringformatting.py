@@ -0,0 +1,113 @@
+import os, sys
+import logging
+
+import pytest
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.stringformatting import StringFormatting
+
+FORMAT = "%albumartist%/[%year%] %album% \\(%catnumber%\\)$if1($strcmp('%totaldiscs%',''),'',$ifgreater('%totaldiscs%', 1,'/CD %discnumber%',''))$if1($strcmp('%disctitle%',''),'',', %disctitle%')/$num('%track%','2') $if1($strcmp('%artist%','%albumartist%'),'','%artist% - ')%title%%fileext%"
+
+def test_parse_string():
+
+    stringFormatting = StringFormatting()
+    values = {
+        '%artist%': 'Advance',
+        '%albumartist%': 'Various Artists',
+        '%year%': '2016',
+        '%album%': 'Modern EBM',
+        '%catnumber%': 'CD 1',
+        '%totaldiscs%': '2',
+        '%discnumber%': '1',
+        '%disctitle%': "Bonus (Live)",
+        '%title%': "Dead technology, it's (not) $1",
+        '%track%': '5',
+        '%fileext%': '.flac',
+    }
+
+    result = stringFormatting.parseString(FORMAT, values)
+    assert result == "Various Artists/[2016] Modern EBM (CD 1)/CD 1, Bonus (Live)/05 Advance - Dead technology, it's (not) $1.flac"
+
+    values['%totaldiscs%'] = '1'
+    values['%disctitle%'] = None
+    values['%artist%'] = values['%albumartist%'] = 'Advance'
+    result = stringFormatting.parseString(FORMAT, values)
+    assert result == "Advance/[2016] Modern EBM (CD 1)/05 Dead technology, it's (not) $1.flac"
+
+    # the format is compiled once
+    assert StringFormatting.compile(FORMAT) is StringFormatting.compile(FORMAT)
+    assert StringFormatting.compile(FORMAT).placeholders == set(values)
+
+def test_functions():
+
+    stringFormatting = StringFormatting()
+    values = {'%album%': 'Deus Ex Machina', '%artist%': 'Advance'}
+
+    assert stringFormatting.parseString("$num(8,4)") == "0008"
+    assert stringFormatting.parseString("$upper('%artist%')-$lower('%album%')", values) == "ADVANCE-deus ex machina"
+    assert stringFormatting.parseString("$substr('%album%',0,4)", values) == "Deus"
+    assert stringFormatting.parseString("$if1($inarray('[\\'Advance\\']','%artist%'),'yes','no')", values) == "yes"
+    assert stringFormatting.parseString("$ifequal('2', 2,'two','other')") == "two"
+    assert stringFormatting.parseString("$unknown('%artist%')", values) == "unknown command"
+    # placeholders without value are kept
+    assert stringFormatting.parseString("%artist% 100%", {}) == "%artist% 100%"
+
+    with pytest.raises(ValueError):
+        stringFormatting.parseString("$num('%track%',2")
+
+def test_unquoted_placeholders():
+
+    stringFormatting = StringFormatting()
+
+    # passed as they are (like the former eval), quoted as string
+    assert stringFormatting.parseString("$ifequal(%bitdepth%,24,'24bit','')", {'%bitdepth%': None}) == ""
+    assert stringFormatting.parseString("$ifequal(%bitdepth%,24,'24bit','')", {'%bitdepth%': 24}) == "24bit"
+    assert stringFormatting.parseString("$if1($strcmp('%disctitle%',''),'',', %disctitle%')", {'%disctitle%': None}) == ""
+
+def test_formatting_context():
+
+    from discogstagger.tagger_config import TaggerConfig
+    from discogstagger.album import Album, Disc, Track
+    from discogstagger.taggerutils import TaggerUtils
+
+    album = Album(4712, "Modern EBM", ["Various"])
+    album.year = "2016"
+    album.catnumbers = ["CD 1"]
+    album.disctotal = 1
+    album.format = "CD"
+    album.format_description = ["Compilation"]
+    disc = Disc(1)
+    disc.filetype = ".flac"
+    disc.tracks = [Track(1, "Intro", ["Advance"]), Track(2, "Dead (technology)", ["Advance"])]
+    album.discs = [disc]
+    # the properties of the audio files (see gather_addional_properties)
+    for track in disc.tracks:
+        track.codec, track.encoding, track.channels = "flac", "lossless", "stereo"
+        track.bitdepth, track.samplerate = 24, 44100
+
+    tagger_config = TaggerConfig(os.path.join(parentdir, "conf/discogs_tagger_sjb.conf"))
+    taggerutils = TaggerUtils("/tmp/source", "/tmp/target", tagger_config, album)
+
+    # only the placeholders of the format are computed, e.g. the missing
+    # genre is not used
+    values = taggerutils._format_values("%ALBARTIST%", 1, 2)
+    assert values["%title%"] == "Dead (technology)"
+    assert values["%TRACKNO%"] == "02"
+    assert values["%catno%"] == "CD 1"
+    assert "%GENRE%" in values
+
+    assert taggerutils.dest_dir_name == "/tmp/target/Various Artists/[2016] Modern EBM (CD 1) [CD flac 24bit lossless-44s]"
+    assert taggerutils._value_from_tag("%TRACKNO% %ARTIST% - %TITLE%%TYPE%", 1, 2, ".flac") == \
+        "02 Advance - Dead (technology).flac"
+    assert taggerutils._value_from_tag_format("%ALBARTIST%-(%CATNO%)") == "Various-(CD\\ 1)"
+
+    # the album values are computed once, the track values on each use
+    album.title = "Changed"
+    disc.tracks[1].title = "Changed"
+    assert taggerutils._format_values("%album%")["%album%"] == "Modern EBM"
+    assert taggerutils._format_values("%title%", 1, 2)["%title%"] == "Changed"
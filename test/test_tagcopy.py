@@ -0,0 +1,79 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from ext.mediafile import MediaFile
+from discogstagger.taggerutils import TagPlan
+from discogstagger.tagcopy import tagged_copy, tags_changed, audio_range
+
+def audio(path, filetype):
+    with open(path, "rb") as fh:
+        start, end = audio_range(fh, filetype)
+        fh.seek(start)
+        return fh.read(end - start)
+
+def test_tagged_copy():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        for filetype in ("flac", "mp3"):
+            source_file = os.path.join(parentdir, "test", "files", "test." + filetype)
+            target_file = os.path.join(target_dir, "01." + filetype)
+            with open(source_file, "rb") as fh:
+                source = fh.read()
+
+            plan = TagPlan(None, None, filetype)
+            # does not fit into the existing padding
+            plan.title = "Title" * 1000
+            plan.track = 1
+            plan.art = open(os.path.join(parentdir, "test", "files", "cover.jpeg"), "rb").read()
+
+            written = tagged_copy(source_file, target_file, plan)
+            assert written == os.path.getsize(target_file)
+            assert not [name for name in os.listdir(target_dir) if name.endswith(".part")]
+
+            metadata = MediaFile(target_file)
+            assert metadata.title == "Title" * 1000
+            assert metadata.track == 1
+            assert metadata.art is not None
+
+            # the audio is copied unchanged, the source is untouched
+            assert audio(target_file, filetype) == audio(source_file, filetype)
+            with open(source_file, "rb") as fh:
+                assert fh.read() == source
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_tags_changed():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        for filetype in ("flac", "mp3"):
+            source_file = os.path.join(parentdir, "test", "files", "test." + filetype)
+            target_file = os.path.join(target_dir, "01." + filetype)
+
+            plan = TagPlan(None, None, filetype)
+            plan.title = "Title"
+            plan.genres = ["Electronic", "House"]
+            plan.art = open(os.path.join(parentdir, "test", "files", "cover.jpeg"), "rb").read()
+            tagged_copy(source_file, target_file, plan)
+
+            assert not tags_changed(target_file, plan)
+            # the source still has its own tags
+            assert tags_changed(source_file, plan)
+
+            plan.genres = ["Electronic"]
+            assert tags_changed(target_file, plan)
+            plan.genres = ["Electronic", "House"]
+
+            plan.art = plan.art[:-1]
+            assert tags_changed(target_file, plan)
+    finally:
+        shutil.rmtree(target_dir)
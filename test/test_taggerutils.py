@@ -408,54 +408,17 @@ class TestFileHandler(TestTaggerUtilFiles):
             self.album.disc(2).target_dir, self.album.disc(2).track(20).new_file)
         assert os.path.exists(track_file)
 
-    def test_embed_coverart_track(self):
-        testTagUtils = TaggerUtils(self.source_dir, self.target_dir, self.tagger_config, self.album)
-
-        testFileHandler = FileHandler(self.album, self.tagger_config)
-
-        self.copy_files(self.album)
-
-        testTagUtils._get_target_list()
-
-        testFileHandler.copy_files()
-
-        assert os.path.exists(self.album.sourcedir)
-        assert os.path.exists(self.album.target_dir)
-
-        track = self.album.disc(1).track(1)
-        track_file = os.path.join(self.album.target_dir,
-            self.album.disc(1).target_dir, track.new_file)
-
-        source_file = "test/files/cover.jpeg"
-        target_dir = os.path.join(self.album.target_dir, self.album.disc(1).target_dir)
-        image_file = os.path.join(target_dir, "cover.jpeg")
-        shutil.copyfile(source_file, image_file)
-        imgdata = open(image_file).read()
-
-        testFileHandler.embed_coverart_track(self.album.disc(1), track, imgdata)
-
-        assert os.path.exists(track_file)
-
-        metadata = MediaFile(track_file)
-
-        assert not metadata.art == None
-
-        track = self.album.disc(1).track(2)
-        track_file = os.path.join(self.album.target_dir,
-            self.album.disc(1).target_dir, track.new_file)
-        metadata = MediaFile(track_file)
-
-        assert metadata.art == None
-
-    def test_embed_coverart_album(self):
+    def test_embed_coverart(self):
         testTagUtils = TaggerUtils(self.source_dir, self.target_dir, self.tagger_config, self.album)
 
+        testTagHandler = TagHandler(self.album, self.tagger_config)
         testFileHandler = FileHandler(self.album, self.tagger_config)
 
         self.copy_files(self.album)
 
         testTagUtils._get_target_list()
 
+        testTagHandler.tag_album()
         testFileHandler.copy_files()
 
         assert os.path.exists(self.album.sourcedir)
@@ -465,14 +428,18 @@ class TestFileHandler(TestTaggerUtilFiles):
         image_file = os.path.join(self.album.target_dir, "folder.jpg")
         shutil.copyfile(source_file, image_file)
 
-        testFileHandler.embed_coverart_album()
+        # the cover art is added to the planned tags, every file is saved once
+        imgdata = testFileHandler.load_coverart()
+        assert not imgdata == None
+        testTagHandler.add_art(imgdata)
+        testTagHandler.write_album(testFileHandler)
 
-        track = self.album.disc(1).track(1)
-        track_file = os.path.join(self.album.target_dir,
-            self.album.disc(1).target_dir, track.new_file)
-        metadata = MediaFile(track_file)
+        for track in (self.album.disc(1).track(1), self.album.disc(1).track(2)):
+            track_file = os.path.join(self.album.target_dir,
+                self.album.disc(1).target_dir, track.new_file)
+            metadata = MediaFile(track_file)
 
-        assert not metadata.art == None
+            assert not metadata.art == None
 
     def test_copy_other_files(self):
         assert not self.tagger_config.getboolean("details", "copy_other_files")
@@ -621,15 +588,26 @@ class TestTagHandler(TestTaggerUtilFiles):
     def tearDown(self):
         TestTaggerUtilFiles.tearDown(self)
 
+    def write_plan(self, plan, track_file):
+        """ writes the planned tags (see TagHandler.write_album) """
+        metadata = MediaFile(track_file)
+        plan.apply(metadata)
+        metadata.save()
+        return MediaFile(track_file)
+
     def test_tag_single_track(self):
-        shutil.copyfile(self.source_file, os.path.join(self.source_dir, self.target_file_name))
+        track_file = os.path.join(self.source_dir, self.target_file_name)
+        shutil.copyfile(self.source_file, track_file)
 
         testTagHandler = TagHandler(self.album, self.tagger_config)
+        self.album.disc(1).track(1).orig_file = self.target_file_name
         self.album.disc(1).track(1).new_file = self.target_file_name
 
-        testTagHandler.tag_single_track(self.source_dir, self.album.disc(1).track(1))
+        # the tags are planned only, the file is not touched
+        plan = testTagHandler.tag_single_track(self.source_dir, self.album.disc(1).track(1))
+        assert MediaFile(track_file).discogs_id == None
 
-        metadata = MediaFile(os.path.join(self.source_dir, self.target_file_name))
+        metadata = self.write_plan(plan, track_file)
 
         assert metadata.artist == "Gigi D'Agostino"
         assert len(metadata.albumartists) == 1
@@ -649,11 +627,12 @@ class TestTagHandler(TestTaggerUtilFiles):
         shutil.copyfile(self.source_file, os.path.join(self.source_dir, self.target_file_name))
 
         testTagHandler = TagHandler(self.album, self.tagger_config)
+        self.album.disc(2).track(19).orig_file = self.target_file_name
         self.album.disc(2).track(19).new_file = self.target_file_name
 
-        testTagHandler.tag_single_track(self.source_dir, self.album.disc(2).track(19))
+        plan = testTagHandler.tag_single_track(self.source_dir, self.album.disc(2).track(19))
 
-        metadata = MediaFile(os.path.join(self.source_dir, self.target_file_name))
+        metadata = self.write_plan(plan, track_file)
 
         logger.debug("artist_sort: %s" % metadata.artist_sort)
         logger.debug("artist: %s" % metadata.artist)
@@ -684,6 +663,7 @@ class TestTagHandler(TestTaggerUtilFiles):
         testFileHandler.copy_files()
 
         testTagHandler.tag_album()
+        testTagHandler.write_album(testFileHandler)
 
         target_dir = os.path.join(self.target_dir, self.album.target_dir, self.album.disc(1).target_dir)
         metadata = MediaFile(os.path.join(target_dir, "01-gigi_dagostino-la_passion_(radio_cut).flac"))
@@ -741,6 +721,7 @@ class TestTagHandler(TestTaggerUtilFiles):
         testFileHandler.copy_files()
 
         testTagHandler.tag_album()
+        testTagHandler.write_album(testFileHandler)
 
         target_dir = os.path.join(self.target_dir, self.album.target_dir, self.album.disc(1).target_dir)
         metadata = MediaFile(os.path.join(target_dir, "01-artful_dodger-re-rewind_the_crowd_say_bo_selecta_(radio_edit).flac"))
@@ -809,6 +790,7 @@ class TestTagHandler(TestTaggerUtilFiles):
         testFileHandler.copy_files()
 
         testTagHandler.tag_album()
+        testTagHandler.write_album(testFileHandler)
 
         target_dir = os.path.join(self.target_dir, self.album.target_dir)
         metadata = MediaFile(os.path.join(target_dir, "01-front_242-masterhit.flac"))
@@ -849,6 +831,7 @@ class TestTagHandler(TestTaggerUtilFiles):
         testFileHandler.copy_files()
 
         testTagHandler.tag_album()
+        testTagHandler.write_album(testFileHandler)
 
         target_dir = os.path.join(self.target_dir, self.album.target_dir)
         metadata = MediaFile(os.path.join(target_dir, "01-coldcut-timber_(chopped_down_radio_edit).flac"))
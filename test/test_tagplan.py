@@ -0,0 +1,169 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+import pytest
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from ext.mediafile import MediaFile, PaddingPolicy, UnreadableFileError
+from discogstagger.taggerutils import TagPlan
+
+def test_tag_plan():
+
+    plan = TagPlan("disc", "track", "flac")
+    plan.title = "Megahits 2001"
+    plan.disc = 1
+    plan.track = 3
+
+    # the disc and track tags do not hide the planned disc and track
+    assert plan.album_disc == "disc"
+    assert plan.album_track == "track"
+    assert plan.values == {"title": "Megahits 2001", "disc": 1, "track": 3}
+
+def test_tag_plan_apply():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        track_file = os.path.join(target_dir, "01.flac")
+        shutil.copyfile(os.path.join(parentdir, "test", "files", "test.flac"), track_file)
+
+        metadata = MediaFile(track_file)
+        metadata.comments = "old comment"
+        metadata.save()
+
+        plan = TagPlan(None, None, "flac")
+        plan.title = "Title"
+        plan.track = 1
+        plan.art = open(os.path.join(parentdir, "test", "files", "cover.jpeg"), "rb").read()
+
+        metadata = MediaFile(track_file)
+        plan.apply(metadata)
+        metadata.save()
+
+        metadata = MediaFile(track_file)
+        assert metadata.title == "Title"
+        assert metadata.track == 1
+        assert metadata.art is not None
+        # all other tags are replaced
+        assert metadata.comments is None
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_padding_policy():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        padding = PaddingPolicy(32 * 1024)
+        for filetype in ("flac", "mp3"):
+            track_file = os.path.join(target_dir, "01." + filetype)
+            shutil.copyfile(os.path.join(parentdir, "test", "files", "test." + filetype), track_file)
+
+            # the cover does not fit into the padding of the file
+            metadata = MediaFile(track_file)
+            metadata.art = open(os.path.join(parentdir, "test", "files", "cover.jpeg"), "rb").read()
+            metadata.save(padding=padding)
+            size = os.path.getsize(track_file)
+
+            # further changes are written into the reserved padding
+            metadata = MediaFile(track_file)
+            metadata.title = "A much longer title than before" * 10
+            metadata.save(padding=padding)
+            assert os.path.getsize(track_file) == size
+            assert MediaFile(track_file).title == "A much longer title than before" * 10
+
+        assert padding.rewrites == 2
+        assert padding.in_place == 2
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_field_styles_are_resolved_once():
+
+    mgfile = MediaFile(os.path.join(parentdir, "test", "files", "test.flac")).mgfile
+    field = MediaFile.__dict__["title"]
+
+    styles = field.styles(mgfile)
+    assert styles
+    assert all("FLAC" in style.formats for style in styles)
+    assert field.styles(mgfile) is styles
+
+def test_mediafile_as_dict_and_apply():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        for filetype in ("flac", "mp3"):
+            track_file = os.path.join(target_dir, "01." + filetype)
+            shutil.copyfile(os.path.join(parentdir, "test", "files", "test." + filetype), track_file)
+
+            metadata = MediaFile(track_file)
+            metadata.apply({"title": "Title", "artist": ["Artist"], "track": 2, "year": 2001})
+            metadata.save()
+
+            metadata = MediaFile(track_file)
+            values = metadata.as_dict(("title", "artist", "track", "year", "comments", "samplerate"))
+            assert values == {"title": "Title", "artist": ["Artist"], "track": 2, "year": 2001,
+                              "comments": None, "samplerate": metadata.samplerate}
+
+            # all readable fields, read in a single pass
+            values = metadata.as_dict()
+            assert values == dict((name, getattr(metadata, name)) for name in metadata.readable_fields())
+
+            assert MediaFile.read_many([track_file], ("title",)) == [{"title": "Title", "type": filetype}]
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_mediafile_without_pictures():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        cover = open(os.path.join(parentdir, "test", "files", "cover.jpeg"), "rb").read()
+        for filetype in ("flac", "mp3"):
+            track_file = os.path.join(target_dir, "01." + filetype)
+            shutil.copyfile(os.path.join(parentdir, "test", "files", "test." + filetype), track_file)
+            metadata = MediaFile(track_file)
+            metadata.title = "Title"
+            metadata.art = cover
+            metadata.save()
+            metadata = MediaFile(track_file)
+
+            light = MediaFile(track_file, pictures=False)
+            assert light.title == "Title"
+            assert light.bitrate == metadata.bitrate
+            assert light.length == metadata.length
+
+            # loaded on access
+            assert light.art == cover
+            with pytest.raises(UnreadableFileError):
+                light.save()
+    finally:
+        shutil.rmtree(target_dir)
+
+def test_tag_plan_keeps_flac_pictures():
+
+    target_dir = tempfile.mkdtemp()
+    try:
+        track_file = os.path.join(target_dir, "01.flac")
+        shutil.copyfile(os.path.join(parentdir, "test", "files", "test.flac"), track_file)
+
+        metadata = MediaFile(track_file)
+        metadata.art = open(os.path.join(parentdir, "test", "files", "cover.jpeg"), "rb").read()
+        metadata.save()
+
+        # the pictures are not tags, they are kept like by MediaFile.delete
+        # (e.g. embed_coverart=False)
+        plan = TagPlan(None, None, "flac")
+        plan.title = "Title"
+        metadata = MediaFile(track_file)
+        plan.apply(metadata)
+        metadata.save()
+
+        metadata = MediaFile(track_file)
+        assert metadata.title == "Title"
+        assert metadata.art is not None
+    finally:
+        shutil.rmtree(target_dir)
@@ -0,0 +1,38 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.tagger_config import TaggerConfig
+from discogstagger.taggerutils import TaggerUtils
+
+def test_shared_template_lookup():
+
+    cache_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(parentdir)
+        conf_file = os.path.join(cache_dir, "test.conf")
+        with open(conf_file, "w") as fh:
+            fh.write("[cache]\ncache_dir=%s\n" % cache_dir)
+        tagger_config = TaggerConfig(conf_file)
+
+        TaggerUtils.reset_shared()
+        lookup = TaggerUtils.shared_template_lookup(tagger_config)
+        # all albums use the same lookup
+        assert TaggerUtils.shared_template_lookup(TaggerConfig(conf_file)) is lookup
+
+        template = lookup.get_template("m3u.txt")
+        assert lookup.get_template("m3u.txt") is template
+        # the compiled template is kept for the next runs
+        assert os.path.exists(os.path.join(cache_dir, "templates", "m3u.txt.py"))
+    finally:
+        os.chdir(cwd)
+        TaggerUtils.reset_shared()
+        shutil.rmtree(cache_dir)
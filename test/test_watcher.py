@@ -0,0 +1,85 @@
+import os, sys
+import shutil
+import tempfile
+import logging
+
+logging.basicConfig(level=10)
+logger = logging.getLogger(__name__)
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parentdir)
+
+from discogstagger.watcher import WorkQueue, WatchDaemon, AlbumEventHandler
+
+def test_work_queue_is_persistent():
+
+    queue_dir = tempfile.mkdtemp()
+    try:
+        queue_file = os.path.join(queue_dir, "watch.db")
+        work_queue = WorkQueue(queue_file)
+        work_queue.put("/music/a")
+        work_queue.put("/music/b")
+
+        assert work_queue.take(0) == "/music/a"
+        work_queue.done("/music/a")
+        # taken, but not processed
+        assert work_queue.take(0) == "/music/b"
+        assert work_queue.take(0) is None
+        work_queue.close()
+
+        work_queue = WorkQueue(queue_file)
+        assert len(work_queue) == 1
+        assert work_queue.take(0) == "/music/b"
+    finally:
+        shutil.rmtree(queue_dir)
+
+def test_album_dir_of_disc_subdirectories():
+
+    handler = AlbumEventHandler(None)
+
+    assert handler.album_dir("/music/album/01.flac") == "/music/album"
+    assert handler.album_dir("/music/album/CD1/01.flac") == "/music/album"
+    assert handler.album_dir("/music/album/disc 2/01.flac") == "/music/album"
+
+def test_watch_daemon_settle():
+
+    source_dir = tempfile.mkdtemp()
+    try:
+        album_dir = os.path.join(source_dir, "album")
+        os.mkdir(album_dir)
+        with open(os.path.join(album_dir, "01.flac"), "wb") as fh:
+            fh.write(b"audio")
+
+        work_queue = WorkQueue(os.path.join(source_dir, "watch.db"))
+        daemon = WatchDaemon(source_dir, None, work_queue, quiet_period=0,
+                             ignore_names=(".done",))
+
+        daemon.touch(album_dir)
+        # ignored, outside of the source directory
+        daemon.touch("/elsewhere")
+        daemon.touch(source_dir + "2")
+        daemon.touch(os.path.join(source_dir + "2", "album"))
+        # files directly in the source directory belong to no album
+        daemon.touch(source_dir)
+        assert list(daemon.pending) == [album_dir]
+        assert daemon.ignored(os.path.join(album_dir, ".done"))
+
+        # the first check records the signature, the second one queues the
+        # directory, if nothing changed
+        daemon.settle()
+        assert len(work_queue) == 0
+        daemon.settle()
+        assert work_queue.take(0) == album_dir
+        assert daemon.pending == {}
+
+        # a changed file restarts the settling
+        daemon.touch(album_dir)
+        daemon.settle()
+        with open(os.path.join(album_dir, "02.flac"), "wb") as fh:
+            fh.write(b"more audio")
+        daemon.settle()
+        assert work_queue.take(0) is None
+        daemon.settle()
+        assert work_queue.take(0) == album_dir
+    finally:
+        shutil.rmtree(source_dir)